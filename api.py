@@ -0,0 +1,187 @@
+from flask import Blueprint, request, jsonify, abort, current_app, url_for
+from flask_login import login_required
+from get_data_fhir import get_census_page, get_census_version, get_census_overview, get_census_origin, \
+    get_health_status, get_observation_history, get_observation_trend, query_patient_status, sync_observations, \
+    invalidate_patient, get_cache_stats, census_lock, settings as fhir_settings, HISTORY_KEYS, HEALTH_STATUS_LEVELS, \
+    WARD_NAMES
+from main import overview_query
+from jobs import start_job, get_job_status
+from auth import check_csrf, csrf_token
+from email.utils import formatdate
+import calendar
+import hashlib
+import json
+
+# JSON views of the census for polling dashboards, unchanged data is answered with 304 Not Modified. The version
+# and the body of a response are read under one census_lock acquisition, so a body never goes out under the etag
+# of another version. Without SHARED_CENSUS every worker process counts its own versions, the etags name the process
+api = Blueprint('api', __name__, url_prefix='/api')
+
+
+@api.route('/census')
+@login_required
+def census():
+    query = overview_query()
+    with census_lock:
+        version, modified_at = get_census_version()
+        # the page depends on the census version and the query string only
+        etag = hash_etag([get_census_origin(), version, sorted(query.items())])
+
+        def build():
+            patient_records, total, ward_allocation = get_census_page(**query)
+            return {'version': version, 'total': total, 'offset': query['offset'], 'limit': query['limit'],
+                    'patients': patient_records}
+
+        return conditional_json(etag, modified_at, build)
+
+
+@api.route('/status')
+@login_required
+def status():
+    # health status, rank and wards of the census from the materialized status table, e.g.
+    # /api/status?health_status=Emergent&ward=intensive+care+unit
+    health_status, ward, suggest_ward = (request.args.get(name) or None
+                                         for name in ['health_status', 'ward', 'suggest_ward'])
+    if health_status not in HEALTH_STATUS_LEVELS + [None] or ward not in WARD_NAMES + [None] \
+            or suggest_ward not in WARD_NAMES + [None]:
+        abort(400)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', fhir_settings['overview_page_size'], type=int), 1),
+                fhir_settings['overview_max_page_size'])
+    with census_lock:
+        # pending changes are applied first, the status table is written with them
+        version, modified_at = get_census_version()
+        etag = hash_etag([get_census_origin(), version, health_status, ward, suggest_ward, offset, limit])
+
+        def build():
+            patients, total = query_patient_status(health_status, ward, suggest_ward, offset, limit)
+            return {'version': version, 'total': total, 'offset': offset, 'limit': limit, 'patients': patients}
+
+        return conditional_json(etag, modified_at, build)
+
+
+@api.route('/occupancy')
+@login_required
+def occupancy():
+    with census_lock:
+        patient_records, ward_allocation = get_census_overview()
+        version, modified_at = get_census_version()
+        # the counters themselves make the etag, so patients changing level without changing ward are not reported
+        ward_allocation = dict(ward_allocation)
+
+    return conditional_json(hash_etag(ward_allocation), modified_at, lambda: ward_allocation)
+
+
+@api.route('/patients/<patient_id>')
+@login_required
+def patient(patient_id):
+    with census_lock:
+        patient_record = get_health_status(patient_id)
+        if patient_record is None:
+            abort(404)
+        version, modified_at = get_census_version()
+
+    return conditional_json(hash_etag(patient_record), modified_at, lambda: patient_record)
+
+
+@api.route('/patients/<patient_id>/history/<key>')
+@login_required
+def history(patient_id, key):
+    # measured values between start and end (epoch seconds), oldest first
+    start, end = history_range(key)
+    values = [{'time': time, 'value': value} for time, value in get_observation_history(patient_id, key, start, end)]
+
+    return conditional_json(hash_etag(values), None, lambda: values)
+
+
+@api.route('/patients/<patient_id>/trends/<key>')
+@login_required
+def trend(patient_id, key):
+    # the history downsampled to at most ?buckets= buckets with min, max and last value
+    start, end = history_range(key)
+    buckets = request.args.get('buckets', type=int)
+    if buckets is not None and buckets < 1:
+        abort(400)
+    trend_buckets = get_observation_trend(patient_id, key, start, end, buckets)
+
+    return conditional_json(hash_etag(trend_buckets), None, lambda: trend_buckets)
+
+
+@api.route('/patients/<patient_id>/invalidate', methods=['POST'])
+@login_required
+def invalidate(patient_id):
+    # drop the patient's cached query result after it was changed on FHIR server, the next census update queries
+    # it again in the background
+    check_csrf()
+    invalidate_patient(patient_id)
+
+    return '', 204
+
+
+@api.route('/cache')
+@login_required
+def cache():
+    # hits, misses, expired entries, evictions and invalidations of the local cache counted by this worker process
+    return jsonify(get_cache_stats())
+
+
+@api.route('/csrf')
+@login_required
+def csrf():
+    # the token POST routes expect in the X-CSRF-Token header, for clients that do not render the pages
+    return jsonify({'token': csrf_token()})
+
+
+@api.route('/sync', methods=['POST'])
+@login_required
+def sync():
+    # merge the observations updated on FHIR server into the local cache in a background job, a sync already
+    # running is reported instead of starting another. Poll the job at the Location url
+    check_csrf()
+    job_id = start_job('observation_sync', run_observation_sync)
+    response = jsonify(get_job_status(job_id))
+    response.status_code = 202
+    response.headers['Location'] = url_for('main.job_status', job_id=job_id)
+
+    return response
+
+
+def run_observation_sync(progress):
+    # the job counts the observations read, its result is the number of changed patients
+    return sync_observations(progress=progress)
+
+
+def history_range(key):
+    if key not in HISTORY_KEYS:
+        abort(404)
+
+    return request.args.get('start', type=float), request.args.get('end', type=float)
+
+
+def hash_etag(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def conditional_json(etag, modified_at, build):
+    # the body is only built when the client does not have the current version
+    if is_not_modified(etag, modified_at):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    if modified_at is not None:
+        response.headers['Last-Modified'] = formatdate(modified_at, usegmt=True)
+    # clients must revalidate, a 304 costs no more than the version check
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+
+def is_not_modified(etag, modified_at):
+    # If-None-Match wins over If-Modified-Since, like in RFC 7232
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is not None and modified_at is not None:
+        return calendar.timegm(request.if_modified_since.utctimetuple()) >= int(modified_at)
+
+    return False
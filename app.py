@@ -33,6 +33,10 @@ def create_app():
     app.register_blueprint(auth_blueprint)
     from main import main as main_blueprint
     app.register_blueprint(main_blueprint)
+    from api import api as api_blueprint
+    app.register_blueprint(api_blueprint)
+    from metrics import metrics as metrics_blueprint
+    app.register_blueprint(metrics_blueprint)
 
     return app
 
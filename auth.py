@@ -1,8 +1,9 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash
+from flask import Blueprint, render_template, redirect, url_for, request, flash, session, abort
 from flask_login import login_user, login_required, logout_user
 from datetime import timedelta
 from model import UserInfo
-from get_data_fhir import clear_local_database
+import secrets
+import hmac
 
 auth = Blueprint('auth', __name__)
 
@@ -37,5 +38,19 @@ def login_post():
 @login_required
 def logout():
     logout_user()
-    clear_local_database()
     return redirect(url_for('auth.login'))
+
+
+@auth.app_template_global()
+def csrf_token():
+    # one token per session, POST routes changing state check it with check_csrf
+    if 'csrf token' not in session:
+        session['csrf token'] = secrets.token_hex(16)
+    return session['csrf token']
+
+
+def check_csrf():
+    # fetch() calls send the token in a header, forms in a field
+    token = request.headers.get('X-CSRF-Token') or request.form.get('csrf_token') or ''
+    if not token or not hmac.compare_digest(token, session.get('csrf token', '')):
+        abort(400)
@@ -0,0 +1,476 @@
+from sqlalchemy import create_engine
+from datetime import datetime, timezone
+import argparse
+import platform
+import tempfile
+import random
+import json
+import time
+import uuid
+import os
+import pandas as pd
+from patient_record import PatientRecord, PatientTable
+import fhir_client
+import fhir_server
+import get_data_fhir
+import upload_data
+import ward_scheduler
+
+PATIENT_SOURCE_COLUMNS = ['Patient ID', 'family name', 'given name', 'gender', 'dob', 'ward allocation',
+                          'SARS-Cov-2 exam result', 'has_disease', 'Leukocytes', 'Platelets',
+                          'Mean platelet volume', 'Eosinophils', 'Monocytes']
+WARDS = ['no allocation', 'regular ward', 'semi-intensive unit', 'intensive care unit']
+
+
+def make_patient_source(size, seed=0):
+    # random rows shaped like the patient_source table
+    rnd = random.Random(seed)
+    rows = list()
+    for i in range(size):
+        rows.append([str(uuid.UUID(int=rnd.getrandbits(128), version=4)), 'Family' + str(i), 'Given' + str(i),
+                     rnd.choice(['female', 'male']), '1970-01-01', rnd.choice(WARDS),
+                     rnd.randint(0, 1), rnd.randint(0, 1),
+                     round(rnd.gauss(0, 1), 4), round(rnd.gauss(0, 1), 4), round(rnd.gauss(0, 1), 4),
+                     round(rnd.gauss(0, 1), 4), round(rnd.gauss(0, 1), 4)])
+
+    return pd.DataFrame(rows, columns=PATIENT_SOURCE_COLUMNS)
+
+
+def make_patient_records(size, seed=0):
+    # records shaped like search_all_patient_data results, rounded values so that ties occur
+    rnd = random.Random(seed)
+    records = list()
+    for i in range(size):
+        record = PatientRecord({'patient id': str(i), 'full name': 'Patient ' + str(i), 'birth date': '1970-01-01',
+                                'ward allocation': rnd.choice(WARDS), 'COVID-19 test result': rnd.randint(0, 1),
+                                'patient has disease': rnd.randint(0, 1)})
+        for key in get_data_fhir.HISTORY_KEYS:
+            record[key] = round(rnd.gauss(0, 1), 1)
+            record['UoM ' + key] = '10*3/uL'
+        records.append(record)
+
+    return records
+
+
+# the resources of upload_data built one dict at a time, the reference of the generate suite and the data of
+# seed_server. upload_data.generate_resources encodes the same resources apart from ids and times
+def reference_patient(patient_data):
+    resource = dict()
+
+    # map patient data from database
+    resource['resourceType'] = 'Patient'
+    resource['id'] = patient_data['Patient ID']
+    resource['active'] = True
+    resource['gender'] = patient_data['gender']
+    resource['birthDate'] = patient_data['dob']
+
+    name = list()
+    name_detail = dict()
+    name_detail['use'] = 'official'
+    name_detail['family'] = patient_data['family name']
+    name_detail['given'] = list()
+    name_detail['given'].append(patient_data['given name'])
+    name_detail['prefix'] = list()
+    if patient_data['gender'] == 'male':
+        name_detail['prefix'].append('Mr.')
+    elif patient_data['gender'] == 'female':
+        name_detail['prefix'].append('Ms.')
+    name.append(name_detail)
+    resource['name'] = name
+
+    return resource
+
+
+def reference_observation(patient_data, index):
+    resource = dict()
+
+    # map observation data from database
+    resource['resourceType'] = 'Observation'
+    resource['id'] = str(uuid.uuid4())
+    resource['status'] = 'final'
+    resource['subject'] = dict()
+    resource['subject']['reference'] = 'Patient/' + patient_data['Patient ID']
+    resource['effectiveDateTime'] = datetime.now(timezone.utc).isoformat()
+    resource['issued'] = resource['effectiveDateTime']
+
+    if patient_data.index[index] == 'ward allocation':
+        # category
+        category_type = 'survey'
+        category_display = 'Survey'
+
+        # valueCodeableConcept
+        valueCodeableConcept = dict()
+        coding_concept = list()
+        coding_concept_detail = dict()
+        coding_concept_detail['system'] = 'http://loinc.org'
+        coding_concept_detail['code'] = patient_data[index]
+        coding_concept_detail['display'] = patient_data[index]
+        coding_concept.append(coding_concept_detail)
+        valueCodeableConcept['coding'] = coding_concept
+        valueCodeableConcept['text'] = coding_concept_detail['display']
+        resource['valueCodeableConcept'] = valueCodeableConcept
+
+    elif patient_data.index[index] in ['SARS-Cov-2 exam result', 'has_disease']:
+        # category
+        category_type = 'exam'
+        category_display = 'Exam'
+
+        # valueBoolean
+        if patient_data[index] == 1:
+            resource['valueBoolean'] = True
+        elif patient_data[index] == 0:
+            resource['valueBoolean'] = False
+
+    else:
+        # category
+        category_type = 'laboratory'
+        category_display = 'Laboratory'
+
+        # valueQuantity
+        valueQuantity = dict()
+        valueQuantity['value'] = patient_data[index]
+        if patient_data.index[index] == 'Mean platelet volume':
+            valueQuantity['unit'] = 'fL'
+        else:
+            valueQuantity['unit'] = '10*3/uL'
+        valueQuantity['system'] = 'http://unitsofmeasure.org'
+        valueQuantity['code'] = valueQuantity['unit']
+        resource['valueQuantity'] = valueQuantity
+
+    # category
+    category = list()
+    category_detail = dict()
+    category_detail['coding'] = list()
+    coding_cat = dict()
+    coding_cat['system'] = 'http://terminology.hl7.org/CodeSystem/observation-category'
+    coding_cat['code'] = category_type
+    coding_cat['display'] = category_display
+    category_detail['coding'].append(coding_cat)
+    category.append(category_detail)
+    resource['category'] = category
+
+    # code
+    code = dict()
+    code_detail = list()
+    coding_code = dict()
+    coding_code['system'] = 'http://loinc.org'
+    coding_code['code'] = upload_data.LOINC_CODES[index - 5]
+    coding_code['display'] = upload_data.LOINC_TEXTS[index - 5]
+    code_detail.append(coding_code)
+    code['coding'] = code_detail
+    code['text'] = coding_code['display']
+    resource['code'] = code
+
+    return resource
+
+
+def reference_entry(resource):
+    entry = dict()
+    entry['fullUrl'] = resource['resourceType'] + '/' + resource['id']
+    entry['resource'] = resource
+    entry['request'] = dict()
+    entry['request']['method'] = 'PUT'
+    entry['request']['url'] = entry['fullUrl']
+
+    return entry
+
+
+def reference_entries(patient_data):
+    # the patient and all of its observations, kept together in one Bundle
+    entries = list()
+    entries.append(reference_entry(reference_patient(patient_data)))
+    for i in range(5, patient_data.shape[0]):
+        entries.append(reference_entry(reference_observation(patient_data, i)))
+
+    return entries
+
+
+def reference_bundle(entries):
+    bundle = dict()
+    bundle['resourceType'] = 'Bundle'
+    bundle['type'] = 'transaction'
+    bundle['entry'] = entries
+
+    return bundle
+
+
+def reference_health_status(list_patients):
+    # the original seven sorted() passes, used to check the ranking engine
+    sorted_list = sorted(list_patients, key=lambda i: i['patient has disease'], reverse=False)
+    sorted_list = sorted(sorted_list, key=lambda i: i['leukocytes'], reverse=False)
+    sorted_list = sorted(sorted_list, key=lambda i: i['platelets'], reverse=False)
+    sorted_list = sorted(sorted_list, key=lambda i: i['platelets mean volume'], reverse=False)
+    sorted_list = sorted(sorted_list, key=lambda i: i['eosinophils'], reverse=False)
+    sorted_list = sorted(sorted_list, key=lambda i: i['monocytes'], reverse=True)
+    sorted_list = sorted(sorted_list, key=lambda i: i['COVID-19 test result'], reverse=True)
+
+    status = list()
+    for i in range(len(sorted_list)):
+        if i / len(sorted_list) < 0.1:
+            status.append((sorted_list[i]['patient id'], 'Emergent'))
+        elif i / len(sorted_list) < 0.4:
+            status.append((sorted_list[i]['patient id'], 'Semi-urgent'))
+        elif i / len(sorted_list) < 0.8:
+            status.append((sorted_list[i]['patient id'], 'Warning'))
+        else:
+            status.append((sorted_list[i]['patient id'], 'Good'))
+
+    return status
+
+
+def bench_health_status(sizes):
+    results = dict()
+    for size in sizes:
+        records = make_patient_records(size)
+        ward_allocation = get_data_fhir.count_ward_allocation(records)
+        sorted_list = get_data_fhir.calculate_health_status(records, ward_allocation)
+        status = [(patient['patient id'], patient['health status']) for patient in sorted_list]
+        assert status == reference_health_status(records), 'ranking differs at ' + str(size) + ' patients'
+        # the lexsort alone, and the whole census table with health status and ward scheduler
+        table = PatientTable.from_records(records)
+        results[size] = (time_call(reference_health_status, records),
+                         time_call(get_data_fhir.rank_patients, table),
+                         time_call(get_data_fhir.calculate_health_status, records, ward_allocation))
+
+    return results
+
+
+def bench_ward_scheduler(size, events, seed=0):
+    # random admit, discharge and rescore events, the result must equal a scheduler built from scratch
+    rnd = random.Random(seed)
+    capacity = get_data_fhir.settings['ward_capacity']
+    levels = get_data_fhir.HEALTH_STATUS_LEVELS
+    patients = dict()
+    scheduler = ward_scheduler.create_scheduler(capacity)
+    for i in range(size):
+        patients[i] = ((rnd.random(), i), get_data_fhir.HEALTH_STATUS_WARDS[rnd.choice(levels)])
+        ward_scheduler.admit(scheduler, i, *patients[i])
+
+    start = time.perf_counter()
+    for _ in range(events):
+        patient_id = rnd.randrange(size)
+        if patient_id in patients and rnd.random() < 0.2:
+            ward_scheduler.discharge(scheduler, patient_id)
+            del patients[patient_id]
+        else:
+            patients[patient_id] = ((rnd.random(), patient_id), get_data_fhir.HEALTH_STATUS_WARDS[rnd.choice(levels)])
+            ward_scheduler.rescore(scheduler, patient_id, *patients[patient_id])
+    seconds = time.perf_counter() - start
+
+    rebuilt = ward_scheduler.build_scheduler(capacity, sorted(((patient_id, key, wards) for patient_id, (key, wards)
+                                                               in patients.items()), key=lambda i: i[1]))
+    assert all(ward_scheduler.get_ward(scheduler, patient_id) == ward_scheduler.get_ward(rebuilt, patient_id)
+               for patient_id in patients), 'incremental ward allocation differs'
+
+    return events / seconds
+
+
+def seed_server(df_patient_source):
+    for index, row in df_patient_source.iterrows():
+        fhir_server.put_resource(reference_patient(row))
+        for i in range(5, df_patient_source.shape[1]):
+            fhir_server.put_resource(reference_observation(row, i))
+
+
+def time_call(func, *args, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_fetch_modes(patient_ids, latency):
+    fhir_server.settings['latency'] = latency
+    results = dict()
+    expected = None
+    for mode in ['sequential', 'parallel', 'batch']:
+        records = [get_data_fhir.fetch_patient_data(patient_id, mode) for patient_id in patient_ids]
+        # every mode must produce exactly the same patient_data
+        if expected is None:
+            expected = records
+        assert records == expected, mode + ' returned different patient data'
+        start = time.perf_counter()
+        for patient_id in patient_ids:
+            get_data_fhir.fetch_patient_data(patient_id, mode)
+        results[mode] = (time.perf_counter() - start) / len(patient_ids)
+
+    return results
+
+
+def bench_search(df_patient_source, census_sizes):
+    # cold runs start from an empty local cache, warm runs repeat them with every patient cached
+    results = dict()
+    patient_ids = df_patient_source['Patient ID'].tolist()
+    for size in census_sizes:
+        census_ids = patient_ids[:size]
+        get_data_fhir.clear_local_database()
+        cold_patient = time_call(get_data_fhir.search_patient_data, census_ids[0])
+        warm_patient = time_call(get_data_fhir.search_patient_data, census_ids[0], repeat=10)
+        get_data_fhir.clear_local_database()
+        cold_census = time_call(get_data_fhir.search_all_patient_data, census_ids)
+        warm_census = time_call(get_data_fhir.search_all_patient_data, census_ids, repeat=3)
+        records = get_data_fhir.search_all_patient_data(census_ids)
+        ward_allocation = get_data_fhir.count_ward_allocation(records)
+        results[size] = {'search_patient_data cold': cold_patient,
+                         'search_patient_data warm': warm_patient,
+                         'search_all_patient_data cold': cold_census,
+                         'search_all_patient_data warm': warm_census,
+                         'calculate_health_status': time_call(get_data_fhir.calculate_health_status, records,
+                                                              ward_allocation, repeat=3)}
+
+    return results
+
+
+def bench_import(df_patient_source, census_sizes, directory):
+    # cold census from one search per patient and observation, vs a $export of the whole server imported at once
+    results = dict()
+    patient_ids = df_patient_source['Patient ID'].tolist()
+    for size in census_sizes:
+        census_ids = patient_ids[:size]
+        get_data_fhir.clear_local_database()
+        search = time_call(get_data_fhir.search_all_patient_data, census_ids)
+        expected = get_data_fhir.search_all_patient_data(census_ids)
+        get_data_fhir.clear_local_database()
+        export = time_call(get_data_fhir.import_bulk_export, os.path.join(directory, 'export-' + str(size)), census_ids)
+        assert get_data_fhir.search_all_patient_data(census_ids) == expected, 'the import stored different records'
+        results[size] = {'search_all_patient_data cold': search, 'import_bulk_export': export}
+
+    return results
+
+
+def bench_upload(df_patient_source, census_sizes):
+    results = dict()
+    for size in census_sizes:
+        results[size] = time_call(upload_data.bulk_upload, df_patient_source[:size])
+
+    return results
+
+
+def bench_generate(df_patient_source, workers):
+    # seconds per patient: one dict per resource and json.dumps per Bundle, vs the encoded templates
+    sample = df_patient_source[:min(2000, df_patient_source.shape[0])]
+    start = time.perf_counter()
+    for index, row in sample.iterrows():
+        json.dumps(reference_bundle(reference_entries(row)))
+    reference = (time.perf_counter() - start) / sample.shape[0]
+
+    start = time.perf_counter()
+    for chunk_entries in upload_data.generate_resources(df_patient_source, workers):
+        for entries in chunk_entries:
+            upload_data.encode_bundle(entries)
+    templates = (time.perf_counter() - start) / df_patient_source.shape[0]
+
+    return reference, templates
+
+
+def use_temporary_database(directory):
+    # keep the app's project_database.db out of the measurements
+    get_data_fhir.disk_engine = create_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+    get_data_fhir.local_database_ready = False
+
+
+def write_results(path, args, results):
+    report = dict()
+    report['created at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    report['python'] = platform.python_version()
+    report['settings'] = vars(args)
+    report['results'] = results
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the app against the local FHIR stand-in server')
+    parser.add_argument('suite', nargs='?', default='all', choices=['all', 'fetch', 'search', 'ranking', 'upload',
+                                                                     'generate', 'import'])
+    parser.add_argument('--patients', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--census-sizes', default='10,100')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    census_sizes = [int(size) for size in args.census_sizes.split(',')]
+    results = dict()
+    server, fhir_client.settings['api_base'] = fhir_server.start_server()
+    fhir_server.settings['error_rate'] = args.error_rate
+    directory = tempfile.TemporaryDirectory()
+    use_temporary_database(directory.name)
+
+    if args.suite in ['all', 'fetch']:
+        df_patient_source = make_patient_source(args.patients)
+        seed_server(df_patient_source)
+
+        print('search_patient_data cold fetch, %d patients, %.0f ms injected latency'
+              % (args.patients, args.latency * 1000))
+        results['fetch'] = bench_fetch_modes(df_patient_source['Patient ID'].tolist(), args.latency)
+        for mode, seconds in results['fetch'].items():
+            print('  %-10s %8.1f ms/patient  (x%.1f)' % (mode, seconds * 1000, results['fetch']['sequential'] / seconds))
+
+    if args.suite in ['all', 'search']:
+        fhir_server.settings['latency'] = args.latency
+        df_patient_source = make_patient_source(max(census_sizes), seed=1)
+        seed_server(df_patient_source)
+
+        print('cold and warm searches, %.0f ms injected latency' % (args.latency * 1000))
+        results['search'] = bench_search(df_patient_source, census_sizes)
+        for size, timings in results['search'].items():
+            for name, seconds in timings.items():
+                print('  %7d patients  %-30s %9.1f ms' % (size, name, seconds * 1000))
+
+    if args.suite in ['all', 'import']:
+        fhir_server.settings['latency'] = args.latency
+        df_patient_source = make_patient_source(max(census_sizes), seed=4)
+        seed_server(df_patient_source)
+
+        print('cold census from searches and from a bulk data import, %.0f ms injected latency' % (args.latency * 1000))
+        results['import'] = bench_import(df_patient_source, census_sizes, directory.name)
+        for size, timings in results['import'].items():
+            print('  %7d patients %9.1f ms %9.1f ms  (x%.1f)'
+                  % (size, timings['search_all_patient_data cold'] * 1000, timings['import_bulk_export'] * 1000,
+                     timings['search_all_patient_data cold'] / timings['import_bulk_export']))
+
+    if args.suite in ['all', 'upload']:
+        fhir_server.settings['latency'] = args.latency
+        df_patient_source = make_patient_source(max(census_sizes), seed=2)
+
+        print('bulk_upload, %.0f ms injected latency' % (args.latency * 1000))
+        results['upload'] = bench_upload(df_patient_source, census_sizes)
+        for size, seconds in results['upload'].items():
+            print('  %7d patients %9.1f ms' % (size, seconds * 1000))
+
+    if args.suite in ['all', 'generate']:
+        df_patient_source = make_patient_source(max(int(size) for size in args.sizes.split(',')), seed=3)
+        workers = upload_data.settings['generate_workers']
+        print('FHIR resource generation, %d patients, %d processes (orjson %s)'
+              % (df_patient_source.shape[0], workers, 'on' if upload_data.orjson is not None else 'off'))
+        reference, templates = bench_generate(df_patient_source, workers)
+        results['generate'] = {'reference': reference, 'templates': templates}
+        print('  %9.1f us/patient %9.1f us/patient  (x%.1f)'
+              % (reference * 1e6, templates * 1e6, reference / templates))
+
+    if args.suite in ['all', 'ranking']:
+        print('health status ranking: seven sorted() passes, rank_patients (lexsort), calculate_health_status '
+              '(census table, ranking and ward scheduler)')
+        results['ranking'] = bench_health_status([int(size) for size in args.sizes.split(',')])
+        for size, (reference, ranking, census) in results['ranking'].items():
+            print('  %7d patients %9.1f ms %9.1f ms  (x%.1f) %9.1f ms  (x%.1f)'
+                  % (size, reference * 1000, ranking * 1000, reference / ranking, census * 1000, reference / census))
+
+        print('ward scheduler, admit/discharge/rescore events')
+        results['ward scheduler'] = dict()
+        for size in [int(size) for size in args.sizes.split(',')]:
+            results['ward scheduler'][size] = bench_ward_scheduler(size, 20000)
+            print('  %7d patients %9.0f events/s' % (size, results['ward scheduler'][size]))
+
+    server.shutdown()
+    directory.cleanup()
+
+    if args.output:
+        write_results(args.output, args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,124 @@
 from sqlalchemy import create_engine
-import random
+import hashlib
+import pickle
 import names
-import uuid
+import json
+import os
 import pandas as pd
 import numpy as np
+import openpyxl
+import metrics
 
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    # optional, the cache is written as pickle files without it
+    pyarrow = None
 
-def import_data(path='dataset.xlsx'):
-    df = pd.read_excel(path)
+settings = {
+    'cache_dir': '.cache',  # parsed and cleaned source data, see import_data
+    'chunk_size': 10000  # source rows per chunk of the streaming ingest, see stream_to_database
+}
 
-    original_size_message = 'Original data size: ' + str(df.shape[0]) \
-                            + ' entries and ' + str(df.shape[1]) + ' parameters.'
+PATIENT_SOURCE_COLUMNS = ['Patient ID', 'family name', 'given name', 'gender', 'dob', 'ward allocation',
+                          'SARS-Cov-2 exam result', 'has_disease', 'Leukocytes', 'Platelets',
+                          'Mean platelet volume', 'Eosinophils', 'Monocytes']
+# bound parameters per INSERT statement allowed by SQLite
+SQL_MAX_VARIABLES = 999
+# bump when clean_data or the cache files change, so older cached frames are not used
+CACHE_VERSION = 2
+EXTRACT_FEATURES = ['Patient ID',
+                    'Patient addmited to regular ward (1=yes, 0=no)',
+                    'Patient addmited to semi-intensive unit (1=yes, 0=no)',
+                    'Patient addmited to intensive care unit (1=yes, 0=no)',
+                    'SARS-Cov-2 exam result',
+                    'Patient age quantile',
+                    'Leukocytes',
+                    'Platelets',
+                    'has_disease',
+                    'Eosinophils',
+                    'Mean platelet volume ',
+                    'Monocytes']
+SOURCE_READERS = {
+    '.xlsx': pd.read_excel,
+    '.xls': pd.read_excel,
+    '.csv': pd.read_csv,
+    '.json': pd.read_json,
+    '.parquet': pd.read_parquet,
+    '.feather': pd.read_feather
+}
+
+# gender, dob months, dob days, family name, given name and two for the patient id
+RANDOM_BITS_PER_PATIENT = 7
+
+name_pools = dict()
+
+
+def import_data(path='dataset.xlsx', null_threshold=90, use_cache=True):
+    # the cleaned frame is cached per source file version and cleanup parameters
+    cache_params = {'null_threshold': null_threshold}
+    df_extracted, original_shape = load_from_cache(path, 'cleaned', cache_params) if use_cache else (None, None)
+    if df_extracted is None:
+        df = read_source_data(path, use_cache)
+        df_extracted, original_shape = clean_data(df, null_threshold), list(df.shape)
+        if use_cache:
+            save_to_cache(df_extracted, path, 'cleaned', cache_params, original_shape)
+
+    original_size_message = 'Original data size: ' + str(original_shape[0]) \
+                            + ' entries and ' + str(original_shape[1]) + ' parameters.'
     print(original_size_message)
 
+    print('Data size after clean-up: ', df_extracted.shape)
+
+    return df_extracted, original_size_message
+
+
+def read_source_data(path, use_cache=True):
+    # pickle is not a source type, loading it runs code from the file
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in SOURCE_READERS:
+        raise ValueError('Unsupported source file type: ' + path)
+    df = load_from_cache(path, 'raw')[0] if use_cache else None
+    if df is None:
+        df = SOURCE_READERS[extension](path)
+        if use_cache:
+            save_to_cache(df, path, 'raw')
+
+    return df
+
+
+def clean_data(df, null_threshold=90):
+    df = standardize_results(df)
+
+    # Map null percentage by column
+    df_null_pct = df.isna().mean().round(4) * 100
+
+    return extract_features(df, select_columns(df_null_pct, null_threshold))
+
+
+def standardize_results(df):
     # Standardize the test result as 1 and 0
     df['SARS-Cov-2 exam result'] = df['SARS-Cov-2 exam result'].map({'positive': 1, 'negative': 0})
     # Map detected/not_detected and positive/negative to 1 and 0
     df = df.replace({'positive': 1, 'negative': 0, 'detected': 1, 'not_detected': 0})
 
-    # Map null percentage by column
-    df_null_pct = df.isna().mean().round(4) * 100
-    df_null_pct.sort_values(ascending=False)
+    return df
+
+
+def select_columns(df_null_pct, null_threshold=90):
     # Remove null columns > 90% (should remain 39 features)
-    nulls = df_null_pct[df_null_pct > 90]
-    df = df[[col for col in df.columns if col not in nulls]]
+    nulls = df_null_pct[df_null_pct > null_threshold]
+    columns = [col for col in df_null_pct.index if col not in nulls]
 
     # Drop this feature due to 0 variance
-    df.drop('Parainfluenza 2', axis=1, inplace=True)
+    columns.remove('Parainfluenza 2')
+
+    return columns
+
+
+def extract_features(df, columns):
+    df = df[columns].copy()
 
     # Summarize features as presence of antigens
     df['has_disease'] = df[df.columns[20:]].sum(axis=1)
@@ -34,26 +126,95 @@ def import_data(path='dataset.xlsx'):
     df['has_disease'] = df['has_disease'].astype(int)
 
     # Extract the require columns (according to the research)
-    extract_features = ['Patient ID',
-                        'Patient addmited to regular ward (1=yes, 0=no)',
-                        'Patient addmited to semi-intensive unit (1=yes, 0=no)',
-                        'Patient addmited to intensive care unit (1=yes, 0=no)',
-                        'SARS-Cov-2 exam result',
-                        'Patient age quantile',
-                        'Leukocytes',
-                        'Platelets',
-                        'has_disease',
-                        'Eosinophils',
-                        'Mean platelet volume ',
-                        'Monocytes']
-    df_extracted = df[extract_features]
+    df_extracted = df[EXTRACT_FEATURES]
 
     # Remove entries with missing values
     df_extracted = df_extracted.dropna(axis=0)
 
-    print('Data size after clean-up: ', df_extracted.shape)
+    return df_extracted
+
+
+def cache_file(path, stage, params=None):
+    # the file name changes with the source path, size, modification time and the parameters
+    stat = os.stat(path)
+    source_key = os.path.abspath(path)
+    version_key = json.dumps([stat.st_mtime_ns, stat.st_size, params or dict(), CACHE_VERSION], sort_keys=True)
+    name = stage + '-' + hash_key(source_key) + '-' + hash_key(version_key)
+
+    return os.path.join(settings['cache_dir'], name)
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def load_from_cache(path, stage, params=None):
+    # (frame, info) of a cached stage, (None, None) when it is not cached. Pickle runs code while loading, so it is
+    # only read from the files save_to_cache writes to the private cache_dir, never from source files
+    filename = cache_file(path, stage, params)
+    try:
+        if pyarrow is not None and os.path.exists(filename + '.feather'):
+            return table_to_frame(pyarrow.feather.read_table(filename + '.feather'))
+        if os.path.exists(filename + '.pkl'):
+            return pd.read_pickle(filename + '.pkl')
+    except Exception:
+        pass
+
+    return None, None
 
-    return df_extracted, original_size_message
+
+def save_to_cache(df, path, stage, params=None, info=None):
+    # a feather file with pyarrow, pickle without it or for frames arrow cannot convert
+    filename = cache_file(path, stage, params)
+    os.makedirs(settings['cache_dir'], exist_ok=True)
+    # only keep the newest version for a source file and stage
+    prefix = os.path.basename(filename).rsplit('-', 1)[0] + '-'
+    for old_name in os.listdir(settings['cache_dir']):
+        if old_name.startswith(prefix):
+            os.remove(os.path.join(settings['cache_dir'], old_name))
+
+    # write then rename, so readers never see half a file
+    table = None
+    if pyarrow is not None:
+        try:
+            table = frame_to_table(df, info)
+        except (pyarrow.ArrowException, ValueError, TypeError):
+            table = None
+    if table is not None:
+        pyarrow.feather.write_feather(table, filename + '.feather.tmp')
+        os.replace(filename + '.feather.tmp', filename + '.feather')
+    else:
+        pd.to_pickle((df, info), filename + '.pkl.tmp', protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.pkl.tmp', filename + '.pkl')
+
+    return
+
+
+def frame_to_table(df, info):
+    # object columns arrow cannot store, e.g. 'Urine - pH' mixing numbers and text, are kept as one JSON text per
+    # value. The schema metadata names them and holds info
+    json_columns = list()
+    for column in df.columns[(df.dtypes == object).to_numpy()]:
+        try:
+            pyarrow.array(df[column], from_pandas=True)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            json_columns.append(column)
+    if json_columns:
+        df = df.assign(**{column: [json.dumps(value) for value in df[column]] for column in json_columns})
+    table = pyarrow.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or dict())
+    metadata[b'cache info'] = json.dumps({'info': info, 'json columns': json_columns}).encode('utf-8')
+
+    return table.replace_schema_metadata(metadata)
+
+
+def table_to_frame(table):
+    cache_info = json.loads(table.schema.metadata[b'cache info'])
+    df = table.to_pandas()
+    for column in cache_info['json columns']:
+        df[column] = pd.Series([json.loads(value) for value in df[column]], index=df.index, dtype=object)
+
+    return df, cache_info['info']
 
 
 def export_to_database(df_data, path='sqlite:///project_database.db'):
@@ -65,69 +226,224 @@ def export_to_database(df_data, path='sqlite:///project_database.db'):
     return
 
 
-def generate_patient_data(df_patient):
+def generate_patient_data(df_patient, seed=None, scale_factor=1):
+    age_qua_range = [min(df_patient['Patient age quantile']), max(df_patient['Patient age quantile'])]
+
+    # repeat the source rows to get a bigger synthetic cohort
+    df_patient = pd.concat([df_patient] * scale_factor, ignore_index=True)
+    df_patient = generate_patient_fields(df_patient, np.random.default_rng(seed), age_qua_range)
+
+    cleanup_size_message = 'Data size after clean-up: ' + str(df_patient.shape[0]) \
+                           + ' entries and ' + str(df_patient.shape[1]) + ' parameters.'
+    print(cleanup_size_message)
+
+    return df_patient, cleanup_size_message
+
+
+def generate_patient_fields(df_patient, rng, age_qua_range):
+    # rows are generated in order from rng, so consecutive chunks give the same data as one frame
     gender = ['female', 'male']
     age_range = [10, 80]  # fake data
-    age_qua_range = [min(df_patient['Patient age quantile']), max(df_patient['Patient age quantile'])]
+    random_bits = draw_random_bits(rng, df_patient.shape[0])
 
     # gender
-    df_patient['gender'] = np.random.randint(0, 2, df_patient.shape[0])
-    df_patient['gender'] = df_patient['gender'].map({0: gender[0], 1: gender[1]})
+    df_patient['gender'] = np.where(random_bits[:, 0] % 2 == 0, gender[0], gender[1])
 
     # age (for getting dob)
     ages = (((age_range[1] - age_range[0]) / (age_qua_range[1] - age_qua_range[0]) * df_patient[
         'Patient age quantile']) + age_range[0]).astype(int)
 
-    for index, row in df_patient.iterrows():
-        # ward allocation
-        if row['Patient addmited to regular ward (1=yes, 0=no)'] == 1:
-            df_patient.at[index, 'ward allocation'] = 'regular ward'
-        elif row['Patient addmited to semi-intensive unit (1=yes, 0=no)'] == 1:
-            df_patient.at[index, 'ward allocation'] = 'semi-intensive unit'
-        elif row['Patient addmited to intensive care unit (1=yes, 0=no)'] == 1:
-            df_patient.at[index, 'ward allocation'] = 'intensive care unit'
-        else:
-            df_patient.at[index, 'ward allocation'] = 'no allocation'
-
-        # dob
-        dob = pd.Timestamp('now') - pd.DateOffset(years=ages[index],
-                                                  months=random.randint(0, 12),
-                                                  days=random.randint(0, 31))
-        df_patient.at[index, 'dob'] = dob.date().isoformat()
-
-        # last name
-        df_patient.at[index, 'family name'] = names.get_last_name()
-        # first name
-        df_patient.at[index, 'given name'] = names.get_first_name(row['gender'])
-        # patient id
-        df_patient.at[index, 'Patient ID'] = str(uuid.uuid4())
+    # ward allocation
+    df_patient['ward allocation'] = np.select(
+        [df_patient['Patient addmited to regular ward (1=yes, 0=no)'] == 1,
+         df_patient['Patient addmited to semi-intensive unit (1=yes, 0=no)'] == 1,
+         df_patient['Patient addmited to intensive care unit (1=yes, 0=no)'] == 1],
+        ['regular ward', 'semi-intensive unit', 'intensive care unit'], 'no allocation')
+
+    # dob, same calendar arithmetic as subtracting pd.DateOffset(years, months, days) from today
+    df_patient['dob'] = subtract_dates(pd.Timestamp('now'), ages.values,
+                                       (random_bits[:, 1] % 13).astype(int), (random_bits[:, 2] % 32).astype(int))
+
+    # last name
+    df_patient['family name'] = draw_names('last', random_bits[:, 3])
+    # first name
+    df_patient['given name'] = np.where(df_patient['gender'] == gender[1],
+                                        draw_names('first:male', random_bits[:, 4]),
+                                        draw_names('first:female', random_bits[:, 4]))
+    # patient id
+    df_patient['Patient ID'] = format_uuids(random_bits[:, 5:7])
 
     df_patient['Mean platelet volume'] = df_patient['Mean platelet volume ']
     # clean redundant and rearrange df columns
-    df_patient = df_patient[['Patient ID',
-                             'family name',
-                             'given name',
-                             'gender',
-                             'dob',
-                             'ward allocation',
-                             'SARS-Cov-2 exam result',
-                             'has_disease',
-                             'Leukocytes',
-                             'Platelets',
-                             'Mean platelet volume',
-                             'Eosinophils',
-                             'Monocytes']]
+    df_patient = df_patient[PATIENT_SOURCE_COLUMNS]
 
-    cleanup_size_message = 'Data size after clean-up: ' + str(df_patient.shape[0]) \
-                           + ' entries and ' + str(df_patient.shape[1]) + ' parameters.'
+    return df_patient
+
+
+def draw_random_bits(rng, size):
+    # all random draws of a patient come from one row, so the values do not depend on how rows are batched
+    return rng.bit_generator.random_raw((size, RANDOM_BITS_PER_PATIENT))
+
+
+def subtract_dates(today, years, months, days):
+    # years and months are subtracted on the calendar (day clipped to the month end), then the days
+    total_months = today.year * 12 + today.month - 1 - years * 12 - months
+    month_start = pd.to_datetime(pd.DataFrame({'year': total_months // 12, 'month': total_months % 12 + 1, 'day': 1}))
+    day = np.minimum(today.day, month_start.dt.days_in_month)
+    dates = month_start + pd.to_timedelta(day - 1 - days, unit='D')
+
+    return dates.dt.strftime('%Y-%m-%d').values
+
+
+def draw_names(kind, random_bits):
+    # same weighting as the names package, which picks the first name whose cumulative frequency exceeds
+    # a uniform draw in [0, 90)
+    if kind not in name_pools:
+        name_table = pd.read_csv(names.FILES[kind], sep=r'\s+', header=None, usecols=[0, 2], keep_default_na=False)
+        pool = np.append(name_table[0].str.capitalize().values, '')
+        name_pools[kind] = (pool, name_table[2].values)
+    pool, cumulative = name_pools[kind]
+    selected = (random_bits >> np.uint64(11)) * 2.0 ** -53 * 90
+
+    return pool[np.searchsorted(cumulative, selected, side='right')]
+
+
+def format_uuids(random_bits):
+    # version 4 uuid strings from two 64-bit draws per row, same as str(uuid.UUID(bytes=..., version=4))
+    octets = random_bits.astype('>u8').view(np.uint8).reshape(-1, 16).copy()
+    octets[:, 6] = octets[:, 6] & 0x0F | 0x40
+    octets[:, 8] = octets[:, 8] & 0x3F | 0x80
+    digits = np.frombuffer(octets.tobytes().hex().encode('ascii'), dtype=np.uint8).reshape(-1, 32)
+    digits = np.insert(digits, [8, 12, 16, 20], ord('-'), axis=1)
+
+    return np.ascontiguousarray(digits).view('S36').ravel().astype(str)
+
+
+def stream_to_database(source_path='dataset.xlsx', path='sqlite:///project_database.db', chunk_size=None,
+                       null_threshold=90, seed=None, scale_factor=1, progress=None):
+    # same result as import_data, generate_patient_data and export_to_database, holding one chunk at a time
+    chunk_size = chunk_size or settings['chunk_size']
+    disk_engine = create_engine(path)
+
+    # first pass: column null percentages and the age range of the rows that survive the clean-up. No row is
+    # written yet, the pass reports 0 rows of an unknown total
+    scan_progress = None if progress is None else lambda rows_scanned: progress(0, None)
+    source_size, columns, age_qua_range = scan_source(source_path, chunk_size, null_threshold, scan_progress)
+    original_size_message = 'Original data size: ' + str(source_size[0]) \
+                            + ' entries and ' + str(source_size[1]) + ' parameters.'
+    print(original_size_message)
+
+    # second pass: clean, generate and write each chunk into a staging table. The source is read scale_factor
+    # times, the same row order as the repeated frame of generate_patient_data
+    rng = np.random.default_rng(seed)
+    rows_read, rows_written = 0, 0
+    rows_total = source_size[0] * scale_factor
+    disk_engine.execute('DROP TABLE IF EXISTS patient_source_staging')
+    for _ in range(scale_factor):
+        for df_chunk in iter_source_chunks(source_path, chunk_size):
+            df_patient = extract_features(standardize_results(df_chunk), columns)
+            df_patient = generate_patient_fields(df_patient, rng, age_qua_range)
+            with disk_engine.begin() as connection:
+                df_patient.to_sql('patient_source_staging', connection, if_exists='append', index=False,
+                                  method='multi', chunksize=SQL_MAX_VARIABLES // df_patient.shape[1])
+            rows_read += df_chunk.shape[0]
+            rows_written += df_patient.shape[0]
+            metrics.inc('ingest_rows_total', df_patient.shape[0], stage='cleanup')
+            print('Processing rows', rows_read, '/', rows_total, '-', rows_written, 'patients written')
+            if progress is not None:
+                progress(rows_read, rows_total)
+
+    # swap the new table in at once
+    with disk_engine.begin() as connection:
+        connection.execute('DROP TABLE IF EXISTS patient_source')
+        connection.execute('ALTER TABLE patient_source_staging RENAME TO patient_source')
+    print('Source data has been exported to', path)
+
+    cleanup_size_message = 'Data size after clean-up: ' + str(rows_written) \
+                           + ' entries and ' + str(len(PATIENT_SOURCE_COLUMNS)) + ' parameters.'
     print(cleanup_size_message)
 
-    return df_patient, cleanup_size_message
+    return original_size_message, cleanup_size_message
+
+
+def iter_source_chunks(path, chunk_size):
+    # csv and xlsx files are read chunk by chunk, other formats are parsed once (and cached) then sliced
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        for df_chunk in pd.read_csv(path, chunksize=chunk_size):
+            yield df_chunk
+    elif extension == '.xlsx':
+        for df_chunk in iter_excel_chunks(path, chunk_size):
+            yield df_chunk
+    else:
+        df = read_source_data(path)
+        for i in range(0, max(df.shape[0], 1), chunk_size):
+            yield df.iloc[i:i + chunk_size].copy()
+
+
+def iter_excel_chunks(path, chunk_size):
+    # rows of the first sheet in chunk_size batches, the first row holds the column names
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        chunk = list()
+        chunks = 0
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield excel_frame(chunk, header)
+                chunk = list()
+                chunks += 1
+        # an empty sheet still gives its columns
+        if chunk or not chunks:
+            yield excel_frame(chunk, header)
+    finally:
+        workbook.close()
+
+
+def excel_frame(rows, header):
+    # same values as pd.read_excel: empty cells are missing, whole floats are read as integers
+    rows = [[value if not isinstance(value, float) or not value.is_integer() else int(value) for value in row]
+            + [None] * (len(header) - len(row)) for row in rows]
+
+    return pd.DataFrame(rows, columns=header).infer_objects()
+
+
+def scan_source(path, chunk_size, null_threshold=90, progress=None):
+    size = 0
+    null_counts = None
+    age_quantiles = list()
+    for df_chunk in iter_source_chunks(path, chunk_size):
+        df_chunk = standardize_results(df_chunk)
+        size += df_chunk.shape[0]
+        chunk_nulls = df_chunk.isna().sum()
+        null_counts = chunk_nulls if null_counts is None else null_counts + chunk_nulls
+        # rows kept by extract_features, has_disease is never missing
+        features = [feature for feature in EXTRACT_FEATURES if feature != 'has_disease']
+        ages = df_chunk.loc[df_chunk[features].notna().all(axis=1), 'Patient age quantile']
+        if not ages.empty:
+            age_quantiles.extend([ages.min(), ages.max()])
+        if progress is not None:
+            progress(size)
+
+    # Map null percentage by column
+    df_null_pct = (null_counts / size).round(4) * 100
+    age_qua_range = [min(age_quantiles), max(age_quantiles)] if age_quantiles else [0, 1]
+
+    return (size, null_counts.shape[0]), select_columns(df_null_pct, null_threshold), age_qua_range
+
 
+def main(seed=None, scale_factor=1, chunk_size=None, progress=None):
+    # chunk_size switches to the streaming ingest, which keeps memory bounded for big sources
+    if chunk_size is not None:
+        return stream_to_database(chunk_size=chunk_size, seed=seed, scale_factor=scale_factor, progress=progress)
 
-def main():
     data, msg_original_size = import_data()
-    generate_data, msg_cleanup_size = generate_patient_data(data)
+    generate_data, msg_cleanup_size = generate_patient_data(data, seed, scale_factor)
     export_to_database(generate_data)
+    metrics.inc('ingest_rows_total', generate_data.shape[0], stage='cleanup')
+    if progress is not None:
+        progress(generate_data.shape[0], generate_data.shape[0])
 
     return msg_original_size, msg_cleanup_size
@@ -0,0 +1,167 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit, parse_qs, urlencode
+import threading
+import requests
+import metrics
+import json
+import time
+import os
+
+# the single place where the FHIR server is configured, FHIR_API_BASE overrides the default server
+settings = {
+    'api_base': os.environ.get('FHIR_API_BASE', 'https://r4.smarthealthit.org'),
+    'pool_size': 10,  # keep-alive connections kept open to the server
+    'connect_timeout': 3.05,
+    'read_timeout': 30,
+    'max_retries': 3,
+    'backoff_factor': 0.5,  # waits 0.5s, 1s, 2s, ... between retries
+    'export_poll_interval': 1.0,  # seconds between $export status checks when the server sends no Retry-After
+    'export_timeout': 3600  # seconds to wait for a $export to complete
+}
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+# PUT and batch/transaction POSTs of this app are idempotent, so they are safe to retry
+RETRY_METHODS = ['GET', 'PUT', 'POST']
+
+session = None
+session_lock = threading.Lock()
+
+
+def create_retry():
+    options = dict(total=settings['max_retries'],
+                   backoff_factor=settings['backoff_factor'],
+                   status_forcelist=RETRY_STATUS,
+                   raise_on_status=False)
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **options)
+
+
+def create_session():
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'], max_retries=create_retry())
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    new_session.headers.update({'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'})
+
+    return new_session
+
+
+def get_session():
+    global session
+
+    with session_lock:
+        if session is None:
+            session = create_session()
+
+    return session
+
+
+def reset_session():
+    # call after changing settings so the next request builds a new pool
+    global session
+
+    with session_lock:
+        if session is not None:
+            session.close()
+        session = None
+
+    return
+
+
+def request(method, path, data=None):
+    url = resolve_url(path)
+    # bytes are sent as they are, already encoded (see upload_data.encode_bundle)
+    body = data if data is None or isinstance(data, bytes) else json.dumps(data)
+    timeout = (settings['connect_timeout'], settings['read_timeout'])
+
+    resource, code = request_labels(url)
+    start = time.perf_counter()
+    with get_session().request(method, url, data=body, timeout=timeout, stream=True) as res:
+        check_response(method, url, res)
+        # decode the json straight from the socket instead of building res.text first
+        res.raw.decode_content = True
+        data = json.load(res.raw)
+    metrics.observe('fhir_request_duration_seconds', time.perf_counter() - start, method=method, resource=resource,
+                    code=code)
+
+    return data
+
+
+def resolve_url(path):
+    # paging links of search bundles and $export status and file urls are absolute
+    if path.startswith('http://') or path.startswith('https://'):
+        return path
+
+    return settings['api_base'].rstrip('/') + '/' + path.lstrip('/')
+
+
+def check_response(method, url, res):
+    resource, code = request_labels(url)
+    metrics.inc('fhir_requests_total', method=method, resource=resource, code=code, status=str(res.status_code))
+    if res.status_code >= 400:
+        raise requests.HTTPError(str(res.status_code) + ' ' + res.reason + ' for url: ' + url, response=res)
+
+    return
+
+
+def bulk_export(resource_types):
+    # FHIR Bulk Data system level $export: kick off, poll the status url until the files are ready and return
+    # the manifest, {'transactionTime': ..., 'output': [{'type': ..., 'url': ...}], ...}
+    url = resolve_url('$export?' + urlencode({'_type': ','.join(resource_types)}))
+    timeout = (settings['connect_timeout'], settings['read_timeout'])
+    with get_session().get(url, headers={'Prefer': 'respond-async'}, timeout=timeout) as res:
+        check_response('GET', url, res)
+        status_url = res.headers['Content-Location']
+
+    deadline = time.time() + settings['export_timeout']
+    while True:
+        with get_session().get(status_url, timeout=timeout) as res:
+            check_response('GET', status_url, res)
+            if res.status_code != 202:
+                return res.json()
+            retry_after = res.headers.get('Retry-After', '')
+        if time.time() > deadline:
+            raise TimeoutError('$export not complete after ' + str(settings['export_timeout']) + 's: ' + status_url)
+        # Retry-After may also be an HTTP date, then the default interval is used
+        time.sleep(float(retry_after) if retry_after.isdigit() else settings['export_poll_interval'])
+
+
+def download(url, path):
+    # stream a bulk data file to disk, returns its size in bytes
+    url = resolve_url(url)
+    timeout = (settings['connect_timeout'], settings['read_timeout'])
+    size = 0
+    with get_session().get(url, headers={'Accept': 'application/fhir+ndjson'}, timeout=timeout, stream=True) as res:
+        check_response('GET', url, res)
+        with open(path, 'wb') as file:
+            for chunk in res.iter_content(chunk_size=1 << 16):
+                file.write(chunk)
+                size += len(chunk)
+
+    return size
+
+
+def request_labels(url):
+    # resource type and loinc code of a search, batch and transaction Bundles are posted to the base url
+    parts = urlsplit(url)
+    resource = parts.path[len(urlsplit(settings['api_base']).path):].strip('/').split('/')[0] or 'Bundle'
+    codes = parse_qs(parts.query).get('code', [''])[0].split(',')
+    code = codes[0].split('|')[-1] if len(codes) == 1 else 'multiple'
+
+    return resource, code
+
+
+def get(path):
+    return request('GET', path)
+
+
+def put(path, resource):
+    return request('PUT', path, resource)
+
+
+def post(path, resource):
+    return request('POST', path, resource)
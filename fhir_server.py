@@ -0,0 +1,267 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+from datetime import datetime, timezone
+import threading
+import argparse
+import random
+import json
+import time
+import uuid
+
+# minimal in-memory FHIR R4 stand-in, used to benchmark the app without the public server. Besides search,
+# batch and transaction it answers the Bulk Data $export kick-off, status and file requests
+settings = {
+    'latency': 0.0,  # seconds added to every HTTP request
+    'error_rate': 0.0  # share of HTTP requests answered with 503 Service Unavailable
+}
+
+store = {
+    'Patient': dict(),
+    'Observation': dict()
+}
+store_lock = threading.Lock()
+exports = dict()  # $export id -> transaction time, request url and resource type -> NDJSON body, kept until exit
+
+
+def put_resource(resource):
+    resource = dict(resource)
+    resource['meta'] = dict(resource.get('meta', dict()))
+    resource['meta']['lastUpdated'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    with store_lock:
+        store[resource['resourceType']][resource['id']] = resource
+
+    return resource
+
+
+def search_resources(resource_type, params):
+    with store_lock:
+        resources = list(store.get(resource_type, dict()).values())
+
+    if '_id' in params:
+        ids = params['_id'].split(',')
+        resources = [resource for resource in resources if resource['id'] in ids]
+    if 'subject' in params:
+        resources = [resource for resource in resources
+                     if resource.get('subject', dict()).get('reference') == params['subject']]
+    if 'code' in params:
+        codes = params['code'].split(',')
+        resources = [resource for resource in resources if match_code(resource, codes)]
+    if '_lastUpdated' in params:
+        prefix, instant = params['_lastUpdated'][:2], params['_lastUpdated'][2:]
+        compare = {'gt': lambda i: i > instant, 'ge': lambda i: i >= instant,
+                   'lt': lambda i: i < instant, 'le': lambda i: i <= instant}[prefix]
+        resources = [resource for resource in resources if compare(resource['meta']['lastUpdated'])]
+    if params.get('_sort') == '-date':
+        resources = sorted(resources, key=lambda i: i.get('effectiveDateTime', ''), reverse=True)
+    elif params.get('_sort') == '_lastUpdated':
+        resources = sorted(resources, key=lambda i: i['meta']['lastUpdated'])
+
+    return resources
+
+
+def match_code(resource, codes):
+    for coding in resource.get('code', dict()).get('coding', list()):
+        if coding['code'] in codes or coding['system'] + '|' + coding['code'] in codes:
+            return True
+
+    return False
+
+
+def search_bundle(query, base=''):
+    parts = urlsplit(query)
+    resource_type = parts.path.strip('/')
+    params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+    resources = search_resources(resource_type, params)
+
+    bundle = dict()
+    bundle['resourceType'] = 'Bundle'
+    bundle['type'] = 'searchset'
+    bundle['total'] = len(resources)
+    bundle['link'] = [{'relation': 'self', 'url': base + '/' + query.lstrip('/')}]
+
+    # pages of _count resources, the next page is linked like on a real server
+    if '_count' in params:
+        offset = int(params.get('_offset', 0))
+        count = int(params['_count'])
+        if offset + count < len(resources):
+            params['_offset'] = str(offset + count)
+            bundle['link'].append({'relation': 'next',
+                                   'url': base + '/' + resource_type + '?' + urlencode(params)})
+        resources = resources[offset:offset + count]
+    if '_elements' in params:
+        elements = params['_elements'].split(',')
+        resources = [subset_resource(resource, elements) for resource in resources]
+    bundle['entry'] = [{'resource': resource} for resource in resources]
+
+    return bundle
+
+
+def subset_resource(resource, elements):
+    # keep the listed elements, choice elements like value[x] are listed without their type suffix
+    subset = {key: value for key, value in resource.items()
+              if key in ['resourceType', 'id', 'meta'] or strip_choice_type(key) in elements}
+    subset['meta'] = dict(subset.get('meta', dict()))
+    subset['meta']['tag'] = [{'system': 'http://terminology.hl7.org/CodeSystem/v3-ObservationValue',
+                              'code': 'SUBSETTED'}]
+
+    return subset
+
+
+def strip_choice_type(key):
+    for prefix in ['value', 'effective']:
+        if key.startswith(prefix) and key[len(prefix):len(prefix) + 1].isupper():
+            return prefix
+
+    return key
+
+
+def start_export(query, base=''):
+    # bulk data export of the store as it is now, complete at once, so the first status check gets the manifest
+    parts = urlsplit(query)
+    params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+    resource_types = params['_type'].split(',') if '_type' in params else list(store)
+    search_params = {'_lastUpdated': 'gt' + params['_since']} if '_since' in params else dict()
+
+    export = dict()
+    export['transactionTime'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    export['request'] = base + '/' + query.lstrip('/')
+    export['files'] = dict()
+    for resource_type in resource_types:
+        resources = search_resources(resource_type, search_params)
+        export['files'][resource_type] = b''.join(json.dumps(resource).encode('utf-8') + b'\n'
+                                                  for resource in resources)
+    export_id = str(uuid.uuid4())
+    with store_lock:
+        exports[export_id] = export
+
+    return export_id
+
+
+def export_manifest(export_id, base=''):
+    export = exports[export_id]
+    manifest = dict()
+    manifest['transactionTime'] = export['transactionTime']
+    manifest['request'] = export['request']
+    manifest['requiresAccessToken'] = False
+    manifest['output'] = [{'type': resource_type, 'url': base + '/$export-file/' + export_id + '/' + resource_type
+                           + '.ndjson'} for resource_type, body in export['files'].items() if body]
+    manifest['error'] = list()
+
+    return manifest
+
+
+def process_bundle(bundle):
+    # batch and transaction Bundles of GET searches and PUT writes
+    response = dict()
+    response['resourceType'] = 'Bundle'
+    response['type'] = bundle['type'] + '-response'
+    response['entry'] = list()
+    for entry in bundle.get('entry', list()):
+        if entry['request']['method'] == 'PUT':
+            resource = put_resource(entry['resource'])
+            response['entry'].append({'response': {'status': '201 Created',
+                                                   'location': resource['resourceType'] + '/' + resource['id']}})
+        else:
+            response['entry'].append({'resource': search_bundle(entry['request']['url']),
+                                      'response': {'status': '200 OK'}})
+
+    return response
+
+
+class FHIRRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed-ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.inject_failure():
+            return
+        base = 'http://' + self.headers.get('Host', 'localhost')
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        if parts[0] == '$export':
+            self.send_response(202)
+            self.send_header('Content-Location', base + '/$export-status/' + start_export(self.path, base))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif parts[0] in ['$export-status', '$export-file'] and (len(parts) < 2 or parts[1] not in exports):
+            self.send_json(404, operation_outcome('Unknown export', 'not-found'))
+        elif parts[0] == '$export-status':
+            self.send_json(200, export_manifest(parts[1], base))
+        elif parts[0] == '$export-file':
+            body = exports[parts[1]]['files'].get('/'.join(parts[2:])[:-len('.ndjson')], b'')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/fhir+ndjson')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(200, search_bundle(self.path, base))
+
+    def do_POST(self):
+        bundle = self.read_json()
+        if self.inject_failure():
+            return
+        if bundle.get('resourceType') == 'Bundle' and bundle.get('type') in ['batch', 'transaction']:
+            self.send_json(200, process_bundle(bundle))
+        else:
+            self.send_json(400, operation_outcome('Only batch and transaction Bundles are supported'))
+
+    def do_PUT(self):
+        resource = self.read_json()
+        if self.inject_failure():
+            return
+        self.send_json(200, put_resource(resource))
+
+    def inject_failure(self):
+        # the request body is read first so the keep-alive connection stays usable after a failure
+        time.sleep(settings['latency'])
+        if random.random() < settings['error_rate']:
+            self.send_json(503, operation_outcome('Injected failure', 'transient'))
+            return True
+
+        return False
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def operation_outcome(message, code='not-supported'):
+    return {'resourceType': 'OperationOutcome',
+            'issue': [{'severity': 'error', 'code': code, 'diagnostics': message}]}
+
+
+def start_server(host='localhost', port=0):
+    # port 0 picks a free port, the base url is returned for api_base
+    server = ThreadingHTTPServer((host, port), FHIRRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, 'http://%s:%d' % (host, server.server_address[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local FHIR R4 stand-in server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings['latency'] = args.latency
+    settings['error_rate'] = args.error_rate
+    fhir_server = ThreadingHTTPServer((args.host, args.port), FHIRRequestHandler)
+    print('FHIR stand-in running on http://%s:%d' % (args.host, args.port))
+    fhir_server.serve_forever()
@@ -1,11 +1,28 @@
-import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from bisect import bisect_left
+from urllib.parse import quote
+from itertools import islice
 import requests
+import logging
+import heapq
+import threading
+import socket
+import zlib
+import json
+import time
+import os
 from sqlalchemy import create_engine
 import pandas as pd
+import numpy as np
+from patient_record import PatientRecord, PatientTable, TableView, RECORD_FIELDS, DERIVED_FIELDS, is_missing
+import fhir_client
+import ward_scheduler
+import metrics
 
-api_base = 'https://r4.smarthealthit.org'
 path = 'sqlite:///project_database.db'
-disk_engine = create_engine(path)
+disk_engine = None  # created on first use, so worker processes forked after import open their own
+engine_lock = threading.Lock()
 
 loinc_codes = {
     'ward allocation': '91891-2',
@@ -18,7 +35,230 @@ loinc_codes = {
     'monocytes': '742-7'
 }
 
-patients_records_with_calculation = dict()
+loinc_keys = {code: key for key, code in loinc_codes.items()}
+
+# _elements of the searches, everything else of the resources is left on FHIR server
+PATIENT_ELEMENTS = 'name,birthDate'
+OBSERVATION_ELEMENTS = 'code,effective,value'
+
+# fetch_mode: 'sequential' (one GET after another), 'parallel' (GETs over a bounded thread pool)
+# or 'batch' (all searches in one FHIR batch Bundle)
+settings = {
+    'fetch_mode': 'parallel',
+    'fetch_workers': 9,
+    'health_status_max_age': 300,  # seconds before get_health_status rebuilds the ranking
+    'incremental_census': True,  # update the overview from changed patients only, False recomputes every time
+    'cache_ttl': 3600,  # seconds a cached FHIR query result is used, None keeps it until evicted
+    'cache_ttl_jitter': 0.2,  # share of cache_ttl the expiry is moved forward by, spread over the patients
+    'cache_touch_interval': 60,  # seconds access times are buffered before they are written for the LRU eviction
+    'refresh_workers': 2,  # threads querying expired and invalidated patients again in the background
+    'refresh_batch_size': 50,  # patients queried again and saved together by one background task
+    'refresh_retry_after': 300,  # seconds before a patient whose background query failed is queried again
+    'refresh_check_interval': 30,  # seconds between the lookups of expired cache entries by a shared census check
+    'cache_max_entries': 10000,  # least recently used patients are evicted above this size
+    'sync_interval': None,  # seconds between _lastUpdated syncs run by the overview, None only syncs on POST /api/sync
+    'sync_page_size': 500,
+    'history_page_size': 100,
+    'overview_page_size': 50,
+    'overview_max_page_size': 500,
+    'ward_capacity': {'regular ward': 50, 'semi-intensive unit': 20, 'intensive care unit': 10},  # beds per ward
+    # worker processes share one census through the local database, see get_census_overview
+    'shared_census': os.environ.get('SHARED_CENSUS', '0') == '1',
+    'census_writer_lease': 30,  # seconds before others take over the write lease of a worker that stopped renewing it
+    'census_wait_interval': 0.2,  # seconds between checks while another worker builds the first snapshot
+    'census_wait_timeout': 10,  # seconds requests wait for the first snapshot before CensusUnavailable is raised
+    'database_timeout': 30,  # seconds a connection waits for the lock of another writer
+    'history_refresh_interval': 300,  # seconds before the observation history of a patient is checked for new values
+    'trend_buckets': 24,  # points of a downsampled trend
+    'history_workers': 2,  # threads loading observation histories in the background for the patient pages
+    'import_batch_size': 5000  # patients stored per transaction by import_ndjson
+}
+
+# local cache of FHIR query results, one row per patient
+QUERY_LIST_COLUMNS = ['birth date', 'full name', 'ward allocation', 'COVID-19 test result', 'patient has disease',
+                      'leukocytes', 'UoM leukocytes', 'platelets', 'UoM platelets',
+                      'platelets mean volume', 'UoM platelets mean volume', 'eosinophils', 'UoM eosinophils',
+                      'monocytes', 'UoM monocytes', 'patient id']
+QUERY_LIST_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_query_list (
+    "birth date" TEXT,
+    "full name" TEXT,
+    "ward allocation" TEXT,
+    "COVID-19 test result" BOOLEAN,
+    "patient has disease" BOOLEAN,
+    leukocytes FLOAT,
+    "UoM leukocytes" TEXT,
+    platelets FLOAT,
+    "UoM platelets" TEXT,
+    "platelets mean volume" FLOAT,
+    "UoM platelets mean volume" TEXT,
+    eosinophils FLOAT,
+    "UoM eosinophils" TEXT,
+    monocytes FLOAT,
+    "UoM monocytes" TEXT,
+    "patient id" TEXT,
+    "cached at" FLOAT NOT NULL DEFAULT 0,
+    "accessed at" FLOAT NOT NULL DEFAULT 0
+)'''
+QUERY_LIST_INDEX = 'ix_app_query_list_patient_id'
+# cache bookkeeping columns, added to tables created by older versions
+QUERY_LIST_CACHE_COLUMNS = ['cached at', 'accessed at']
+# high-water mark of meta.lastUpdated per sync scope ('census' or 'Patient/<id>')
+SYNC_STATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_sync_state (
+    scope TEXT PRIMARY KEY,
+    "last updated" TEXT
+)'''
+# published census, the rows of one version in ranking order and table row (app_patient_list position)
+SNAPSHOT_TYPES = {'text': 'TEXT', 'category': 'TEXT', 'number': 'FLOAT', 'flag': 'INTEGER'}
+CENSUS_SNAPSHOT_TABLE = 'CREATE TABLE IF NOT EXISTS app_census_snapshot (\n    version INTEGER,\n    rank INTEGER,\n' \
+                        '    position INTEGER,\n' \
+                        + ''.join('    "' + key + '" ' + SNAPSHOT_TYPES[kind] + ',\n' for key, kind in RECORD_FIELDS) \
+                        + '    PRIMARY KEY (version, rank)\n)'
+# single row: latest published version, the patient list version it was built from and the write lease, version 0
+# means nothing is published yet
+CENSUS_STATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_census_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    "modified at" FLOAT,
+    "ward allocation" TEXT,
+    writer TEXT,
+    "writer until" FLOAT NOT NULL DEFAULT 0,
+    "patient list version" INTEGER NOT NULL DEFAULT 0
+)'''
+# single row: counts the replacements of app_patient_list, see save_patient_list
+PATIENT_LIST_STATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_patient_list_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+)'''
+# patients changed by any worker, read by the worker holding the write lease
+CENSUS_CHANGES_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_census_changes (
+    "patient id" TEXT PRIMARY KEY
+)'''
+# observation history of the measured values, one row per patient, loinc code and effective time (epoch seconds)
+OBSERVATION_HISTORY_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_observation_history (
+    "patient id" TEXT NOT NULL,
+    code TEXT NOT NULL,
+    time FLOAT NOT NULL,
+    value FLOAT,
+    PRIMARY KEY ("patient id", code, time)
+) WITHOUT ROWID'''
+# newest effective time loaded from FHIR server per patient and loinc code, older values are never queried again
+OBSERVATION_HISTORY_STATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_observation_history_state (
+    "patient id" TEXT NOT NULL,
+    code TEXT NOT NULL,
+    "loaded through" FLOAT,
+    "checked at" FLOAT NOT NULL,
+    PRIMARY KEY ("patient id", code)
+) WITHOUT ROWID'''
+# health status, rank and wards of the census patients, rewritten with the ranking for indexed lookups
+PATIENT_STATUS_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_patient_status (
+    "patient id" TEXT PRIMARY KEY,
+    rank INTEGER NOT NULL,
+    "health status" TEXT NOT NULL,
+    "suggest ward" TEXT NOT NULL,
+    "ward allocation" TEXT
+)'''
+PATIENT_STATUS_COLUMNS = ['patient id', 'rank', 'health status', 'suggest ward', 'ward allocation']
+PATIENT_STATUS_INDEXES = {
+    'ix_app_patient_status_rank': 'rank',
+    'ix_app_patient_status_health_status': '"health status", "ward allocation", rank',
+    'ix_app_patient_status_ward_allocation': '"ward allocation", rank',
+    'ix_app_patient_status_suggest_ward': '"suggest ward", rank'
+}
+HISTORY_KEYS = ['leukocytes', 'platelets', 'platelets mean volume', 'eosinophils', 'monocytes']
+# patients are ranked by these keys, the first key decides first (True: higher value is more urgent)
+RANKING_KEYS = [('COVID-19 test result', True),
+                ('monocytes', True),
+                ('eosinophils', False),
+                ('platelets mean volume', False),
+                ('platelets', False),
+                ('leukocytes', False),
+                ('patient has disease', False)]
+# share of the ranked patients below which each level ends, the rest is 'Good'
+HEALTH_STATUS_LEVELS = ['Emergent', 'Semi-urgent', 'Warning', 'Good']
+HEALTH_STATUS_CUTS = [0.1, 0.4, 0.8]
+# wards suggested for each level, in order of preference
+HEALTH_STATUS_WARDS = {
+    'Emergent': ['intensive care unit', 'semi-intensive unit', 'regular ward'],
+    'Semi-urgent': ['semi-intensive unit', 'regular ward'],
+    'Warning': ['regular ward'],
+    'Good': []
+}
+WARD_NAMES = ['no allocation', 'regular ward', 'semi-intensive unit', 'intensive care unit']
+RANKING_COLUMNS = [key for key, descending in RANKING_KEYS]
+RANKING_DESCENDING = [descending for key, descending in RANKING_KEYS]
+# orders of the clinician overview, 'health status' is the ranking itself
+CENSUS_SORT_KEYS = ['health status', 'full name'] + RANKING_COLUMNS
+# stay below the SQLite limit of 999 bound parameters per statement
+SQL_BATCH_SIZE = 500
+
+# last computed ranking, the census table with health status and suggested ward per row
+health_status_store = {
+    'table': PatientTable(),
+    'rows': dict(),  # patient id -> table row
+    'built at': None,  # when the ranking last changed
+    'checked at': None  # when the ranking was last compared with the local store
+}
+# incrementally maintained overview, see get_census_overview
+census_state = {
+    'patient ids': None,  # app_patient_list order the census was built from
+    'positions': dict(),  # patient id -> position in app_patient_list, breaks ranking ties
+    'scheduler': None,  # ward allocation of the census, see ward_scheduler
+    'sorted records': TableView(PatientTable(), list()),  # table rows in ranking order
+    'ward allocation': dict(),
+    'synced at': None,  # last automatic _lastUpdated sync
+    'patient list version': 0,  # app_patient_list_state version the patient ids were last compared with
+    'refresh checked at': None,  # last lookup of expired cache entries by is_census_outdated
+    'version': 0,  # increased on every change of the ranking or occupancy, see api.py
+    'modified at': None,
+    'snapshot version': None,  # shared census version attached or published by this process
+    'waiting since': None,  # when this process started waiting for another worker's first snapshot
+    'writer renewal': None  # event stopping the lease renewal thread while this process holds the write lease
+}
+census_lock = threading.RLock()
+# patients with new or changed observations since the census was last updated
+changed_patients = set()
+changed_lock = threading.Lock()
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'expired': 0,
+    'evictions': 0,
+    'invalidations': 0
+}
+cache_stats_lock = threading.Lock()
+fetch_executor = None
+fetch_executor_lock = threading.Lock()
+history_executor = None
+# (patient id, key) of the histories waiting for or being loaded in the background
+history_pending = set()
+history_lock = threading.Lock()
+refresh_executor = None
+# patients waiting for or being queried again in the background, see refresh_cached_patients
+refresh_pending = set()
+# patient id -> time its last background query failed, the patient is left out for refresh_retry_after seconds
+refresh_failed = dict()
+refresh_lock = threading.Lock()
+# patient id -> last access time not written yet, see touch_local_database
+touched_patients = dict()
+touches_written_at = 0
+touch_lock = threading.Lock()
+local_database_ready = False
+logger = logging.getLogger(__name__)
+loaded_at = time.time()  # with the pid, tells this process's census versions from those of a restarted one
+
+
+class CensusUnavailable(Exception):
+    # no shared census version yet, see refresh_shared_census
+    pass
 
 
 def search_patient_data(patient_id):
@@ -26,42 +266,7 @@ def search_patient_data(patient_id):
     patient_data = search_local_database(patient_id)
 
     if not patient_data:
-
-        url = api_base + '/Patient?_id=' + patient_id
-        headers = {'Content-Type': 'application/json'}
-        res = requests.get(url=url, headers=headers).text
-        res = json.loads(res)
-
-        # get the patient's personal data
-        if res['total'] > 0:
-            patient_data['birth date'] = res['entry'][0]['resource']['birthDate']
-            patient_data['full name'] = res['entry'][0]['resource']['name'][0]['given'][0] + ' ' \
-                                        + res['entry'][0]['resource']['name'][0]['family']
-
-        for i, (key, values) in enumerate(loinc_codes.items()):
-            url = api_base + '/Observation?_sort=-date' \
-                  + '&subject=Patient/' + patient_id \
-                  + '&code=http://loinc.org|' + loinc_codes[key]
-            headers = {'Content-Type': 'application/json'}
-            res = requests.get(url=url, headers=headers).text
-            res = json.loads(res)
-
-            # get the patient's vital sign, ward allocation and test result
-            if res['total'] > 0:
-                if key == 'ward allocation':
-                    patient_data[key] = \
-                        res['entry'][0]['resource']['valueCodeableConcept']['coding'][0]['code']
-                elif key == 'COVID-19 test result' or key == 'patient has disease':
-                    patient_data[key] = \
-                        res['entry'][0]['resource']['valueBoolean']
-                else:
-                    patient_data[key] = \
-                        res['entry'][0]['resource']['valueQuantity']['value']
-                    unit_key = 'UoM ' + key
-                    patient_data[unit_key] = \
-                        res['entry'][0]['resource']['valueQuantity']['unit']
-
-        patient_data['patient id'] = patient_id
+        patient_data = fetch_patient_data(patient_id)
 
         # save query data into database for better performance
         save_to_local_database(patient_data)
@@ -69,58 +274,818 @@ def search_patient_data(patient_id):
     return patient_data
 
 
-def search_all_patient_data():
-    patient_id_list = get_database_patients()
+def fetch_patient_data(patient_id, mode=None):
+    # query the patient and the latest observation of every loinc code from FHIR server
+    bundles = fetch_patient_bundles(patient_id, mode)
+    patient_data = PatientRecord()
+
+    # get the patient's personal data
+    parse_patient_bundle(bundles[0], patient_data)
+
+    # get the patient's vital sign, ward allocation and test result
+    for key, res in zip(loinc_codes, bundles[1:]):
+        parse_observation_bundle(key, res, patient_data)
+
+    patient_data['patient id'] = patient_id
+
+    return patient_data
+
+
+def build_patient_queries(patient_id):
+    # only the latest observation is read, so ask for one entry trimmed to the elements that are parsed
+    queries = ['Patient?_id=' + patient_id + '&_elements=' + PATIENT_ELEMENTS]
+    for key in loinc_codes:
+        queries.append('Observation?_sort=-date&_count=1'
+                       + '&_elements=' + OBSERVATION_ELEMENTS
+                       + '&subject=Patient/' + patient_id
+                       + '&code=http://loinc.org|' + loinc_codes[key])
+
+    return queries
+
+
+def iter_observation_history(patient_id, key):
+    # (effective date, patient_data with the observed value) newest first, pages are fetched as they are consumed
+    query = 'Observation?_sort=-date&_count=' + str(settings['history_page_size']) \
+            + '&_elements=' + OBSERVATION_ELEMENTS \
+            + '&subject=Patient/' + patient_id \
+            + '&code=http://loinc.org|' + loinc_codes[key]
+    for resource in iter_search_resources(query):
+        yield resource.get('effectiveDateTime'), parse_observation(key, resource, PatientRecord())
+
+
+def load_observation_history(patient_id, key):
+    # append the values newer than the last load, the search is newest first and stops at the first known value.
+    # Returns the number of values read from FHIR server
+    init_local_database()
+    now = time.time()
+    state = get_engine().execute('SELECT "loaded through", "checked at" FROM app_observation_history_state '
+                                 'WHERE "patient id" = ? AND code = ?', (patient_id, loinc_codes[key])).fetchone()
+    loaded_through = state[0] if state else None
+    if state and now - state[1] < settings['history_refresh_interval']:
+        return 0
+
+    rows = list()
+    try:
+        for effective, patient_data in iter_observation_history(patient_id, key):
+            row = history_row(patient_id, key, effective, patient_data)
+            if row[2] is None:
+                continue
+            if loaded_through is not None and row[2] <= loaded_through:
+                break
+            rows.append(row)
+    except requests.RequestException as error:
+        # the stored history is served, "checked at" is kept so the next load tries again
+        logger.warning('Observation history %s of patient %s not loaded: %s', key, patient_id, error)
+        return 0
+
+    newest = max([row[2] for row in rows] + ([loaded_through] if loaded_through is not None else []), default=None)
+    with get_engine().begin() as connection:
+        insert_observation_history(connection, rows)
+        connection.execute('INSERT OR REPLACE INTO app_observation_history_state '
+                           '("patient id", code, "loaded through", "checked at") VALUES (?, ?, ?, ?)',
+                           (patient_id, loinc_codes[key], newest, now))
+
+    return len(rows)
+
+
+def history_row(patient_id, key, effective, patient_data):
+    return patient_id, loinc_codes[key], effective_time(effective), patient_data.get(key)
+
+
+def effective_time(value):
+    # epoch seconds of a FHIR dateTime, times without a zone are taken as UTC
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+
+    return moment.timestamp()
+
+
+def append_observation_history(rows):
+    rows = [row for row in rows if row[2] is not None]
+    if not rows:
+        return
+
+    init_local_database()
+    with get_engine().begin() as connection:
+        insert_observation_history(connection, rows)
+
+    return
+
+
+def insert_observation_history(connection, rows):
+    # append only, a value already stored for the same time is kept
+    if rows:
+        connection.execute('INSERT OR IGNORE INTO app_observation_history ("patient id", code, time, value) '
+                           'VALUES (?, ?, ?, ?)', rows)
+
+    return
+
+
+def get_observation_history(patient_id, key, start=None, end=None, load=True):
+    # (time, value) of one patient and loinc code between start and end (epoch seconds, both included), oldest first.
+    # load=False answers from the stored history without asking FHIR server
+    if load:
+        load_observation_history(patient_id, key)
+    command = 'SELECT time, value FROM app_observation_history WHERE "patient id" = ? AND code = ? ' \
+              'AND time >= ? AND time <= ? ORDER BY time'
+    params = (patient_id, loinc_codes[key], -np.inf if start is None else start, np.inf if end is None else end)
+    with metrics.timer('sql_query_duration_seconds', query='app_observation_history'):
+        rows = get_engine().execute(command, params).fetchall()
+
+    return [tuple(row) for row in rows]
+
+
+def get_observation_trend(patient_id, key, start=None, end=None, buckets=None, load=True):
+    # the history downsampled to equal time buckets, each with the time of its first value, the lowest,
+    # the highest and the last value, and the number of values. Empty buckets are left out
+    if load:
+        load_observation_history(patient_id, key)
+    buckets = buckets or settings['trend_buckets']
+    code = loinc_codes[key]
+    if start is None or end is None:
+        first, last = get_engine().execute('SELECT MIN(time), MAX(time) FROM app_observation_history '
+                                           'WHERE "patient id" = ? AND code = ?', (patient_id, code)).fetchone()
+        if first is None:
+            return list()
+        start = first if start is None else start
+        end = last if end is None else end
+    width = (end - start) / buckets if end > start else 1.0
+
+    # the last value is the bare column of the single MAX(time) aggregate, which SQLite takes from that row
+    selection = 'SELECT MIN(CAST((time - ?) / ? AS INTEGER), ?) AS bucket, time, value FROM app_observation_history ' \
+                'WHERE "patient id" = ? AND code = ? AND time >= ? AND time <= ?'
+    command = 'SELECT summary.bucket, first, low, high, count, latest.value FROM ' \
+              '(SELECT bucket, MIN(time) AS first, MIN(value) AS low, MAX(value) AS high, COUNT(*) AS count FROM (' \
+              + selection + ') GROUP BY bucket) AS summary JOIN ' \
+              '(SELECT bucket, MAX(time), value FROM (' + selection + ') GROUP BY bucket) AS latest ' \
+              'ON summary.bucket = latest.bucket ORDER BY summary.bucket'
+    params = (start, width, buckets - 1, patient_id, code, start, end)
+    with metrics.timer('sql_query_duration_seconds', query='app_observation_history'):
+        rows = get_engine().execute(command, params * 2).fetchall()
+
+    return [{'time': first, 'min': low, 'max': high, 'last': value, 'count': count}
+            for bucket, first, low, high, count, value in rows]
+
+
+def get_observation_trends(patient_id, start=None, end=None, buckets=None):
+    # trends of every measured value for the patient pages, from the stored history only. The histories are
+    # refreshed in the background, so a page never waits for FHIR server and the next view shows the new values
+    refresh_observation_history(patient_id)
+
+    return {key: get_observation_trend(patient_id, key, start, end, buckets, load=False) for key in HISTORY_KEYS}
+
+
+def refresh_observation_history(patient_id):
+    for key in HISTORY_KEYS:
+        with history_lock:
+            if (patient_id, key) in history_pending:
+                continue
+            history_pending.add((patient_id, key))
+        get_history_executor().submit(refresh_history_task, patient_id, key)
+
+    return
+
+
+def refresh_history_task(patient_id, key):
+    try:
+        load_observation_history(patient_id, key)
+    except Exception:
+        logger.exception('Observation history %s of patient %s not loaded', key, patient_id)
+    finally:
+        with history_lock:
+            history_pending.discard((patient_id, key))
+
+    return
+
+
+def get_history_executor():
+    global history_executor
+
+    with history_lock:
+        if history_executor is None:
+            history_executor = ThreadPoolExecutor(max_workers=settings['history_workers'])
+
+    return history_executor
+
+
+def fetch_patient_bundles(patient_id, mode=None):
+    # one search bundle for the patient followed by one per loinc code, in loinc_codes order
+    mode = mode or settings['fetch_mode']
+    queries = build_patient_queries(patient_id)
+
+    if mode == 'batch':
+        return fetch_batch(queries)
+    elif mode == 'parallel':
+        return list(get_fetch_executor().map(fetch_search, queries))
+
+    return [fetch_search(query) for query in queries]
+
+
+def fetch_search(query):
+    return fhir_client.get(query)
+
+
+def fetch_batch(queries):
+    # send every search in a single FHIR batch Bundle, the server answers in the same order
+    bundle = dict()
+    bundle['resourceType'] = 'Bundle'
+    bundle['type'] = 'batch'
+    bundle['entry'] = [{'request': {'method': 'GET', 'url': query}} for query in queries]
+
+    res = fhir_client.post('', bundle)
+
+    return [entry.get('resource', dict()) for entry in res['entry']]
+
+
+def get_fetch_executor():
+    # bounded pool shared by all requests, so concurrent page loads cannot flood the FHIR server
+    global fetch_executor
+
+    with fetch_executor_lock:
+        if fetch_executor is None:
+            fetch_executor = ThreadPoolExecutor(max_workers=settings['fetch_workers'])
+
+    return fetch_executor
+
+
+def parse_patient_bundle(res, patient_data):
+    # total is optional on paged searches, so look at the entries
+    if res.get('entry'):
+        parse_patient(res['entry'][0]['resource'], patient_data)
+
+    return patient_data
+
+
+def parse_patient(resource, patient_data):
+    patient_data['birth date'] = resource['birthDate']
+    patient_data['full name'] = resource['name'][0]['given'][0] + ' ' + resource['name'][0]['family']
+
+    return patient_data
+
+
+def parse_observation_bundle(key, res, patient_data):
+    if res.get('entry'):
+        parse_observation(key, res['entry'][0]['resource'], patient_data)
+
+    return patient_data
+
+
+def parse_observation(key, resource, patient_data):
+    if key == 'ward allocation':
+        patient_data[key] = resource['valueCodeableConcept']['coding'][0]['code']
+    elif key == 'COVID-19 test result' or key == 'patient has disease':
+        patient_data[key] = resource['valueBoolean']
+    else:
+        patient_data[key] = resource['valueQuantity']['value']
+        unit_key = 'UoM ' + key
+        patient_data[unit_key] = resource['valueQuantity']['unit']
+
+    return patient_data
+
+
+def search_all_patient_data(patient_id_list=None):
+    if patient_id_list is None:
+        patient_id_list = [patient_id[0] for patient_id in get_database_patients()]
+    patient_records, fetched_records = read_all_patient_data(patient_id_list)
+    # the caller gets the fetched records, they are not reported as changed
+    write_local_database(fetched_records)
+
+    return patient_records
+
+
+def read_all_patient_data(patient_id_list):
+    # one bulk read of the local cache, only the misses are queried on FHIR server. Returns every record and the
+    # fetched ones, which are left to the caller to store
+    cached_records = search_local_database_bulk(patient_id_list)
     patient_records = list()
+    fetched_records = list()
 
     for patient_id in patient_id_list:
-        patient_record = search_patient_data(patient_id[0])
+        patient_record = cached_records.get(patient_id)
+        if patient_record is None:
+            patient_record = fetch_patient_data(patient_id)
+            fetched_records.append(patient_record)
         patient_records.append(patient_record)
 
-    return patient_records
+    return patient_records, fetched_records
+
+
+def get_engine():
+    global disk_engine
+
+    with engine_lock:
+        if disk_engine is None:
+            disk_engine = create_engine(path, connect_args={'timeout': settings['database_timeout']})
+
+    return disk_engine
 
 
 def get_database_patients():
-    df_id = pd.read_sql('SELECT * FROM app_patient_list', disk_engine)
+    with metrics.timer('sql_query_duration_seconds', query='app_patient_list'):
+        df_id = pd.read_sql('SELECT * FROM app_patient_list', get_engine())
 
     return df_id.values.tolist()
 
 
-def save_to_local_database(patient_data):
-    df = pd.DataFrame([patient_data])
-    df.to_sql('app_query_list', disk_engine, if_exists='append', index=False)
+def save_patient_list(patient_ids, engine=None):
+    # replace the census patients and count the replacement in the same transaction, so a census check compares
+    # one version number instead of reading the whole list
+    engine = engine or get_engine()
+    df_patient_list = pd.DataFrame(patient_ids, columns=['Patient ID'])
+    with engine.begin() as connection:
+        df_patient_list.to_sql('app_patient_list', connection, if_exists='replace', index=False)
+        connection.execute(PATIENT_LIST_STATE_TABLE)
+        connection.execute('INSERT OR IGNORE INTO app_patient_list_state (id) VALUES (1)')
+        connection.execute('UPDATE app_patient_list_state SET version = version + 1 WHERE id = 1')
+
+    return
+
+
+def get_patient_list_version():
+    init_local_database()
+
+    return get_engine().execute('SELECT version FROM app_patient_list_state WHERE id = 1').fetchone()[0]
+
+
+def init_local_database():
+    # create the cache table with a unique index on patient id, removing duplicates left by older versions
+    global local_database_ready
+
+    if local_database_ready:
+        return
+
+    get_engine().execute(QUERY_LIST_TABLE)
+    get_engine().execute(SYNC_STATE_TABLE)
+    get_engine().execute(CENSUS_SNAPSHOT_TABLE)
+    get_engine().execute(CENSUS_STATE_TABLE)
+    get_engine().execute(PATIENT_LIST_STATE_TABLE)
+    get_engine().execute(CENSUS_CHANGES_TABLE)
+    get_engine().execute(OBSERVATION_HISTORY_TABLE)
+    get_engine().execute(OBSERVATION_HISTORY_STATE_TABLE)
+    get_engine().execute(PATIENT_STATUS_TABLE)
+    for index, columns in PATIENT_STATUS_INDEXES.items():
+        get_engine().execute('CREATE INDEX IF NOT EXISTS ' + index + ' ON app_patient_status (' + columns + ')')
+    get_engine().execute('INSERT OR IGNORE INTO app_census_state (id) VALUES (1)')
+    get_engine().execute('INSERT OR IGNORE INTO app_patient_list_state (id) VALUES (1)')
+    has_index = get_engine().execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                                    (QUERY_LIST_INDEX,)).fetchone()
+    if not has_index:
+        with get_engine().begin() as connection:
+            connection.execute('DELETE FROM app_query_list WHERE rowid NOT IN '
+                               '(SELECT MAX(rowid) FROM app_query_list GROUP BY "patient id")')
+            # IF NOT EXISTS: another worker process may have created it since the check
+            connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS ' + QUERY_LIST_INDEX
+                               + ' ON app_query_list ("patient id")')
+
+    # entries cached before timestamps existed count as expired
+    columns = [row[1] for row in get_engine().execute('PRAGMA table_info(app_query_list)')]
+    for column in QUERY_LIST_CACHE_COLUMNS:
+        if column not in columns:
+            get_engine().execute('ALTER TABLE app_query_list ADD COLUMN "' + column + '" FLOAT NOT NULL DEFAULT 0')
+    columns = [row[1] for row in get_engine().execute('PRAGMA table_info(app_census_state)')]
+    if 'patient list version' not in columns:
+        get_engine().execute('ALTER TABLE app_census_state '
+                             'ADD COLUMN "patient list version" INTEGER NOT NULL DEFAULT 0')
+    get_engine().execute('CREATE INDEX IF NOT EXISTS ix_app_query_list_cached_at ON app_query_list ("cached at")')
+    get_engine().execute('CREATE INDEX IF NOT EXISTS ix_app_query_list_accessed_at ON app_query_list ("accessed at")')
+    local_database_ready = True
+
+    return
+
+
+def save_to_local_database(*patient_records):
+    # census patients are ranked again and stored with their new status in one transaction, see update_census.
+    # Without a census in this process the changes are left to the next census update
+    with census_lock:
+        if settings['incremental_census'] and not settings['shared_census'] and census_state['patient ids'] is not None:
+            update_census([patient_data['patient id'] for patient_data in patient_records],
+                          {patient_data['patient id']: patient_data for patient_data in patient_records})
+            return
+
+    write_local_database(patient_records)
+    mark_patients_changed(patient_data['patient id'] for patient_data in patient_records)
+
+    return
+
+
+def write_local_database(patient_records, connection=None):
+    # upsert, a patient queried again replaces its previous row
+    if not patient_records:
+        return
+
+    init_local_database()
+    if connection is None:
+        with get_engine().begin() as connection:
+            write_local_database(patient_records, connection)
+        return
+
+    now = time.time()
+    columns = QUERY_LIST_COLUMNS + QUERY_LIST_CACHE_COLUMNS
+    command = 'INSERT OR REPLACE INTO app_query_list (' + ', '.join('"' + column + '"' for column in columns) \
+              + ') VALUES (' + ', '.join('?' * len(columns)) + ')'
+    rows = [tuple(patient_data.get(column) for column in QUERY_LIST_COLUMNS) + (now, now)
+            for patient_data in patient_records]
+    connection.execute(command, rows)
+    evict_local_database(connection)
+
+    return
+
+
+def evict_local_database(connection):
+    # drop the least recently used entries above the size bound
+    size = connection.execute('SELECT COUNT(*) FROM app_query_list').fetchone()[0]
+    if size > settings['cache_max_entries']:
+        write_touched_patients(connection)
+        connection.execute('DELETE FROM app_query_list WHERE "patient id" IN (SELECT "patient id" FROM app_query_list '
+                           'ORDER BY "accessed at" LIMIT ?)', (size - settings['cache_max_entries'],))
+        count_cache(evictions=size - settings['cache_max_entries'])
 
     return
 
 
 def search_local_database(patient_id):
     try:
-        command = 'SELECT * FROM app_query_list WHERE "patient id" = "' + patient_id + '"'
-        df_data = pd.read_sql(command, disk_engine)
-        if df_data.empty:
-            return dict()
-        else:
-            patient_data = df_data.to_dict('r')
-            patient_data = patient_data[0]
+        patient_data = search_local_database_bulk([patient_id]).get(patient_id, PatientRecord())
     except Exception:
-        return dict()
+        return PatientRecord()
 
     return patient_data
 
 
+def search_local_database_bulk(patient_id_list):
+    # cached records of many patients keyed by patient id, missing and expired patients are left out
+    patient_records = dict()
+    expired = 0
+    now = time.time()
+
+    for patient_id, (patient_data, cached_at) in read_local_database(patient_id_list).items():
+        if settings['cache_ttl'] is not None and cached_at < now - cache_expiry(patient_id):
+            expired += 1
+        else:
+            patient_records[patient_id] = patient_data
+
+    touch_local_database(list(patient_records))
+    count_cache(hits=len(patient_records), misses=len(patient_id_list) - len(patient_records), expired=expired)
+
+    return patient_records
+
+
+def read_local_database(patient_id_list):
+    # patient id -> (cached record, time it was cached), without ttl or statistics
+    init_local_database()
+    patient_records = dict()
+    columns = ', '.join('"' + column + '"' for column in QUERY_LIST_COLUMNS + ['cached at'])
+
+    for i in range(0, len(patient_id_list), SQL_BATCH_SIZE):
+        batch = patient_id_list[i:i + SQL_BATCH_SIZE]
+        command = 'SELECT ' + columns + ' FROM app_query_list WHERE "patient id" IN (' \
+                  + ', '.join('?' * len(batch)) + ')'
+        with metrics.timer('sql_query_duration_seconds', query='app_query_list'):
+            df_data = pd.read_sql(command, get_engine(), params=tuple(batch))
+        for patient_data in df_data.to_dict('records'):
+            cached_at = patient_data.pop('cached at')
+            patient_records[patient_data['patient id']] = (PatientRecord(patient_data), cached_at)
+
+    return patient_records
+
+
+def touch_local_database(patient_id_list):
+    # remember the access time for the LRU eviction. Reads only buffer it, the buffer is written every
+    # cache_touch_interval seconds and before an eviction
+    now = time.time()
+    with touch_lock:
+        touched_patients.update(dict.fromkeys(patient_id_list, now))
+        if now - touches_written_at < settings['cache_touch_interval']:
+            return
+
+    with get_engine().begin() as connection:
+        write_touched_patients(connection)
+
+    return
+
+
+def write_touched_patients(connection):
+    global touched_patients, touches_written_at
+
+    with touch_lock:
+        touches, touched_patients = touched_patients, dict()
+        touches_written_at = time.time()
+    if touches:
+        connection.execute('UPDATE app_query_list SET "accessed at" = ? WHERE "patient id" = ?',
+                           [(accessed_at, patient_id) for patient_id, accessed_at in touches.items()])
+
+    return
+
+
+def cache_expiry(patient_id):
+    # seconds a cached entry is used, spread over [1 - cache_ttl_jitter, 1] * cache_ttl by patient id so the
+    # entries cached by one census build do not all expire at once
+    spread = zlib.crc32(str(patient_id).encode('utf-8')) / 2 ** 32
+
+    return settings['cache_ttl'] * (1 - settings['cache_ttl_jitter'] * spread)
+
+
+def expired_local_database():
+    # patients whose cached query result is older than its expiry
+    if settings['cache_ttl'] is None:
+        return list()
+
+    init_local_database()
+    now = time.time()
+    rows = get_engine().execute('SELECT "patient id", "cached at" FROM app_query_list WHERE "cached at" < ?',
+                               (now - settings['cache_ttl'] * (1 - settings['cache_ttl_jitter']),))
+
+    return [patient_id for patient_id, cached_at in rows if cached_at < now - cache_expiry(patient_id)]
+
+
+def refresh_cached_patients(patient_ids):
+    # query patients again in the background and save them like a search, outside of census_lock. The census
+    # keeps their previous record until then. Patients already being queried or failed recently are left out, so
+    # page loads during a FHIR server outage do not submit the same queries again and again
+    with refresh_lock:
+        skipped = skipped_refreshes()
+        patient_ids = [patient_id for patient_id in patient_ids if patient_id not in skipped]
+        refresh_pending.update(patient_ids)
+    for i in range(0, len(patient_ids), settings['refresh_batch_size']):
+        get_refresh_executor().submit(refresh_patients_task, patient_ids[i:i + settings['refresh_batch_size']])
+
+    return
+
+
+def refresh_patients_task(patient_ids):
+    failed_at = None
+    try:
+        save_to_local_database(*[fetch_patient_data(patient_id) for patient_id in patient_ids])
+    except Exception:
+        failed_at = time.time()
+        logger.exception('Cached records of %d patients not refreshed', len(patient_ids))
+    finally:
+        with refresh_lock:
+            refresh_pending.difference_update(patient_ids)
+            for patient_id in patient_ids:
+                if failed_at is None:
+                    refresh_failed.pop(patient_id, None)
+                else:
+                    refresh_failed[patient_id] = failed_at
+
+    return
+
+
+def skipped_refreshes():
+    # patients being queried again by this process or whose last query failed less than refresh_retry_after
+    # seconds ago, called under refresh_lock
+    retry_at = time.time() - settings['refresh_retry_after']
+    for patient_id in [patient_id for patient_id, failed_at in refresh_failed.items() if failed_at < retry_at]:
+        del refresh_failed[patient_id]
+
+    return refresh_pending | set(refresh_failed)
+
+
+def is_refresh_due():
+    # expired patients not already queried again or failed recently in this process
+    with refresh_lock:
+        skipped = skipped_refreshes()
+
+    return any(patient_id not in skipped for patient_id in expired_local_database())
+
+
+def get_refresh_executor():
+    global refresh_executor
+
+    with refresh_lock:
+        if refresh_executor is None:
+            refresh_executor = ThreadPoolExecutor(max_workers=settings['refresh_workers'])
+
+    return refresh_executor
+
+
+def invalidate_patient(patient_id):
+    # drop one patient from the cache, the next lookup queries the FHIR server again. A failed query of the
+    # patient is not waited out
+    with refresh_lock:
+        refresh_failed.pop(patient_id, None)
+    init_local_database()
+    get_engine().execute('DELETE FROM app_query_list WHERE "patient id" = ?', (patient_id,))
+    mark_patients_changed([patient_id])
+    count_cache(invalidations=1)
+
+    return
+
+
 def clear_local_database():
-    disk_engine.execute('DELETE FROM app_query_list')
+    init_local_database()
+    get_engine().execute('DELETE FROM app_query_list')
+    mark_patients_changed(census_state['positions'])
+
+    return
+
+
+def count_cache(**counts):
+    with cache_stats_lock:
+        for name, count in counts.items():
+            cache_stats[name] += count
+    for name, count in counts.items():
+        if count:
+            metrics.inc('cache_events_total', count, event=name)
 
     return
 
 
+def get_cache_stats():
+    with cache_stats_lock:
+        stats = dict(cache_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit rate'] = stats['hits'] / lookups if lookups else 0.0
+
+    return stats
+
+
+def sync_observations(patient_id=None, progress=None):
+    # merge the tracked observations updated on FHIR server since the last sync into the local cache,
+    # returns the number of cached patients that changed. progress(read, None) is called per observation read
+    init_local_database()
+    scope = 'census' if patient_id is None else 'Patient/' + patient_id
+    last_updated = get_sync_mark(scope)
+
+    query = 'Observation?code=' + ','.join('http://loinc.org|' + code for code in loinc_codes.values()) \
+            + '&_sort=_lastUpdated&_count=' + str(settings['sync_page_size']) \
+            + '&_elements=subject,' + OBSERVATION_ELEMENTS
+    if patient_id is not None:
+        query += '&subject=Patient/' + patient_id
+    if last_updated is not None:
+        query += '&_lastUpdated=gt' + quote(last_updated)
+
+    # latest observation per patient and loinc code among the updates
+    deltas = dict()
+    history = list()
+    newest = last_updated
+    read = 0
+    for resource in iter_search_resources(query):
+        read += 1
+        if progress is not None:
+            progress(read, None)
+        key = observation_key(resource)
+        if key is None:
+            continue
+        subject_id = resource['subject']['reference'].split('/')[-1]
+        if key in HISTORY_KEYS:
+            history.append(history_row(subject_id, key, resource.get('effectiveDateTime'),
+                                       parse_observation(key, resource, PatientRecord())))
+        observations = deltas.setdefault(subject_id, dict())
+        if key not in observations \
+                or resource.get('effectiveDateTime', '') >= observations[key].get('effectiveDateTime', ''):
+            observations[key] = resource
+        if newest is None or resource['meta']['lastUpdated'] > newest:
+            newest = resource['meta']['lastUpdated']
+
+    changed = merge_observation_deltas(deltas)
+    append_observation_history(history)
+    if newest != last_updated:
+        set_sync_mark(scope, newest)
+    if progress is not None:
+        progress(read, read)
+
+    return changed
+
+
+def iter_search_resources(query):
+    # resources of a search, following the server's next links one page at a time
+    while query:
+        res = fhir_client.get(query)
+        for entry in res.get('entry', list()):
+            yield entry['resource']
+        query = next((link['url'] for link in res.get('link', list()) if link['relation'] == 'next'), None)
+
+
+def observation_key(resource):
+    for coding in resource.get('code', dict()).get('coding', list()):
+        if coding.get('system') == 'http://loinc.org' and coding.get('code') in loinc_keys:
+            return loinc_keys[coding['code']]
+
+    return None
+
+
+def merge_observation_deltas(deltas):
+    # only cached patients are updated, the others get the full query when they are first needed
+    cached_records = read_local_database(list(deltas))
+    patient_records = list()
+    for patient_id, (patient_data, cached_at) in cached_records.items():
+        for key, resource in deltas[patient_id].items():
+            parse_observation(key, resource, patient_data)
+        patient_records.append(patient_data)
+
+    save_to_local_database(*patient_records)
+
+    return len(patient_records)
+
+
+def get_sync_mark(scope):
+    row = get_engine().execute('SELECT "last updated" FROM app_sync_state WHERE scope = ?', (scope,)).fetchone()
+
+    return row[0] if row else None
+
+
+def set_sync_mark(scope, last_updated):
+    get_engine().execute('INSERT OR REPLACE INTO app_sync_state (scope, "last updated") VALUES (?, ?)',
+                        (scope, last_updated))
+
+    return
+
+
+def import_bulk_export(directory, patient_id_list=None):
+    # warm start from a $export of the FHIR server, the NDJSON files are downloaded to directory and imported
+    manifest = fhir_client.bulk_export(['Patient', 'Observation'])
+    os.makedirs(directory, exist_ok=True)
+    paths = list()
+    for number, output in enumerate(manifest['output']):
+        paths.append(os.path.join(directory, output['type'] + '-' + str(number) + '.ndjson'))
+        fhir_client.download(output['url'], paths[-1])
+
+    return import_ndjson(paths, patient_id_list, manifest['transactionTime'])
+
+
+def import_ndjson(paths, patient_id_list=None, transaction_time=None):
+    # seed the local cache from FHIR bulk data NDJSON files of Patient and Observation resources (a directory or
+    # a list of files, in any order), without a search per patient. The files are read line by line and only the
+    # records are kept, with the latest observation per loinc code like search_patient_data. Patients without a
+    # Patient resource are left to the FHIR server. Returns the number of patients stored
+    if isinstance(paths, str):
+        paths = sorted(os.path.join(paths, name) for name in os.listdir(paths) if name.endswith('.ndjson'))
+    init_local_database()
+    wanted = set(patient_id_list) if patient_id_list is not None else None
+    patient_records = dict()
+    has_patient = dict()  # patient ids with a Patient resource, in file order
+    effective = dict()  # (patient id, key) -> effective date of the stored observation
+    history = list()
+    loaded_through = dict()  # (patient id, loinc code) -> newest history time
+
+    for resource in iter_ndjson_resources(paths):
+        if resource.get('resourceType') == 'Patient':
+            if wanted is None or resource['id'] in wanted:
+                parse_patient(resource, patient_records.setdefault(resource['id'], PatientRecord()))
+                has_patient[resource['id']] = True
+            continue
+        key = observation_key(resource) if resource.get('resourceType') == 'Observation' else None
+        if key is None:
+            continue
+        patient_id = resource['subject']['reference'].split('/')[-1]
+        if wanted is not None and patient_id not in wanted:
+            continue
+        # the first of equal dates is kept, like the stable _sort=-date search
+        effective_date = resource.get('effectiveDateTime', '')
+        if (patient_id, key) not in effective or effective_date > effective[patient_id, key]:
+            effective[patient_id, key] = effective_date
+            parse_observation(key, resource, patient_records.setdefault(patient_id, PatientRecord()))
+        if key in HISTORY_KEYS:
+            row = history_row(patient_id, key, effective_date, parse_observation(key, resource, PatientRecord()))
+            if row[2] is not None:
+                history.append(row)
+                loaded_through[row[:2]] = max(row[2], loaded_through.get(row[:2], row[2]))
+            if len(history) >= settings['import_batch_size'] * len(HISTORY_KEYS):
+                append_observation_history(history)
+                history = list()
+    append_observation_history(history)
+
+    # the first history load of an imported patient reads only what is newer than the files
+    if loaded_through:
+        get_engine().execute('INSERT OR IGNORE INTO app_observation_history_state '
+                             '("patient id", code, "loaded through", "checked at") VALUES (?, ?, ?, 0)',
+                             [key + (newest,) for key, newest in loaded_through.items()])
+
+    imported_records = list()
+    for patient_id in has_patient:
+        patient_records[patient_id]['patient id'] = patient_id
+        imported_records.append(patient_records[patient_id])
+    for i in range(0, len(imported_records), settings['import_batch_size']):
+        save_to_local_database(*imported_records[i:i + settings['import_batch_size']])
+
+    # every patient of a full export is stored as of its transaction time, the _lastUpdated sync goes on from there
+    last_updated = get_sync_mark('census')
+    if transaction_time is not None and wanted is None and (last_updated is None or last_updated < transaction_time):
+        set_sync_mark('census', transaction_time)
+
+    return len(imported_records)
+
+
+def iter_ndjson_resources(paths):
+    for path in paths:
+        with open(path, 'rb') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
 def count_ward_allocation(list_patients):
     ward_allocation = dict()
-    # mock up the hospital ward capacity
-    ward_allocation['regular ward total'] = 50
-    ward_allocation['semi-intensive unit total'] = 20
-    ward_allocation['intensive care unit total'] = 10
-    ward_allocation['total'] = 80
+    # hospital ward capacity
+    ward_allocation['regular ward total'] = settings['ward_capacity']['regular ward']
+    ward_allocation['semi-intensive unit total'] = settings['ward_capacity']['semi-intensive unit']
+    ward_allocation['intensive care unit total'] = settings['ward_capacity']['intensive care unit']
+    ward_allocation['total'] = sum(settings['ward_capacity'].values())
     ward_allocation['current'] = 0
     ward_allocation['no allocation'] = 0
     ward_allocation['regular ward'] = 0
@@ -128,72 +1093,605 @@ def count_ward_allocation(list_patients):
     ward_allocation['intensive care unit'] = 0
 
     for patient in list_patients:
-        if patient['ward allocation'] == 'no allocation':
+        if patient.get('ward allocation') == 'no allocation':
             ward_allocation['no allocation'] += 1
             ward_allocation['current'] += 1
-        elif patient['ward allocation'] == 'regular ward':
+        elif patient.get('ward allocation') == 'regular ward':
             ward_allocation['regular ward'] += 1
             ward_allocation['current'] += 1
-        elif patient['ward allocation'] == 'semi-intensive unit':
+        elif patient.get('ward allocation') == 'semi-intensive unit':
             ward_allocation['semi-intensive unit'] += 1
             ward_allocation['current'] += 1
-        elif patient['ward allocation'] == 'intensive care unit':
+        elif patient.get('ward allocation') == 'intensive care unit':
             ward_allocation['intensive care unit'] += 1
             ward_allocation['current'] += 1
 
     return ward_allocation
 
 
+def scheduler_capacity(ward_allocation):
+    return {ward: ward_allocation[ward + ' total'] for ward in WARD_NAMES if ward + ' total' in ward_allocation}
+
+
+def move_ward_allocation(ward_allocation, old_ward, new_ward):
+    # adjust the counters of count_ward_allocation for one patient changing ward
+    for ward, step in [(old_ward, -1), (new_ward, 1)]:
+        if ward in WARD_NAMES:
+            ward_allocation[ward] += step
+            ward_allocation['current'] += step
+
+    return ward_allocation
+
+
 def calculate_health_status(list_patients, ward_allocation):
-    global patients_records_with_calculation
-
-    patients_records_with_calculation = dict()
-
-    sorted_list = sorted(list_patients, key=lambda i: i['patient has disease'], reverse=False)
-    sorted_list = sorted(sorted_list, key=lambda i: i['leukocytes'], reverse=False)
-    sorted_list = sorted(sorted_list, key=lambda i: i['platelets'], reverse=False)
-    sorted_list = sorted(sorted_list, key=lambda i: i['platelets mean volume'], reverse=False)
-    sorted_list = sorted(sorted_list, key=lambda i: i['eosinophils'], reverse=False)
-    sorted_list = sorted(sorted_list, key=lambda i: i['monocytes'], reverse=True)
-    sorted_list = sorted(sorted_list, key=lambda i: i['COVID-19 test result'], reverse=True)
-
-    for i in range(len(sorted_list)):
-        if i / len(sorted_list) < 0.1:
-            sorted_list[i]['health status'] = 'Emergent'
-            if ward_allocation['intensive care unit'] < ward_allocation['intensive care unit total']:
-                sorted_list[i]['suggest ward'] = 'intensive care unit'
-            elif ward_allocation['semi-intensive unit'] < ward_allocation['semi-intensive unit total']:
-                sorted_list[i]['suggest ward'] = 'semi-intensive unit'
-            elif ward_allocation['regular ward'] < ward_allocation['regular ward total']:
-                sorted_list[i]['suggest ward'] = 'regular ward'
-            else:
-                sorted_list[i]['suggest ward'] = 'no allocation'
-        elif i / len(sorted_list) < 0.4:
-            sorted_list[i]['health status'] = 'Semi-urgent'
-            if ward_allocation['semi-intensive unit'] < ward_allocation['semi-intensive unit total']:
-                sorted_list[i]['suggest ward'] = 'semi-intensive unit'
-            elif ward_allocation['regular ward'] < ward_allocation['regular ward total']:
-                sorted_list[i]['suggest ward'] = 'regular ward'
-            else:
-                sorted_list[i]['suggest ward'] = 'no allocation'
-        elif i / len(sorted_list) < 0.8:
-            sorted_list[i]['health status'] = 'Warning'
-            if ward_allocation['regular ward'] < ward_allocation['regular ward total']:
-                sorted_list[i]['suggest ward'] = 'regular ward'
-            else:
-                sorted_list[i]['suggest ward'] = 'no allocation'
-        else:
-            sorted_list[i]['health status'] = 'Good'
-            sorted_list[i]['suggest ward'] = 'no allocation'
+    # ranks the patients into a new census table, returns its rows in ranking order
+    with metrics.timer('health_status_duration_seconds'):
+        table = PatientTable.from_records(list_patients, skip=DERIVED_FIELDS)
+        order, boundaries = rank_patients(table)
+
+        health_status_column = table.columns['health status']
+        for health_status, start, end in zip(HEALTH_STATUS_LEVELS, [0] + boundaries, boundaries + [len(order)]):
+            for i in order[start:end]:
+                health_status_column[i] = health_status
+        scheduler = build_ward_scheduler(table, order, scheduler_capacity(ward_allocation))
+        suggest_ward_column = table.columns['suggest ward'] = ['no allocation'] * len(table)
+        for ward, start, end in ward_scheduler.iter_ranked_wards(scheduler):
+            for i in order[start:end]:
+                suggest_ward_column[i] = ward
+
+        health_status_store['scheduler'] = scheduler
+        health_status_store['table'] = table
+        health_status_store['rows'] = dict(zip(table.columns['patient id'], range(len(table))))
+        health_status_store['built at'] = time.time()
+
+        return TableView(table, order)
+
+
+def rank_patients(table):
+    # one stable lexsort over the feature columns gives the same order as sorting by each key in turn,
+    # returns the sorted rows and where each health status level ends
+    features = ranking_features(table)
+    order = np.lexsort(features[:, ::-1].T).tolist()
+
+    return order, health_status_boundaries(len(table))
 
-    patients_records_with_calculation = sorted_list
 
-    return sorted_list
+def ranking_features(table):
+    features = np.column_stack([table.column(key) for key in RANKING_COLUMNS]).reshape(len(table), len(RANKING_KEYS))
+    features[:, RANKING_DESCENDING] *= -1
+
+    return features
+
+
+def build_ward_scheduler(table, order, capacity):
+    # beds are handed out in ranking order, each health status level is a group of the ranked scheduler. The
+    # scheduler reads the ranking entries of the order at build time, the census order changes afterwards
+    order = list(order)
+    patient_ids = table.columns['patient id']
+    boundaries = health_status_boundaries(len(order))
+    groups = [(end, HEALTH_STATUS_WARDS[health_status])
+              for health_status, end in zip(HEALTH_STATUS_LEVELS, boundaries + [len(order)])]
+
+    return ward_scheduler.build_ranked_scheduler(capacity, [patient_ids[i] for i in order],
+                                                 RankingEntries(table, order), groups)
+
+
+def health_status_boundaries(size):
+    # a patient at position i belongs to the first level with i / size < cut
+    boundaries = np.searchsorted(np.arange(size) / max(size, 1), HEALTH_STATUS_CUTS, side='left')
+
+    return boundaries.tolist()
+
 
 def get_health_status(patient_id):
+    # served from the last ranking, rebuilt when it is stale or does not know a listed patient. The record is
+    # copied under the census lock, a concurrent update_census rewrites the table row field by field
+    with census_lock:
+        if is_health_status_stale():
+            rebuild_health_status()
+        elif patient_id not in health_status_store['rows'] \
+                and [patient_id] in get_database_patients():
+            rebuild_health_status()
+
+        row = health_status_store['rows'].get(patient_id)
+
+        return dict(health_status_store['table'].row(row).items()) if row is not None else None
+
+
+def is_health_status_stale():
+    checked_at = health_status_store['checked at']
+
+    # a shared census is checked on every lookup, another worker may have published a newer version. The check
+    # reads a few single rows, see is_census_outdated
+    return settings['shared_census'] or checked_at is None or has_changed_patients() \
+        or time.time() - checked_at > settings['health_status_max_age']
+
+
+def rebuild_health_status():
+    get_census_overview()
+
+    return
+
+
+def get_census_overview():
+    # ranked records and ward occupancy of the whole census, only changed patients are recomputed
+    with census_lock:
+        if settings['shared_census']:
+            refresh_shared_census()
+        else:
+            refresh_census()
+        health_status_store['checked at'] = time.time()
+
+        return census_state['sorted records'], census_state['ward allocation']
+
+
+def refresh_census():
+    # the version is read first, a list replaced meanwhile moves it past the one recorded
+    list_version = get_patient_list_version()
+    patient_id_list = [patient_id[0] for patient_id in get_database_patients()]
+    census_state['patient list version'] = list_version
+    if not settings['incremental_census'] or census_state['patient ids'] != patient_id_list:
+        build_census(patient_id_list)
+    else:
+        if is_sync_due():
+            sync_observations()
+            census_state['synced at'] = time.time()
+        # expired cache entries are queried again in the background, then saved as changed patients
+        refresh_cached_patients(expired_local_database())
+        patient_ids = take_changed_patients()
+        if patient_ids:
+            update_census(patient_ids)
+
+    return
+
+
+def is_sync_due():
+    return settings['sync_interval'] is not None and \
+        (census_state['synced at'] is None or time.time() - census_state['synced at'] > settings['sync_interval'])
+
+
+def refresh_shared_census():
+    # one worker at a time holds the write lease, applies the changes saved by every worker and publishes the
+    # census as a new snapshot version. The others attach the latest version instead of computing their own.
+    while True:
+        attach_census_snapshot()
+        if census_state['patient ids'] is not None:
+            census_state['waiting since'] = None
+            if not is_census_outdated():
+                return
+        if acquire_census_writer():
+            try:
+                # a version published since the last check is the base of the update
+                attach_census_snapshot()
+                if census_state['patient ids'] is not None and census_state['scheduler'] is None:
+                    restore_census_ranking()
+                refresh_census()
+                if census_state['version'] != census_state['snapshot version']:
+                    publish_census_snapshot()
+            finally:
+                release_census_writer()
+            return
+        if census_state['patient ids'] is not None:
+            # another worker is updating, the attached version is served meanwhile
+            return
+        # another worker is building the first version. The wait is shared by the requests of this process, which
+        # queue on census_lock, so after census_wait_timeout they fail at once until a version is published
+        if census_state['waiting since'] is None:
+            census_state['waiting since'] = time.time()
+        if time.time() - census_state['waiting since'] > settings['census_wait_timeout']:
+            raise CensusUnavailable('No census version published yet, another worker holds the write lease')
+        time.sleep(settings['census_wait_interval'])
+
+
+def is_census_outdated():
+    # runs on every shared census lookup, so it reads single rows: the whole patient list only when its version
+    # moved and the expired cache entries every refresh_check_interval seconds
+    if not settings['incremental_census'] or is_sync_due():
+        return True
+    list_version = get_patient_list_version()
+    if list_version != census_state['patient list version']:
+        if census_state['patient ids'] != [patient_id[0] for patient_id in get_database_patients()]:
+            return True
+        census_state['patient list version'] = list_version
+    if has_changed_patients():
+        return True
+
+    now = time.time()
+    if census_state['refresh checked at'] is not None \
+            and now - census_state['refresh checked at'] < settings['refresh_check_interval']:
+        return False
+    census_state['refresh checked at'] = now
+
+    return is_refresh_due()
+
+
+def attach_census_snapshot():
+    # load the latest published census, unless this process already has it
+    init_local_database()
+    while True:
+        version, size, modified_at, ward_allocation, list_version = get_engine().execute(
+            'SELECT version, size, "modified at", "ward allocation", "patient list version" FROM app_census_state '
+            'WHERE id = 1').fetchone()
+        if version == 0 or version == census_state['snapshot version']:
+            return
+        with metrics.timer('sql_query_duration_seconds', query='app_census_snapshot'):
+            df_data = pd.read_sql('SELECT * FROM app_census_snapshot WHERE version = ? ORDER BY position',
+                                  get_engine(), params=(version,))
+        # versions are deleted two publications later, read the state again if that happened in between
+        if len(df_data) == size:
+            break
+
+    table = PatientTable.from_records(df_data.to_dict('records'))
+    patient_ids = table.columns['patient id']
+    census_state['patient ids'] = list(patient_ids)
+    census_state['positions'] = {patient_id: i for i, patient_id in enumerate(patient_ids)}
+    census_state['sorted records'] = TableView(table, np.argsort(df_data['rank'].to_numpy()).tolist())
+    census_state['ward allocation'] = json.loads(ward_allocation)
+    # rebuilt by restore_census_ranking when this process takes the write lease
+    census_state['scheduler'] = None
+    census_state['version'] = census_state['snapshot version'] = version
+    census_state['modified at'] = modified_at
+    census_state['patient list version'] = list_version
+    health_status_store['table'] = table
+    health_status_store['rows'] = census_state['positions']
+    health_status_store['built at'] = modified_at
+
+    return
+
+
+def restore_census_ranking():
+    # ward scheduler of an attached census, the published order and wards are kept
+    sorted_records = census_state['sorted records']
+    census_state['scheduler'] = build_ward_scheduler(sorted_records.table, sorted_records.order,
+                                                     scheduler_capacity(census_state['ward allocation']))
+
+    return
+
+
+def publish_census_snapshot():
+    # the new version replaces the published one in a single transaction
+    sorted_records = census_state['sorted records']
+    table, order = sorted_records.table, sorted_records.order
+    version = census_state['version']
+    columns = [[version] * len(order), list(range(len(order))), list(order)]
+    for key, kind in RECORD_FIELDS:
+        if kind in ['number', 'flag']:
+            # NaN is missing
+            columns.append([None if value != value else value for value in table.column(key)[order].tolist()])
+        else:
+            column = table.columns[key]
+            columns.append([column[i] for i in order])
+    command = 'INSERT INTO app_census_snapshot VALUES (' + ', '.join('?' * len(columns)) + ')'
+
+    with get_engine().begin() as connection:
+        # a writer whose lease ran out leaves the census to the worker that took it over
+        result = connection.execute('UPDATE app_census_state SET version = ?, size = ?, "modified at" = ?, '
+                                    '"ward allocation" = ?, "patient list version" = ? WHERE id = 1 AND writer = ?',
+                                    (version, len(order), census_state['modified at'],
+                                     json.dumps(census_state['ward allocation']), census_state['patient list version'],
+                                     get_writer_id()))
+        if result.rowcount != 1:
+            return
+        # workers may still be reading the previous version
+        connection.execute('DELETE FROM app_census_snapshot WHERE version < ? OR version >= ?',
+                           (census_state['snapshot version'] or version, version))
+        if order:
+            connection.execute(command, list(zip(*columns)))
+    census_state['snapshot version'] = version
+
+    return
+
+
+def acquire_census_writer():
+    now = time.time()
+    result = get_engine().execute('UPDATE app_census_state SET writer = ?, "writer until" = ? '
+                                  'WHERE id = 1 AND (writer = ? OR "writer until" < ?)',
+                                  (get_writer_id(), now + settings['census_writer_lease'], get_writer_id(), now))
+    if result.rowcount != 1:
+        return False
+
+    # the lease is renewed while the census is built, so a short lease only runs out when the writer is gone
+    census_state['writer renewal'] = threading.Event()
+    threading.Thread(target=renew_census_writer, args=(census_state['writer renewal'],), daemon=True).start()
+
+    return True
+
+
+def renew_census_writer(stop):
+    while not stop.wait(settings['census_writer_lease'] / 3):
+        try:
+            get_engine().execute('UPDATE app_census_state SET "writer until" = ? WHERE id = 1 AND writer = ?',
+                                 (time.time() + settings['census_writer_lease'], get_writer_id()))
+        except Exception:
+            logger.exception('Census write lease not renewed')
+
+    return
+
+
+def release_census_writer():
+    if census_state['writer renewal'] is not None:
+        census_state['writer renewal'].set()
+        census_state['writer renewal'] = None
+    get_engine().execute('UPDATE app_census_state SET writer = NULL, "writer until" = 0 WHERE id = 1 AND writer = ?',
+                         (get_writer_id(),))
+
+    return
+
+
+def get_census_origin():
+    # what a census version counts in, the shared snapshots or this process's own census
+    if settings['shared_census']:
+        return 'shared'
+
+    return get_writer_id() + ':' + repr(loaded_at)
+
+
+def get_writer_id():
+    # workers forked from one process share the module, so the id is taken when it is needed
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+def get_census_page(offset=0, limit=None, sort='health status', descending=False, ward=None, health_status=None):
+    # one page of the census and the number of patients matching the filters, without copying the census. The page
+    # and the ward counts are copied before the census lock is released, they are read while the census changes
+    limit = limit or settings['overview_page_size']
+    with census_lock:
+        sorted_records, ward_allocation = get_census_overview()
+
+        # the levels are consecutive ranges of the ranking
+        start, end = 0, len(sorted_records)
+        if health_status is not None:
+            boundaries = [0] + health_status_boundaries(len(sorted_records)) + [len(sorted_records)]
+            level = HEALTH_STATUS_LEVELS.index(health_status)
+            start, end = boundaries[level], boundaries[level + 1]
+        positions = range(end - 1, start - 1, -1) if descending and sort == 'health status' else range(start, end)
+        candidates = (sorted_records[i] for i in positions)
+        if ward is not None:
+            candidates = (patient for patient in candidates if patient['ward allocation'] == ward)
+
+        if ward is None:
+            total = end - start
+        elif health_status is None:
+            total = ward_allocation[ward]
+        else:
+            total = sum(1 for i in range(start, end) if sorted_records[i]['ward allocation'] == ward)
+
+        if sort == 'health status':
+            page_records = list(islice(candidates, offset, offset + limit))
+        elif descending:
+            page_records = heapq.nlargest(offset + limit, candidates,
+                                          key=lambda i: census_sort_key(i.get(sort), True))[offset:]
+        else:
+            page_records = heapq.nsmallest(offset + limit, candidates,
+                                           key=lambda i: census_sort_key(i.get(sort), False))[offset:]
+
+        return [dict(patient.items()) for patient in page_records], total, dict(ward_allocation)
+
+
+def census_sort_key(value, descending):
+    # patients without the value are listed last in both directions, NaN is the only value not equal to itself
+    missing = value is None or value != value
+    if missing:
+        return (not descending, 0)
+
+    return (descending, value)
+
+
+def build_census(patient_id_list):
+    # changes saved while building are picked up by the next update
+    take_changed_patients()
+    patient_records, fetched_records = read_all_patient_data(patient_id_list)
+    ward_allocation = count_ward_allocation(patient_records)
+    sorted_records = calculate_health_status(patient_records, ward_allocation)
+    table = sorted_records.table
+    init_local_database()
+    with get_engine().begin() as connection:
+        write_local_database(fetched_records, connection)
+        write_patient_status(connection, [status_row(table, i, rank) for rank, i in enumerate(sorted_records.order)],
+                             replace=True)
+
+    census_state['patient ids'] = patient_id_list
+    # patient_records are in app_patient_list order, so table rows are list positions and the scheduler keys
+    # are the ranking entries
+    census_state['positions'] = health_status_store['rows']
+    census_state['scheduler'] = health_status_store['scheduler']
+    census_state['sorted records'] = sorted_records
+    census_state['ward allocation'] = ward_allocation
+    mark_census_modified()
+
+    return
+
+
+def mark_census_modified():
+    census_state['version'] += 1
+    census_state['modified at'] = time.time()
+
+    return
+
+
+def get_census_version():
+    # version and modification time of the census after applying pending changes
+    with census_lock:
+        get_census_overview()
+
+        return census_state['version'], census_state['modified at']
+
+
+def update_census(patient_ids, saved_records=None):
+    # saved_records (patient id -> record) are new records to store, the other patients are read from the local
+    # database. New records are stored in the transaction writing the changed status rows
+    saved_records = saved_records or dict()
+    table = census_state['sorted records'].table
+    positions = census_state['positions']
+    ward_allocation = census_state['ward allocation']
+    order = census_state['sorted records'].order
+    entries = RankingEntries(table, order)
+    scheduler = census_state['scheduler']
+
+    patient_ids = [patient_id for patient_id in patient_ids if patient_id in positions]
+    new_records = search_local_database_bulk([patient_id for patient_id in patient_ids
+                                              if patient_id not in saved_records])
+    new_records.update((patient_id, saved_records[patient_id]) for patient_id in patient_ids
+                       if patient_id in saved_records)
+    # patients without a cached record (invalidated or expired) are queried in the background and saved again,
+    # the census keeps their previous record meanwhile
+    refresh_cached_patients([patient_id for patient_id in patient_ids if patient_id not in new_records])
+    # patients queried again without a change keep their place, and the census its version
+    patient_ids = [patient_id for patient_id in patient_ids if patient_id in new_records
+                   and not table.has_record(positions[patient_id], new_records[patient_id])]
+
+    # move each changed patient to its new place, only positions between old and new place shift
+    low, high = len(order), 0
+    for patient_id in patient_ids:
+        position = positions[patient_id]
+        old_record, new_record = table.row(position), new_records[patient_id]
+        old_place = bisect_left(entries, ranking_entry(old_record, position))
+        del order[old_place]
+        new_place = bisect_left(entries, ranking_entry(new_record, position))
+        order.insert(new_place, position)
+        low, high = min(low, old_place, new_place), max(high, old_place + 1, new_place + 1)
+
+        move_ward_allocation(ward_allocation, old_record['ward allocation'], new_record.get('ward allocation'))
+        # the scheduler reads the keys of the patients in its rank ranges from the table, so the patient leaves
+        # its range with the old key first
+        ward_scheduler.take_patient(scheduler, patient_id)
+        table.set_record(position, new_record)
+
+    # levels are cut by position, so only the shifted range changes level. Changed patients and patients
+    # changing level are rescored, the scheduler reports every patient whose ward changed as a consequence
+    boundaries = health_status_boundaries(len(order))
+    for health_status, start, end in zip(HEALTH_STATUS_LEVELS, [0] + boundaries, boundaries + [len(order)]):
+        for i in range(max(start, low), min(end, high)):
+            table.set(order[i], 'health status', health_status)
+            entry = entries[i]
+            ward_scheduler.rescore(scheduler, entry[-1], entry, HEALTH_STATUS_WARDS[health_status])
+    moved_patients = ward_scheduler.take_moved_patients(scheduler)
+    for patient_id in moved_patients:
+        table.set(positions[patient_id], 'suggest ward',
+                  ward_scheduler.get_ward(scheduler, patient_id) or 'no allocation')
+
+    # the shifted range has new ranks, patients moved outside of it only a new ward
+    status_rows = [status_row(table, order[i], i) for i in range(low, high)]
+    shifted = set(order[low:high])
+    ward_rows = [(table.get(positions[patient_id], 'suggest ward'), patient_id) for patient_id in moved_patients
+                 if positions[patient_id] not in shifted]
+    init_local_database()
+    with get_engine().begin() as connection:
+        write_local_database(list(saved_records.values()), connection)
+        write_patient_status(connection, status_rows, ward_rows)
+
+    health_status_store['built at'] = time.time()
+    if patient_ids:
+        mark_census_modified()
+
+    return
+
+
+def status_row(table, index, rank):
+    return (table.get(index, 'patient id'), rank, table.get(index, 'health status'), table.get(index, 'suggest ward'),
+            table.get(index, 'ward allocation'))
+
+
+def write_patient_status(connection, status_rows, ward_rows=(), replace=False):
+    # status_rows as in PATIENT_STATUS_COLUMNS, ward_rows (suggested ward, patient id) of unchanged ranks
+    if replace:
+        connection.execute('DELETE FROM app_patient_status')
+    if status_rows:
+        connection.execute('INSERT OR REPLACE INTO app_patient_status ('
+                           + ', '.join('"' + column + '"' for column in PATIENT_STATUS_COLUMNS) + ') VALUES ('
+                           + ', '.join('?' * len(PATIENT_STATUS_COLUMNS)) + ')', status_rows)
+    if ward_rows:
+        connection.execute('UPDATE app_patient_status SET "suggest ward" = ? WHERE "patient id" = ?', ward_rows)
+
+    return
+
+
+def query_patient_status(health_status=None, ward=None, suggest_ward=None, offset=0, limit=None):
+    # census patients matching the filters in ranking order and their number, answered from the status indexes
+    init_local_database()
+    conditions, params = list(), list()
+    for column, value in [('health status', health_status), ('ward allocation', ward), ('suggest ward', suggest_ward)]:
+        if value is not None:
+            conditions.append('"' + column + '" = ?')
+            params.append(value)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    limit = limit or settings['overview_page_size']
+
+    with metrics.timer('sql_query_duration_seconds', query='app_patient_status'):
+        total = get_engine().execute('SELECT COUNT(*) FROM app_patient_status' + where, tuple(params)).fetchone()[0]
+        rows = get_engine().execute('SELECT ' + ', '.join('"' + column + '"' for column in PATIENT_STATUS_COLUMNS)
+                                    + ' FROM app_patient_status' + where + ' ORDER BY rank LIMIT ? OFFSET ?',
+                                    tuple(params) + (limit, offset)).fetchall()
+
+    return [dict(zip(PATIENT_STATUS_COLUMNS, row)) for row in rows], total
+
+
+def ranking_entry(patient, position):
+    # sorts like rank_patients: a missing value after all others, then the app_patient_list position keeps equal
+    # patients in list order
+    entry = list()
+    for key, descending in RANKING_KEYS:
+        value = patient.get(key)
+        if is_missing(value):
+            entry.extend([1, 0.0])
+        else:
+            entry.extend([0, -float(value) if descending else float(value)])
+
+    return tuple(entry) + (position, patient['patient id'])
+
+
+class RankingEntries:
+    # ranking entries (see ranking_entry) of table rows in the given order, computed on access so the census
+    # keeps no tuple per patient. bisect searches it like the sorted list of entries
+    __slots__ = ['table', 'order']
+
+    def __init__(self, table, order):
+        self.table = table
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        index = self.order[position]
+
+        return ranking_entry(self.table.row(index), index)
+
+
+def mark_patients_changed(patient_ids):
+    if settings['shared_census']:
+        # the worker holding the write lease may be another process
+        init_local_database()
+        rows = [(patient_id,) for patient_id in patient_ids]
+        if rows:
+            get_engine().execute('INSERT OR IGNORE INTO app_census_changes ("patient id") VALUES (?)', rows)
+        return
+
+    with changed_lock:
+        changed_patients.update(patient_ids)
+
+    return
+
+
+def take_changed_patients():
+    global changed_patients
+
+    if settings['shared_census']:
+        with get_engine().begin() as connection:
+            rows = connection.execute('SELECT rowid, "patient id" FROM app_census_changes').fetchall()
+            # patients marked again meanwhile keep their rowid, new ones get a higher one and stay
+            if rows:
+                connection.execute('DELETE FROM app_census_changes WHERE rowid <= ?', (max(row[0] for row in rows),))
+        return {row[1] for row in rows}
+
+    with changed_lock:
+        patient_ids, changed_patients = changed_patients, set()
+
+    return patient_ids
+
 
-    global patients_records_with_calculation
+def has_changed_patients():
+    if settings['shared_census']:
+        return get_engine().execute('SELECT 1 FROM app_census_changes LIMIT 1').fetchone() is not None
 
-    for patient in patients_records_with_calculation:
-        if patient_id == patient['patient id']:
-            return patient
+    return bool(changed_patients)
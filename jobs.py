@@ -0,0 +1,267 @@
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
+from get_data_fhir import get_engine
+import threading
+import logging
+import json
+import time
+import uuid
+
+# background jobs (data clean-up, upload, observation sync) run here instead of inside the HTTP request. A job runs
+# in the worker process that started it, its state is kept in the local database so any worker can report or
+# cancel it
+settings = {
+    'workers': 2,
+    'keep_finished': 20,  # finished jobs kept for status queries
+    'progress_interval': 0.5,  # seconds between progress writes of a running job
+    'heartbeat_interval': 60,  # seconds between the liveness writes of the queued and running jobs of a process
+    'stale_after': 600  # seconds without a liveness write before a job counts as failed, its worker is gone
+}
+
+JOBS_TABLE = '''
+CREATE TABLE IF NOT EXISTS app_jobs (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    status TEXT,
+    "rows processed" INTEGER,
+    "rows total" INTEGER,
+    errors TEXT,
+    result TEXT,
+    "created at" FLOAT,
+    "started at" FLOAT,
+    "finished at" FLOAT,
+    "updated at" FLOAT,
+    "cancel requested" INTEGER NOT NULL DEFAULT 0
+)'''
+# at most one queued or running job per name, over all worker processes
+JOBS_ACTIVE_INDEX = 'CREATE UNIQUE INDEX IF NOT EXISTS ix_app_jobs_active_name ON app_jobs (name) ' \
+                    "WHERE status IN ('queued', 'running')"
+JOB_COLUMNS = ['id', 'name', 'status', 'rows processed', 'rows total', 'errors', 'result', 'created at', 'started at',
+               'finished at']
+ACTIVE_STATUS = ['queued', 'running']
+
+jobs_lock = threading.Lock()
+job_executor = None
+# not jobs_lock, start_job asks for the executor while holding it
+executor_lock = threading.Lock()
+jobs_table_ready = False
+# queued and running jobs of this process, kept fresh by the heartbeat thread
+held_jobs = set()
+heartbeat_thread = None
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def start_job(name, target, *args, **kwargs):
+    # target is called with a progress(done, total, error=None) keyword argument and returns the job result.
+    # Returns the id of the new job, or of the queued or running job of the same name
+    job = dict()
+    job['id'] = str(uuid.uuid4())
+    job['name'] = name
+    job['status'] = 'queued'
+    job['rows processed'] = 0
+    job['rows total'] = None
+    job['errors'] = list()
+    job['result'] = None
+    job['created at'] = time.time()
+    job['started at'] = None
+    job['finished at'] = None
+    job['reported at'] = 0
+
+    init_jobs_table()
+    expire_stale_jobs()
+    with jobs_lock:
+        remove_finished_jobs()
+        try:
+            get_engine().execute('INSERT INTO app_jobs (' + ', '.join('"' + column + '"' for column in JOB_COLUMNS)
+                                 + ', "updated at") VALUES (' + ', '.join('?' * (len(JOB_COLUMNS) + 1)) + ')',
+                                 job_row(job) + (job['created at'],))
+        except IntegrityError:
+            # another request or worker started it meanwhile
+            return find_active_job(name)
+        held_jobs.add(job['id'])
+        start_heartbeat()
+        get_job_executor().submit(run_job, job, target, args, kwargs)
+
+    return job['id']
+
+
+def run_job(job, target, args, kwargs):
+    try:
+        if is_cancel_requested(job['id']):
+            raise JobCancelled()
+        job['status'] = 'running'
+        job['started at'] = time.time()
+        save_job(job)
+        job['result'] = target(*args, progress=lambda done, total, error=None: report_progress(job, done, total, error),
+                               **kwargs)
+        job['status'] = 'done'
+    except JobCancelled:
+        job['status'] = 'cancelled'
+    except Exception as error:
+        job['errors'].append(str(error))
+        job['status'] = 'failed'
+    job['finished at'] = time.time()
+    try:
+        save_job(job)
+    except Exception:
+        # nothing else reports it, the executor drops exceptions
+        logger.exception('Job %s not saved', job['id'])
+    finally:
+        with jobs_lock:
+            held_jobs.discard(job['id'])
+
+    return
+
+
+def report_progress(job, done, total, error=None):
+    job['rows processed'] = done
+    job['rows total'] = total
+    if error:
+        job['errors'].append(error)
+    # written and checked for a cancel request every progress_interval, errors and the last row right away
+    now = time.time()
+    if now - job['reported at'] < settings['progress_interval'] and not error and done != total:
+        return
+    job['reported at'] = now
+    save_job(job)
+    # the job stops at its next progress report after a cancel request
+    if is_cancel_requested(job['id']):
+        raise JobCancelled()
+
+    return
+
+
+def save_job(job):
+    get_engine().execute('UPDATE app_jobs SET ' + ', '.join('"' + column + '" = ?' for column in JOB_COLUMNS[1:])
+                         + ', "updated at" = ? WHERE id = ?', job_row(job)[1:] + (time.time(), job['id']))
+
+    return
+
+
+def job_row(job):
+    row = [job[column] for column in JOB_COLUMNS]
+    row[JOB_COLUMNS.index('errors')] = json.dumps(job['errors'])
+    row[JOB_COLUMNS.index('result')] = json.dumps(job['result'], default=str)
+
+    return tuple(row)
+
+
+def is_cancel_requested(job_id):
+    row = get_engine().execute('SELECT "cancel requested" FROM app_jobs WHERE id = ?', (job_id,)).fetchone()
+
+    return bool(row and row[0])
+
+
+def cancel_job(job_id):
+    init_jobs_table()
+    if get_engine().execute('SELECT 1 FROM app_jobs WHERE id = ?', (job_id,)).fetchone() is None:
+        return False
+    get_engine().execute('UPDATE app_jobs SET "cancel requested" = 1 WHERE id = ?', (job_id,))
+
+    return True
+
+
+def find_active_job(name):
+    # a queued or running job of this kind, so a page reload does not start it twice
+    init_jobs_table()
+    expire_stale_jobs()
+    row = get_engine().execute('SELECT id FROM app_jobs WHERE name = ? AND status IN (?, ?)',
+                               (name,) + tuple(ACTIVE_STATUS)).fetchone()
+
+    return row[0] if row else None
+
+
+def get_job_status(job_id):
+    init_jobs_table()
+    expire_stale_jobs()
+    row = get_engine().execute('SELECT ' + ', '.join('"' + column + '"' for column in JOB_COLUMNS)
+                               + ' FROM app_jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    status = dict(zip(JOB_COLUMNS, row))
+    status['errors'] = json.loads(status['errors'])
+    status['result'] = json.loads(status['result'])
+    status['throughput'] = None
+    status['eta'] = None
+    if status['started at'] is not None:
+        elapsed = (status['finished at'] or time.time()) - status['started at']
+        if elapsed > 0 and status['rows processed']:
+            status['throughput'] = status['rows processed'] / elapsed
+            if status['rows total'] and status['status'] == 'running':
+                status['eta'] = (status['rows total'] - status['rows processed']) / status['throughput']
+
+    return status
+
+
+def start_heartbeat():
+    # called under jobs_lock
+    global heartbeat_thread
+
+    if heartbeat_thread is None:
+        heartbeat_thread = threading.Thread(target=beat_jobs, daemon=True)
+        heartbeat_thread.start()
+
+    return
+
+
+def beat_jobs():
+    # a job may write no progress for a long time (a first sync, the scan of the source, waiting for a worker), its
+    # "updated at" is kept fresh as long as this process holds it
+    while True:
+        time.sleep(settings['heartbeat_interval'])
+        with jobs_lock:
+            job_ids = list(held_jobs)
+        if not job_ids:
+            continue
+        try:
+            get_engine().execute('UPDATE app_jobs SET "updated at" = ? WHERE id IN (' + ', '.join('?' * len(job_ids))
+                                 + ') AND status IN (?, ?)', (time.time(),) + tuple(job_ids) + tuple(ACTIVE_STATUS))
+        except Exception:
+            logger.exception('Job heartbeat not written')
+
+
+def expire_stale_jobs():
+    # jobs of a worker that stopped never finish, they fail so the job can be started again. Queued and running jobs
+    # of a live worker are kept fresh by its heartbeat, however long they wait or run without progress
+    now = time.time()
+    get_engine().execute('UPDATE app_jobs SET status = ?, errors = ?, "finished at" = ? '
+                         'WHERE status IN (?, ?) AND "updated at" < ?',
+                         ('failed', json.dumps(['No progress for ' + str(settings['stale_after']) + 's']), now)
+                         + tuple(ACTIVE_STATUS) + (now - settings['stale_after'],))
+
+    return
+
+
+def remove_finished_jobs():
+    get_engine().execute('DELETE FROM app_jobs WHERE id IN (SELECT id FROM app_jobs WHERE "finished at" IS NOT NULL '
+                         'ORDER BY "finished at" DESC LIMIT -1 OFFSET ?)', (settings['keep_finished'],))
+
+    return
+
+
+def init_jobs_table():
+    global jobs_table_ready
+
+    if jobs_table_ready:
+        return
+
+    get_engine().execute(JOBS_TABLE)
+    get_engine().execute(JOBS_ACTIVE_INDEX)
+    jobs_table_ready = True
+
+    return
+
+
+def get_job_executor():
+    global job_executor
+
+    with executor_lock:
+        if job_executor is None:
+            job_executor = ThreadPoolExecutor(max_workers=settings['workers'])
+
+    return job_executor
@@ -1,7 +1,9 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, abort, jsonify, request
 from flask_login import login_required, current_user
-from get_data_fhir import search_patient_data, search_all_patient_data, count_ward_allocation, calculate_health_status, \
-    get_health_status
+from get_data_fhir import search_patient_data, get_census_page, get_health_status, get_observation_trends, \
+    settings as fhir_settings, CensusUnavailable, CENSUS_SORT_KEYS, HEALTH_STATUS_LEVELS, WARD_NAMES
+from jobs import start_job, find_active_job, get_job_status, cancel_job
+from auth import check_csrf
 import data_cleanup
 import upload_data
 
@@ -10,33 +12,116 @@ main = Blueprint('main', __name__)
 
 @main.route('/initiate_patient_data/<status>')
 def initiate_patient_data(status):
-    if status == 'data_cleanup':
-        msg_origin, msg_cleanup = data_cleanup.main()
-        return render_template('progress.html', status=status, msg_origin=msg_origin, msg_cleanup=msg_cleanup)
-    elif status == 'data_upload':
-        msg_sample_patients = upload_data.main()
-        return render_template('progress.html', status=status, msg_sample_patients=msg_sample_patients)
+    # clean-up and upload run as background jobs, progress.html polls their status
+    if status in initiation_jobs:
+        job_id = find_active_job(status) or start_job(status, initiation_jobs[status])
+        return render_template('progress.html', status=status, job_id=job_id)
 
     return render_template('progress.html', status=status)
 
 
+@main.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = get_job_status(job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@main.route('/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def job_cancel(job_id):
+    check_csrf()
+    if not cancel_job(job_id):
+        abort(404)
+    return jsonify(get_job_status(job_id))
+
+
+@main.app_errorhandler(CensusUnavailable)
+def census_unavailable(error):
+    # another worker is building the first shared census, pages and API calls are retried shortly
+    return str(error), 503, {'Retry-After': str(max(int(fhir_settings['census_wait_timeout']), 1))}
+
+
+def run_data_cleanup(progress):
+    return data_cleanup.main(chunk_size=data_cleanup.settings['chunk_size'], progress=progress)
+
+
+def run_data_upload(progress):
+    return upload_data.main(progress=progress)
+
+
+initiation_jobs = {
+    'data_cleanup': run_data_cleanup,
+    'data_upload': run_data_upload
+}
+
+
 @main.route('/patient/<patient_id>')
 @login_required
 def patient(patient_id):
     patient_record = search_patient_data(patient_id)
-    return render_template('patient.html', name=current_user.fullname, patient_record=patient_record)
+    return render_template('patient.html', name=current_user.fullname, patient_record=patient_record,
+                           trends=patient_trends(patient_id))
 
 
 @main.route('/clinician/<page>/<user_id>')
 @login_required
 def clinician(page, user_id):
     if page == 'Overview':
-        patient_records = search_all_patient_data()
-        ward_allocation = count_ward_allocation(patient_records)
-        patient_records_with_status = calculate_health_status(patient_records, ward_allocation)
-        return render_template('clinician.html', page=page, name=current_user.fullname,
-                               patient_records=patient_records_with_status, ward_allocation=ward_allocation)
+        query = overview_query()
+        patient_records_with_status, total, ward_allocation = get_census_page(**query)
+        return render_template('clinician.html', page=page, user_id=user_id, name=current_user.fullname,
+                               patient_records=patient_records_with_status, total=total, query=query,
+                               ward_allocation=ward_allocation, sort_keys=CENSUS_SORT_KEYS,
+                               health_status_levels=HEALTH_STATUS_LEVELS, ward_names=WARD_NAMES)
     if page == 'Details':
         # patient_record = search_patient_data(user_id)
         patient_record = get_health_status(user_id)
-        return render_template('clinician_details.html', c_name=current_user.fullname, p_name=patient_record['full name'], patient_record=patient_record)
+        if patient_record is None:
+            abort(404)
+        return render_template('clinician_details.html', c_name=current_user.fullname, p_name=patient_record['full name'], patient_record=patient_record,
+                               trends=patient_trends(user_id))
+
+
+def patient_trends(patient_id):
+    # sparklines of the measured values, an empty history gives None
+    return {key: sparkline(buckets) for key, buckets in get_observation_trends(patient_id).items()}
+
+
+def sparkline(buckets, width=120, height=30):
+    # svg coordinates of the trend buckets: the last values as a polyline and each bucket's min-max range
+    if not buckets:
+        return None
+    times = [bucket['time'] for bucket in buckets]
+    low, high = min(bucket['min'] for bucket in buckets), max(bucket['max'] for bucket in buckets)
+
+    def x(value):
+        return round((value - times[0]) / (times[-1] - times[0]) * width, 1) if times[-1] > times[0] else width / 2
+
+    def y(value):
+        # higher values up, with a pixel of margin
+        return round(height - 1 - (value - low) / (high - low) * (height - 2), 1) if high > low else height / 2
+
+    points = ' '.join(str(x(bucket['time'])) + ',' + str(y(bucket['last'])) for bucket in buckets)
+    ranges = [(x(bucket['time']), y(bucket['min']), y(bucket['max'])) for bucket in buckets]
+
+    return {'points': points, 'ranges': ranges, 'width': width, 'height': height,
+            'first': buckets[0]['last'], 'last': buckets[-1]['last']}
+
+
+def overview_query():
+    # paging, sorting and filters of the Overview from the query string, empty filters select every patient
+    query = dict()
+    query['offset'] = max(request.args.get('offset', 0, type=int), 0)
+    query['limit'] = min(max(request.args.get('limit', fhir_settings['overview_page_size'], type=int), 1),
+                         fhir_settings['overview_max_page_size'])
+    query['sort'] = request.args.get('sort') or 'health status'
+    query['descending'] = request.args.get('order') == 'desc'
+    query['ward'] = request.args.get('ward') or None
+    query['health_status'] = request.args.get('status') or None
+    if query['sort'] not in CENSUS_SORT_KEYS or query['ward'] not in WARD_NAMES + [None] \
+            or query['health_status'] not in HEALTH_STATUS_LEVELS + [None]:
+        abort(400)
+
+    return query
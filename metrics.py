@@ -0,0 +1,184 @@
+from flask import Blueprint, Response, request, g, current_app
+from contextlib import contextmanager
+from bisect import bisect_left
+from collections import deque
+import cProfile
+import threading
+import pstats
+import random
+import time
+import io
+
+metrics = Blueprint('metrics', __name__)
+
+settings = {
+    'enabled': True,
+    'profile_rate': 0.0,  # share of requests run under cProfile, 0 turns the profiling hook off
+    'profile_threshold': 1.0,  # profiled requests slower than this (seconds) are kept and logged
+    'profile_keep': 20,
+    'profile_lines': 25  # functions listed per kept profile
+}
+
+# upper bounds (seconds) of the histogram buckets, +Inf is added when rendering
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# name -> (type, help), only these metrics are rendered
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Flask request latency by route'),
+    'template_render_duration_seconds': ('histogram', 'Jinja template rendering time'),
+    'fhir_request_duration_seconds': ('histogram', 'Outbound FHIR request latency by resource and LOINC code'),
+    'fhir_requests_total': ('counter', 'Outbound FHIR requests by resource, LOINC code and HTTP status'),
+    'sql_query_duration_seconds': ('histogram', 'Local database read time by query'),
+    'health_status_duration_seconds': ('histogram', 'calculate_health_status run time'),
+    'cache_events_total': ('counter', 'Local patient cache hits, misses, expiries, evictions and invalidations'),
+    'ingest_rows_total': ('counter', 'Rows written by the clean-up ingest and entries stored by the upload')
+}
+
+counters = dict()  # (name, labels) -> value
+histograms = dict()  # (name, labels) -> [bucket counts, sum, count]
+metrics_lock = threading.Lock()
+slow_profiles = deque(maxlen=settings['profile_keep'])
+
+
+def inc(name, value=1, **labels):
+    if not settings['enabled']:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+    return
+
+
+def observe(name, seconds, **labels):
+    if not settings['enabled']:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        index = bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    return
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def render_metrics():
+    # Prometheus text exposition format 0.0.4
+    with metrics_lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, [list(value[0]), value[1], value[2]]) for key, value in histograms.items())
+
+    lines = list()
+    for name, (metric_type, help_text) in sorted(METRICS.items()):
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+        if metric_type == 'counter':
+            for (key_name, labels), value in counter_items:
+                if key_name == name:
+                    lines.append(name + format_labels(labels) + ' ' + format_value(value))
+        else:
+            for (key_name, labels), (buckets, total, count) in histogram_items:
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(name + '_bucket' + format_labels(labels + (('le', repr(bound)),))
+                                 + ' ' + str(cumulative))
+                lines.append(name + '_bucket' + format_labels(labels + (('le', '+Inf'),)) + ' ' + str(count))
+                lines.append(name + '_sum' + format_labels(labels) + ' ' + format_value(total))
+                lines.append(name + '_count' + format_labels(labels) + ' ' + str(count))
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+
+    return '{' + ','.join(name + '="' + value + '"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def reset_metrics():
+    with metrics_lock:
+        counters.clear()
+        histograms.clear()
+    slow_profiles.clear()
+
+    return
+
+
+@metrics.route('/metrics')
+def metrics_endpoint():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics.before_app_request
+def start_request_timer():
+    g.metrics_start = time.perf_counter()
+    g.metrics_profile = None
+    if settings['profile_rate'] and random.random() < settings['profile_rate']:
+        g.metrics_profile = cProfile.Profile()
+        g.metrics_profile.enable()
+
+
+@metrics.after_app_request
+def record_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    observe('http_request_duration_seconds', seconds, route=route, method=request.method,
+            status=str(response.status_code))
+
+    profile = g.pop('metrics_profile', None)
+    if profile is not None:
+        profile.disable()
+        if seconds >= settings['profile_threshold']:
+            keep_profile(profile, route, seconds)
+
+    return response
+
+
+def keep_profile(profile, route, seconds):
+    # slow sampled requests are logged with their most expensive functions
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(settings['profile_lines'])
+    slow_profiles.append({'route': route, 'seconds': seconds, 'at': time.time(), 'profile': output.getvalue()})
+    current_app.logger.warning('Slow request %s took %.3fs\n%s', route, seconds, output.getvalue())
+
+    return
+
+
+@metrics.record_once
+def time_templates(state):
+    # flask renders through Template.render, a subclass times every template of the app
+    environment = state.app.jinja_env
+    base_class = environment.template_class
+
+    class TimedTemplate(base_class):
+        def render(self, *args, **kwargs):
+            with timer('template_render_duration_seconds', template=self.name or 'string'):
+                return base_class.render(self, *args, **kwargs)
+
+    environment.template_class = TimedTemplate
@@ -0,0 +1,266 @@
+from operator import attrgetter, itemgetter
+from sys import intern
+import numpy as np
+
+# patient records without a dict per patient: PatientRecord holds one record in slots, PatientTable holds
+# the census column by column. Both, and the PatientRow views of a table, are read like the dicts they
+# replace (record['platelets mean volume']), so templates and callers keep their subscripts.
+
+# key, kind: text, category (few distinct strings, shared between patients), number or flag
+RECORD_FIELDS = [('birth date', 'text'),
+                 ('full name', 'text'),
+                 ('ward allocation', 'category'),
+                 ('COVID-19 test result', 'flag'),
+                 ('patient has disease', 'flag'),
+                 ('leukocytes', 'number'),
+                 ('UoM leukocytes', 'category'),
+                 ('platelets', 'number'),
+                 ('UoM platelets', 'category'),
+                 ('platelets mean volume', 'number'),
+                 ('UoM platelets mean volume', 'category'),
+                 ('eosinophils', 'number'),
+                 ('UoM eosinophils', 'category'),
+                 ('monocytes', 'number'),
+                 ('UoM monocytes', 'category'),
+                 ('patient id', 'text'),
+                 ('health status', 'category'),
+                 ('suggest ward', 'category')]
+FIELD_KINDS = dict(RECORD_FIELDS)
+FIELD_SLOTS = {key: key.replace('COVID-19', 'covid_19').replace('UoM', 'unit').replace(' ', '_').lower()
+               for key, kind in RECORD_FIELDS}
+# set by the ranking, not read from FHIR server
+DERIVED_FIELDS = ['health status', 'suggest ward']
+# flag columns of a table store missing as -1
+MISSING_FLAG = -1
+
+
+def is_missing(value):
+    # None, or NaN read from the local database, NaN is the only value not equal to itself
+    return value is None or value != value
+
+
+def convert_value(key, value):
+    kind = FIELD_KINDS[key]
+    if kind == 'number':
+        return None if value is None else float(value)
+    if kind == 'flag':
+        return None if is_missing(value) else bool(value)
+    if kind == 'category' and isinstance(value, str):
+        return intern(value)
+
+    return value
+
+
+class PatientRecord:
+    __slots__ = list(FIELD_SLOTS.values())
+
+    def __init__(self, data=None):
+        if data is not None:
+            for key, value in data.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, FIELD_SLOTS[key])
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, FIELD_SLOTS[key], convert_value(key, value))
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, FIELD_SLOTS[key])
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in FIELD_SLOTS and hasattr(self, FIELD_SLOTS[key])
+
+    def __iter__(self):
+        return (key for key, slot in FIELD_SLOTS.items() if hasattr(self, slot))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return 'PatientRecord(' + repr(dict(self.items())) + ')'
+
+    def get(self, key, default=None):
+        return getattr(self, FIELD_SLOTS[key], default) if key in FIELD_SLOTS else default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def copy(self):
+        return PatientRecord(self)
+
+
+class PatientTable:
+    # struct of arrays, numbers and flags in numpy arrays and strings in lists, one row per patient
+
+    def __init__(self, size=0):
+        self.size = size
+        self.columns = dict()
+        for key, kind in RECORD_FIELDS:
+            if kind == 'number':
+                self.columns[key] = np.full(size, np.nan)
+            elif kind == 'flag':
+                self.columns[key] = np.full(size, MISSING_FLAG, dtype=np.int8)
+            else:
+                self.columns[key] = [None] * size
+
+    @classmethod
+    def from_records(cls, records, skip=()):
+        # the columns of skip (e.g. DERIVED_FIELDS set afterwards) are left empty
+        records = records if isinstance(records, list) else list(records)
+        table = cls(len(records))
+        for key, kind in RECORD_FIELDS:
+            if key in skip:
+                continue
+            values = column_values(records, key)
+            if kind == 'number':
+                # None becomes NaN
+                table.columns[key] = np.array(values, dtype=float).reshape(len(records))
+            elif kind == 'flag':
+                values = np.array(values, dtype=float).reshape(len(records))
+                table.columns[key] = np.where(np.isnan(values), MISSING_FLAG, values != 0).astype(np.int8)
+            elif kind == 'category':
+                # one string object per distinct value
+                shared = dict()
+                table.columns[key] = list(map(shared.setdefault, values, values))
+            else:
+                table.columns[key] = values
+
+        return table
+
+    def __len__(self):
+        return self.size
+
+    def column(self, key):
+        # numbers as a float array, missing flags become NaN
+        if FIELD_KINDS[key] == 'flag':
+            return np.where(self.columns[key] == MISSING_FLAG, np.nan, self.columns[key])
+
+        return self.columns[key]
+
+    def get(self, index, key):
+        kind = FIELD_KINDS[key]
+        value = self.columns[key][index]
+        if kind == 'number':
+            return float(value)
+        if kind == 'flag':
+            return None if value == MISSING_FLAG else bool(value)
+
+        return value
+
+    def set(self, index, key, value):
+        kind = FIELD_KINDS[key]
+        if kind == 'number':
+            self.columns[key][index] = np.nan if value is None else value
+        elif kind == 'flag':
+            self.columns[key][index] = MISSING_FLAG if is_missing(value) else bool(value)
+        else:
+            self.columns[key][index] = convert_value(key, value)
+
+        return
+
+    def set_record(self, index, record):
+        # the derived fields are kept, they are set again by the ranking
+        for key, kind in RECORD_FIELDS:
+            if key not in DERIVED_FIELDS:
+                self.set(index, key, record.get(key))
+
+        return
+
+    def has_record(self, index, record):
+        # True when set_record would change nothing
+        for key, kind in RECORD_FIELDS:
+            if key in DERIVED_FIELDS:
+                continue
+            old_value, new_value = self.get(index, key), record.get(key)
+            if is_missing(old_value) and is_missing(new_value):
+                continue
+            if is_missing(old_value) or is_missing(new_value) or old_value != convert_value(key, new_value):
+                return False
+
+        return True
+
+    def row(self, index):
+        return PatientRow(self, index)
+
+
+def column_values(records, key):
+    # one value per record, read by a C getter unless a record lacks the key
+    if records and isinstance(records[0], PatientRecord):
+        getter = attrgetter(FIELD_SLOTS[key])
+    else:
+        getter = itemgetter(key)
+    try:
+        return list(map(getter, records))
+    except (AttributeError, KeyError):
+        return [record.get(key) for record in records]
+
+
+class PatientRow:
+    # read and write view of one table row, rendered by the templates like a record
+    __slots__ = ['table', 'index']
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        if key not in FIELD_KINDS:
+            raise KeyError(key)
+        return self.table.get(self.index, key)
+
+    def __setitem__(self, key, value):
+        self.table.set(self.index, key, value)
+
+    def __contains__(self, key):
+        return key in FIELD_KINDS
+
+    def __iter__(self):
+        return iter(FIELD_KINDS)
+
+    def __len__(self):
+        return len(FIELD_KINDS)
+
+    def __repr__(self):
+        return 'PatientRow(' + repr(dict(self.items())) + ')'
+
+    def get(self, key, default=None):
+        return self.table.get(self.index, key) if key in FIELD_KINDS else default
+
+    def keys(self):
+        return list(FIELD_KINDS)
+
+    def items(self):
+        return [(key, self.table.get(self.index, key)) for key in FIELD_KINDS]
+
+
+class TableView:
+    # table rows in a given order, indexed and iterated like the list of records it replaces
+    __slots__ = ['table', 'order']
+
+    def __init__(self, table, order):
+        self.table = table
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [PatientRow(self.table, index) for index in self.order[position]]
+        return PatientRow(self.table, self.order[position])
+
+    def __iter__(self):
+        return (PatientRow(self.table, index) for index in self.order)
@@ -0,0 +1,139 @@
+import random
+import pytest
+from sqlalchemy import create_engine
+from patient_record import PatientRecord, PatientTable, TableView
+import get_data_fhir
+import ward_scheduler
+
+# the incrementally updated census must equal a census ranked from scratch after every change: the order and
+# levels, the suggested wards, the ward counts and the app_patient_status rows, in this process's census and in
+# the shared snapshot of several workers
+
+WARDS = ['no allocation', 'regular ward', 'semi-intensive unit', 'intensive care unit']
+STATUS_COLUMNS = ', '.join('"' + column + '"' for column in get_data_fhir.PATIENT_STATUS_COLUMNS)
+
+
+def make_record(rnd, patient_id):
+    # one decimal and few distinct values so ties occur, sometimes a missing value. Like fetch_patient_data, a
+    # record may leave out the values the server has no observation for
+    record = PatientRecord({'patient id': patient_id, 'full name': 'Patient ' + patient_id, 'birth date': '1970-01-01',
+                            'ward allocation': rnd.choice(WARDS)})
+    for key in ['COVID-19 test result', 'patient has disease']:
+        record[key] = rnd.choice([0, 1, 1, None] if rnd.random() < 0.1 else [0, 1])
+    for key in get_data_fhir.HISTORY_KEYS:
+        record[key] = None if rnd.random() < 0.05 else round(rnd.gauss(0, 1), 1)
+        record['UoM ' + key] = '10*3/uL'
+    for key in ['ward allocation', 'COVID-19 test result', 'patient has disease'] + get_data_fhir.HISTORY_KEYS:
+        if rnd.random() < 0.05:
+            del record[key]
+
+    return record
+
+
+@pytest.fixture
+def census(tmp_path, monkeypatch):
+    # a fresh census state on a temporary database, ward capacities small enough to fill up
+    monkeypatch.setattr(get_data_fhir, 'disk_engine', create_engine('sqlite:///' + str(tmp_path / 'census.db')))
+    monkeypatch.setattr(get_data_fhir, 'local_database_ready', False)
+    monkeypatch.setattr(get_data_fhir, 'changed_patients', set())
+    monkeypatch.setattr(get_data_fhir, 'census_state', dict(get_data_fhir.census_state))
+    monkeypatch.setattr(get_data_fhir, 'health_status_store', dict(get_data_fhir.health_status_store))
+    monkeypatch.setitem(get_data_fhir.settings, 'ward_capacity',
+                        {'regular ward': 12, 'semi-intensive unit': 5, 'intensive care unit': 3})
+    monkeypatch.setitem(get_data_fhir.settings, 'cache_ttl', None)
+    monkeypatch.setitem(get_data_fhir.settings, 'incremental_census', True)
+    reset_census()
+
+    return get_data_fhir
+
+
+def reset_census():
+    # the state of a worker process that has not seen a census yet
+    get_data_fhir.census_state.update({'patient ids': None, 'positions': dict(), 'scheduler': None,
+                                       'sorted records': TableView(PatientTable(), list()), 'ward allocation': dict(),
+                                       'version': 0, 'modified at': None, 'snapshot version': None,
+                                       'patient list version': 0, 'refresh checked at': None,
+                                       'waiting since': None, 'writer renewal': None})
+
+
+def store_patients(census, records):
+    census.save_patient_list([record['patient id'] for record in records])
+    census.write_local_database(records)
+
+
+def change_patients(census, rnd, patient_ids):
+    # new records of some patients, saved like a search or stored and marked like a sync
+    records = [make_record(rnd, patient_id) for patient_id in rnd.sample(patient_ids, rnd.randint(1, 8))]
+    if rnd.random() < 0.5:
+        census.save_to_local_database(*records)
+    else:
+        census.write_local_database(records)
+        census.mark_patients_changed(record['patient id'] for record in records)
+
+
+def ranked_from_scratch(census, patient_ids):
+    # order, levels and wards of a census ranked from the stored records, leaving the census state alone
+    stored = dict(census.health_status_store)
+    cached_records = census.read_local_database(patient_ids)
+    records = [cached_records[patient_id][0] for patient_id in patient_ids]
+    ward_allocation = census.count_ward_allocation(records)
+    view = census.calculate_health_status(records, ward_allocation)
+    census.health_status_store.update(stored)
+
+    return [census.status_row(view.table, i, rank) for rank, i in enumerate(view.order)], ward_allocation
+
+
+def assert_census_equal(census, patient_ids):
+    expected_rows, expected_allocation = ranked_from_scratch(census, patient_ids)
+    sorted_records, ward_allocation = census.get_census_overview()
+
+    rows = [census.status_row(sorted_records.table, i, rank) for rank, i in enumerate(sorted_records.order)]
+    assert [row[0] for row in rows] == [row[0] for row in expected_rows], 'order differs'
+    assert rows == expected_rows, 'levels or suggested wards differ'
+    assert ward_allocation == expected_allocation, 'ward counts differ'
+    stored_rows = census.get_engine().execute('SELECT ' + STATUS_COLUMNS + ' FROM app_patient_status '
+                                              'ORDER BY rank').fetchall()
+    assert [tuple(row) for row in stored_rows] == expected_rows, 'app_patient_status differs'
+
+    scheduler = census.census_state['scheduler']
+    if scheduler is not None:
+        assert [ward_scheduler.get_ward(scheduler, row[0]) or 'no allocation' for row in rows] == \
+            [row[3] for row in expected_rows], 'ward scheduler differs'
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_incremental_census(census, seed):
+    rnd = random.Random(seed)
+    patient_ids = ['p%03d' % i for i in range(rnd.randint(20, 120))]
+    store_patients(census, [make_record(rnd, patient_id) for patient_id in patient_ids])
+    assert_census_equal(census, patient_ids)
+
+    for _ in range(20):
+        change_patients(census, rnd, patient_ids)
+        assert_census_equal(census, patient_ids)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_shared_census(census, monkeypatch, seed):
+    # the writer updates its own census or, like another worker taking over the lease, the published snapshot
+    monkeypatch.setitem(get_data_fhir.settings, 'shared_census', True)
+    rnd = random.Random(seed)
+    patient_ids = ['p%03d' % i for i in range(rnd.randint(20, 120))]
+    store_patients(census, [make_record(rnd, patient_id) for patient_id in patient_ids])
+    assert_census_equal(census, patient_ids)
+
+    for step in range(20):
+        if rnd.random() < 0.2:
+            # a new patient list and no changed patients, the workers notice the list by its version
+            patient_ids = rnd.sample(patient_ids, len(patient_ids) - 1) + ['q%03d' % step]
+            census.write_local_database([make_record(rnd, patient_ids[-1])])
+            census.save_patient_list(patient_ids)
+        else:
+            change_patients(census, rnd, patient_ids)
+        if rnd.random() < 0.5:
+            reset_census()
+        assert_census_equal(census, patient_ids)
+        # a worker attaching the published version serves the same census
+        reset_census()
+        census.attach_census_snapshot()
+        assert_census_equal(census, patient_ids)
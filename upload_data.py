@@ -1,13 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from datetime import datetime, timezone
+from collections import deque
 from sqlalchemy import create_engine
 import pandas as pd
+import multiprocessing
+import argparse
 import names
 import uuid
 import json
+import os
 import requests
+import get_data_fhir
+import fhir_client
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    # optional, the standard library encoder produces the same JSON
+    orjson = None
 
 settings = {
-    'api_base': 'https://r4.smarthealthit.org'
+    'bundle_size': 25,  # patients (with their observations) per transaction Bundle
+    'upload_workers': 4,  # Bundles sent at once
+    'upload_retries': 3,  # rounds of re-sending the entries that failed
+    'generate_workers': os.cpu_count() or 1,  # processes encoding resources, 1 encodes in the calling process
+    'generate_chunk_size': 2000  # patient_source rows encoded per task
 }
 
 LOINC_CODES = ['91891-2', '95424-8', '92256-7', '33256-9', '777-3', '32623-1', '711-2', '742-7']
@@ -18,142 +36,263 @@ LOINC_TEXTS = ['Facility Bed type', 'SARS-CoV-2 (COVID-19) RNA in Respiratory sp
                'Platelet mean volume [Entitic volume] in Blood by Automated count',
                'Eosinophils [#/volume] in Blood by Automated count',
                'Monocytes [#/volume] in Blood by Automated count']
+# patient_source columns of the observations, in LOINC_CODES order
+OBSERVATION_COLUMNS = ['ward allocation', 'SARS-Cov-2 exam result', 'has_disease', 'Leukocytes', 'Platelets',
+                       'Mean platelet volume', 'Eosinophils', 'Monocytes']
+# category (code, display) and value element of each column
+OBSERVATION_KINDS = {
+    'ward allocation': ('survey', 'Survey', 'valueCodeableConcept'),
+    'SARS-Cov-2 exam result': ('exam', 'Exam', 'valueBoolean'),
+    'has_disease': ('exam', 'Exam', 'valueBoolean'),
+    'Leukocytes': ('laboratory', 'Laboratory', 'valueQuantity'),
+    'Platelets': ('laboratory', 'Laboratory', 'valueQuantity'),
+    'Mean platelet volume': ('laboratory', 'Laboratory', 'valueQuantity'),
+    'Eosinophils': ('laboratory', 'Laboratory', 'valueQuantity'),
+    'Monocytes': ('laboratory', 'Laboratory', 'valueQuantity')
+}
+NAME_PREFIXES = {'male': ['Mr.'], 'female': ['Ms.']}
 
 
-def createPatient(patient_data):
-    resource = dict()
-
-    # map patient data from database
-    resource['resourceType'] = 'Patient'
-    resource['id'] = patient_data['Patient ID']
-    resource['active'] = True
-    resource['gender'] = patient_data['gender']
-    resource['birthDate'] = patient_data['dob']
-
-    name = list()
-    name_detail = dict()
-    name_detail['use'] = 'official'
-    name_detail['family'] = patient_data['family name']
-    name_detail['given'] = list()
-    name_detail['given'].append(patient_data['given name'])
-    name_detail['prefix'] = list()
-    if patient_data['gender'] == 'male':
-        name_detail['prefix'].append('Mr.')
-    elif patient_data['gender'] == 'female':
-        name_detail['prefix'].append('Ms.')
-    name.append(name_detail)
-    resource['name'] = name
-
-    return resource
-
-
-def createObservationForPatient(patient_data, index):
-    resource = dict()
-
-    # map observation data from database
-    resource['resourceType'] = 'Observation'
-    resource['id'] = str(uuid.uuid4())
-    resource['status'] = 'final'
-    resource['subject'] = dict()
-    resource['subject']['reference'] = 'Patient/' + patient_data['Patient ID']
-    resource['effectiveDateTime'] = datetime.now(timezone.utc).isoformat()
-    resource['issued'] = resource['effectiveDateTime']
-
-    if patient_data.index[index] == 'ward allocation':
-        # category
-        category_type = 'survey'
-        category_display = 'Survey'
-
-        # valueCodeableConcept
-        valueCodeableConcept = dict()
-        coding_concept = list()
-        coding_concept_detail = dict()
-        coding_concept_detail['system'] = 'http://loinc.org'
-        coding_concept_detail['code'] = patient_data[index]
-        coding_concept_detail['display'] = patient_data[index]
-        coding_concept.append(coding_concept_detail)
-        valueCodeableConcept['coding'] = coding_concept
-        valueCodeableConcept['text'] = coding_concept_detail['display']
-        resource['valueCodeableConcept'] = valueCodeableConcept
-
-    elif patient_data.index[index] in ['SARS-Cov-2 exam result', 'has_disease']:
-        # category
-        category_type = 'exam'
-        category_display = 'Exam'
-
-        # valueBoolean
-        if patient_data[index] == 1:
-            resource['valueBoolean'] = True
-        elif patient_data[index] == 0:
-            resource['valueBoolean'] = False
-
-    else:
-        # category
-        category_type = 'laboratory'
-        category_display = 'Laboratory'
-
-        # valueQuantity
-        valueQuantity = dict()
-        valueQuantity['value'] = patient_data[index]
-        if patient_data.index[index] == 'Mean platelet volume':
-            valueQuantity['unit'] = 'fL'
-        else:
-            valueQuantity['unit'] = '10*3/uL'
-        valueQuantity['system'] = 'http://unitsofmeasure.org'
-        valueQuantity['code'] = valueQuantity['unit']
-        resource['valueQuantity'] = valueQuantity
-
-    # category
-    category = list()
-    category_detail = dict()
-    category_detail['coding'] = list()
-    coding_cat = dict()
-    coding_cat['system'] = 'http://terminology.hl7.org/CodeSystem/observation-category'
-    coding_cat['code'] = category_type
-    coding_cat['display'] = category_display
-    category_detail['coding'].append(coding_cat)
-    category.append(category_detail)
-    resource['category'] = category
-
-    # code
-    code = dict()
-    code_detail = list()
-    coding_code = dict()
-    coding_code['system'] = 'http://loinc.org'
-    coding_code['code'] = LOINC_CODES[index - 5]
-    coding_code['display'] = LOINC_TEXTS[index - 5]
-    code_detail.append(coding_code)
-    code['coding'] = code_detail
-    code['text'] = coding_code['display']
-    resource['code'] = code
-
-    return resource
-
-
-def uploadPatient(patient_data):
-    patient_json = json.dumps(patient_data)
-    headers = {'Content-Type': 'application/json'}
-    url = settings['api_base'] + '/Patient/' + patient_data['id']
-
-    res = requests.put(url=url, headers=headers, data=patient_json).text
-    res = json.loads(res)
-
-    # print('Patient ID ' + res['id'] + ' successfully created on FHIR server:', url)
+def uploadBundle(bundle):
+    res = fhir_client.post('', bundle)
 
     return res
 
 
-def uploadObservation(observation_data):
-    observation_json = json.dumps(observation_data)
-    headers = {'Content-Type': 'application/json'}
-    url = settings['api_base'] + '/Observation/' + observation_data['id']
-
-    res = requests.put(url=url, headers=headers, data=observation_json).text
-    res = json.loads(res)
-
-    # print('Observation ID ' + res['id'] + ' successfully created on FHIR server:', url)
+def encode_json(data):
+    # compact JSON as bytes
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def compile_observation_templates(effective):
+    # the encoded parts of each column's Observation around its id, patient reference and value, with one
+    # effective time for the whole run
+    templates = dict()
+    for column, loinc_code, loinc_text in zip(OBSERVATION_COLUMNS, LOINC_CODES, LOINC_TEXTS):
+        category_code, category_display, value_key = OBSERVATION_KINDS[column]
+        category = [{'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/observation-category',
+                                 'code': category_code, 'display': category_display}]}]
+        code = {'coding': [{'system': 'http://loinc.org', 'code': loinc_code, 'display': loinc_text}],
+                'text': loinc_text}
+        effective_times = b',"effectiveDateTime":' + encode_json(effective) + b',"issued":' + encode_json(effective)
+        templates[column] = (b'}' + effective_times,
+                             b',"category":' + encode_json(category) + b',"code":' + encode_json(code) + b'}')
+
+    return templates
+
+
+def encode_observation_values(column, values):
+    # the value element of every row, b'' leaves it out for flags other than 0 and 1 and NaN quantities
+    value_key = OBSERVATION_KINDS[column][2]
+    if value_key == 'valueCodeableConcept':
+        # few distinct wards, each is encoded once
+        encoded = dict()
+        for value in set(values):
+            text = encode_json(value)
+            encoded[value] = b',"valueCodeableConcept":{"coding":[{"system":"http://loinc.org","code":' + text \
+                             + b',"display":' + text + b'}],"text":' + text + b'}'
+        return [encoded[value] for value in values]
+    if value_key == 'valueBoolean':
+        encoded = {1: b',"valueBoolean":true', 0: b',"valueBoolean":false'}
+        return [encoded.get(value, b'') for value in values]
+
+    unit = encode_json('fL' if column == 'Mean platelet volume' else '10*3/uL')
+    suffix = b',"unit":' + unit + b',"system":"http://unitsofmeasure.org","code":' + unit + b'}'
+    # repr of a float is its JSON number, NaN values are left out
+    return [b',"valueQuantity":{"value":' + repr(value).encode('ascii') + suffix if value == value else b''
+            for value in values]
+
+
+def encode_patients(columns):
+    # the Patient resource of every row, with the prefix of its gender
+    encoded = list()
+    for patient_id, gender, dob, family, given in zip(columns['Patient ID'], columns['gender'], columns['dob'],
+                                                      columns['family name'], columns['given name']):
+        encoded.append(b'{"resourceType":"Patient","id":' + encode_json(patient_id) + b',"active":true,"gender":'
+                       + encode_json(gender) + b',"birthDate":' + encode_json(dob)
+                       + b',"name":[{"use":"official","family":' + encode_json(family) + b',"given":['
+                       + encode_json(given) + b'],"prefix":' + encode_json(NAME_PREFIXES.get(gender, list())) + b'}]}')
+
+    return encoded
+
+
+def generate_chunk(df_chunk, start, run):
+    # per row of the chunk, the (full url, encoded resource) of the patient and its observations. Columns are
+    # encoded one at a time, the rows only join the parts
+    templates = compile_observation_templates(run['effective'])
+    columns = {column: df_chunk[column].tolist() for column in df_chunk.columns}
+    patients = encode_patients(columns)
+    observation_values = [(column, encode_observation_values(column, columns[column]))
+                          for column in OBSERVATION_COLUMNS]
+
+    chunk_entries = list()
+    for row, (patient_id, patient) in enumerate(zip(columns['Patient ID'], patients)):
+        reference = b',"status":"final","subject":{"reference":' + encode_json('Patient/' + patient_id)
+        entries = [('Patient/' + patient_id, patient)]
+        for k, (column, values) in enumerate(observation_values):
+            # ids of one run share its uuid
+            observation_id = run['id'] + '-' + str(start + row) + '-' + str(k)
+            head, tail = templates[column]
+            entries.append(('Observation/' + observation_id,
+                            b'{"resourceType":"Observation","id":"' + observation_id.encode('ascii') + b'"'
+                            + reference + head + values[row] + tail))
+        chunk_entries.append(entries)
+
+    return chunk_entries
+
+
+def generate_resources(df_patient_source, workers=None, chunk_size=None):
+    # yields the chunks of generate_chunk in frame order, encoded by a process pool when there is more than one.
+    # At most two chunks per worker wait for the consumer, so memory stays bounded for any cohort size
+    workers = workers or settings['generate_workers']
+    chunk_size = chunk_size or settings['generate_chunk_size']
+    run = {'id': str(uuid.uuid4()), 'effective': datetime.now(timezone.utc).isoformat()}
+    chunks = ((df_patient_source[start:start + chunk_size], start, run)
+              for start in range(0, df_patient_source.shape[0], chunk_size))
+
+    if workers == 1 or df_patient_source.shape[0] <= chunk_size:
+        for chunk in chunks:
+            yield generate_chunk(*chunk)
+        return
+
+    # spawned, not forked: bulk_upload runs in a thread of the Flask app (see jobs.py), and a fork copies the
+    # locks other threads hold
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = deque()
+        for chunk in chunks:
+            futures.append(executor.submit(generate_chunk, *chunk))
+            if len(futures) > 2 * workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def encode_bundle(entries, bundle_type='transaction'):
+    # entries as (full url, encoded resource), each PUT to its full url
+    encoded_entries = list()
+    for full_url, resource in entries:
+        url = encode_json(full_url)
+        encoded_entries.append(b'{"fullUrl":' + url + b',"resource":' + resource + b',"request":{"method":"PUT","url":'
+                               + url + b'}}')
+
+    return b'{"resourceType":"Bundle","type":' + encode_json(bundle_type) + b',"entry":[' \
+        + b','.join(encoded_entries) + b']}'
+
+
+def write_ndjson(df_patient_source, directory, workers=None):
+    # FHIR bulk data files, Patient.ndjson and Observation.ndjson with one resource per line
+    os.makedirs(directory, exist_ok=True)
+    counts = {'Patient': 0, 'Observation': 0}
+    with open(os.path.join(directory, 'Patient.ndjson'), 'wb') as patient_file, \
+            open(os.path.join(directory, 'Observation.ndjson'), 'wb') as observation_file:
+        for chunk_entries in generate_resources(df_patient_source, workers):
+            patient_file.write(b''.join(entries[0][1] + b'\n' for entries in chunk_entries))
+            observation_file.write(b''.join(resource + b'\n' for entries in chunk_entries
+                                            for full_url, resource in entries[1:]))
+            counts['Patient'] += len(chunk_entries)
+            counts['Observation'] += sum(len(entries) - 1 for entries in chunk_entries)
+
+    return counts
+
+
+def write_bundles(df_patient_source, directory, bundle_size=None, workers=None):
+    # transaction Bundles of bundle_size patients, bundle-000001.json and so on, returns the number of files
+    bundle_size = bundle_size or settings['bundle_size']
+    os.makedirs(directory, exist_ok=True)
+    bundles = 0
+    patients = list()
+
+    def write_bundle(bundle_patients):
+        with open(os.path.join(directory, 'bundle-%06d.json' % (bundles + 1)), 'wb') as file:
+            file.write(encode_bundle([entry for entries in bundle_patients for entry in entries]))
+
+    for chunk_entries in generate_resources(df_patient_source, workers):
+        patients.extend(chunk_entries)
+        while len(patients) >= bundle_size:
+            write_bundle(patients[:bundle_size])
+            patients = patients[bundle_size:]
+            bundles += 1
+    if patients:
+        write_bundle(patients)
+        bundles += 1
+
+    return bundles
+
+
+def uploadBundleEntries(entries):
+    # return the entries (full url, encoded resource) which were not stored by the server
+    try:
+        res = uploadBundle(encode_bundle(entries))
+    except (requests.RequestException, ValueError) as error:
+        return entries, str(error)
+
+    failed_entries = list()
+    for entry, res_entry in zip(entries, res.get('entry', list())):
+        if not res_entry.get('response', dict()).get('status', '').startswith('2'):
+            failed_entries.append(entry)
+    # entries the server did not answer are failures as well
+    failed_entries.extend(entries[len(res.get('entry', list())):])
+
+    return failed_entries, None
+
+
+def bulk_upload(df_patient_source, bundle_size=None, max_workers=None, retries=None, progress=None):
+    bundle_size = bundle_size or settings['bundle_size']
+    max_workers = max_workers or settings['upload_workers']
+    retries = settings['upload_retries'] if retries is None else retries
+
+    # the resources are encoded chunk by chunk while the previous chunk is sent
+    entries_per_patient = len(OBSERVATION_COLUMNS) + 1
+    entries_per_bundle = bundle_size * entries_per_patient
+    total_entries, stored_entries = df_patient_source.shape[0] * entries_per_patient, 0
+    patient_list = list()
 
-    return res
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for patient_entries in generate_resources(df_patient_source):
+            pending = [entry for entries in patient_entries for entry in entries]
+            for attempt in range(retries + 1):
+                if not pending:
+                    break
+                bundles = [pending[i:i + entries_per_bundle] for i in range(0, len(pending), entries_per_bundle)]
+                futures = {executor.submit(uploadBundleEntries, bundle): n for n, bundle in enumerate(bundles)}
+                pending = list()
+                try:
+                    for done, future in enumerate(as_completed(futures), start=1):
+                        failed_entries, error = future.result()
+                        pending.extend(failed_entries)
+                        stored_entries += len(bundles[futures[future]]) - len(failed_entries)
+                        metrics.inc('ingest_rows_total', len(bundles[futures[future]]) - len(failed_entries),
+                                    stage='upload')
+                        message = None
+                        if failed_entries:
+                            message = 'Error on bundle ' + str(futures[future] + 1) + ' / ' + str(len(bundles)) \
+                                      + ' (attempt ' + str(attempt + 1) + '): ' + str(len(failed_entries)) \
+                                      + ' failed entries ' + (error or '')
+                            print(message)
+                        else:
+                            print('Processing bundle', done, '/', len(bundles))
+                        if progress is not None:
+                            progress(stored_entries, total_entries, message)
+                except BaseException:
+                    # stop sending the remaining bundles, e.g. when the job was cancelled
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+            failed_urls = set(full_url for full_url, resource in pending)
+
+            # a patient counts as uploaded only when itself and every observation were stored
+            for entries in patient_entries:
+                patient_id = entries[0][0].split('/', 1)[1]
+                if not any(full_url in failed_urls for full_url, resource in entries):
+                    patient_list.append(patient_id)
+                else:
+                    print('Error on patient', patient_id)
+
+    return patient_list
 
 
 def get_database_data(path='sqlite:///project_database.db'):
@@ -164,9 +303,8 @@ def get_database_data(path='sqlite:///project_database.db'):
 
 
 def export_patient_list(patient_source_list, path='sqlite:///project_database.db'):
-    disk_engine = create_engine(path)
-    df_patient_list = pd.DataFrame(patient_source_list, columns=['Patient ID'])
-    df_patient_list.to_sql('app_patient_list', disk_engine, if_exists='replace', index=False)
+    # counted as a new list version, the app's census checks compare the version
+    get_data_fhir.save_patient_list(patient_source_list, create_engine(path))
 
     uploaded_patients_message = str(
         len(patient_source_list)) + ' sample patient records have been uploaded to FHIR server.'
@@ -213,28 +351,13 @@ def create_sample_users(patient_list, path='sqlite:///project_database.db'):
     return
 
 
-def main(sample_size=5):
+def main(sample_size=5, bundle_size=None, max_workers=None, progress=None):
     df_patient_source = get_database_data()
-    # reduce the size of sample data for demonstration
-    df_patient_source = df_patient_source[:sample_size]
-    patient_list = list()
-    for index, row in df_patient_source.iterrows():
-        # print(row)
-        patient = createPatient(row)
-        res = uploadPatient(patient)
-        # when put patient data successfully
-        if 'id' in res:
-            for i in range(5, df_patient_source.shape[1]):
-                observation = createObservationForPatient(row, i)
-                res = uploadObservation(observation)
-            # when put observation data successfully
-            if 'id' in res:
-                print('Processing ', index + 1, '/', df_patient_source.shape[0])
-                patient_list.append(row['Patient ID'])
-            else:
-                print('Error on ', index + 1, '/', df_patient_source.shape[0])
-        else:
-            print('Error on ', index + 1, '/', df_patient_source.shape[0])
+    # reduce the size of sample data for demonstration, None uploads the whole table
+    if sample_size is not None:
+        df_patient_source = df_patient_source[:sample_size]
+
+    patient_list = bulk_upload(df_patient_source, bundle_size, max_workers, progress=progress)
 
     # create sample users
     create_sample_users(df_patient_source)
@@ -244,6 +367,24 @@ def main(sample_size=5):
 
     return msg_sample_patients
 
+
+if __name__ == "__main__":
+    # write the FHIR resources of patient_source to disk, e.g. python upload_data.py ndjson export/
+    parser = argparse.ArgumentParser(description='Generate FHIR resources for the patient_source table')
+    parser.add_argument('format', choices=['ndjson', 'bundles'])
+    parser.add_argument('directory')
+    parser.add_argument('--sample-size', type=int, help='first rows only, default is the whole table')
+    parser.add_argument('--workers', type=int, default=settings['generate_workers'])
+    parser.add_argument('--bundle-size', type=int, default=settings['bundle_size'])
+    args = parser.parse_args()
+
+    df_source = get_database_data()[:args.sample_size]
+    if args.format == 'ndjson':
+        print(write_ndjson(df_source, args.directory, args.workers))
+    else:
+        print(write_bundles(df_source, args.directory, args.bundle_size, args.workers), 'bundles')
+
+
 ## working query
 # https://r4.smarthealthit.org/Patient?_id=168f9f9a-20a6-4ff9-b2f2-445dd527a15b
 # https://r4.smarthealthit.org/Observation?subject=Patient/168f9f9a-20a6-4ff9-b2f2-445dd527a15b&code=http://loinc.org|95424-8&_sort=-date
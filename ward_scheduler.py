@@ -0,0 +1,349 @@
+from itertools import count
+from bisect import bisect_right
+import heapq
+
+# capacity-consistent ward assignments. Patients are ordered by an acuity key, smaller is more acute
+# (get_data_fhir uses ranking_entry), and hold the first ward of their preference list with a free bed.
+# A more acute patient bumps the least acute occupant of a full ward down that occupant's own list, and a
+# freed bed goes to the most acute patient waiting for it, so every event costs O(log n) per ward.
+# Heap entries are never removed in place, a patient's token changes whenever it moves and stale entries
+# are skipped when they come up. A scheduler built from a ranking (build_ranked_scheduler) keeps the
+# patients in rank ranges, a patient gets its own state and heap entries the first time it is touched.
+
+
+class LeastAcute:
+    # occupant heap item, the least acute occupant is on top
+    __slots__ = ['key', 'token', 'patient_id']
+
+    def __init__(self, key, token, patient_id):
+        self.key = key
+        self.token = token
+        self.patient_id = patient_id
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+def create_scheduler(capacity):
+    scheduler = dict()
+    scheduler['capacity'] = dict(capacity)  # ward -> beds
+    scheduler['occupancy'] = {ward: 0 for ward in capacity}
+    scheduler['occupants'] = {ward: list() for ward in capacity}  # heaps of LeastAcute
+    scheduler['waiting'] = {ward: list() for ward in capacity}  # heaps of (key, token, patient id) wanting the ward
+    scheduler['patients'] = dict()  # patient id -> key, preferred wards, ward (None while waiting) and token
+    scheduler['moved'] = set()  # patients placed, bumped or moved up since take_moved_patients
+    # tokens are unique over the scheduler, so entries of a discharged and re-admitted patient stay stale
+    scheduler['tokens'] = count(1)
+    scheduler['ranked'] = create_ranking(capacity, list(), list(), list())
+
+    return scheduler
+
+
+def create_ranking(capacity, patient_ids, keys, groups):
+    ranking = dict()
+    ranking['patient ids'] = patient_ids  # in rank order
+    ranking['keys'] = keys  # key of each rank, may be computed on access
+    ranking['ranks'] = dict(zip(patient_ids, range(len(patient_ids))))  # not taken out yet
+    ranking['ends'] = [end for end, wards in groups]
+    ranking['wards'] = [[ward for ward in wards if ward in capacity] for end, wards in groups]
+    # per group, the rank where the occupants of each ward of its list start, then where the waiting ones start
+    ranking['cuts'] = list()
+    ranking['occupants'] = {ward: list() for ward in capacity}  # [start, end] rank ranges, least acute at the end
+    ranking['waiting'] = {ward: list() for ward in capacity}  # [start, end] rank ranges, most acute at the start
+
+    return ranking
+
+
+def build_scheduler(capacity, patients):
+    # (patient id, key, wards) in increasing key order, the same as admitting them one by one in O(n):
+    # nobody is bumped and the heaps are filled in an order that is already a heap
+    scheduler = create_scheduler(capacity)
+    occupancy, occupants, waiting = scheduler['occupancy'], scheduler['occupants'], scheduler['waiting']
+    known_wards = dict()  # the patients share a few preference lists
+    for patient_id, key, wards in patients:
+        wards = tuple(wards)
+        if wards not in known_wards:
+            known_wards[wards] = [ward for ward in wards if ward in capacity]
+        token = next(scheduler['tokens'])
+        patient = {'key': key, 'wards': known_wards[wards], 'ward': None, 'token': token}
+        scheduler['patients'][patient_id] = patient
+        for ward in patient['wards']:
+            if occupancy[ward] < capacity[ward]:
+                occupancy[ward] += 1
+                patient['ward'] = ward
+                occupants[ward].append(LeastAcute(key, token, patient_id))
+                break
+            waiting[ward].append((key, token, patient_id))
+    # occupants were added most acute first, the reverse order puts the least acute on top
+    for occupants in scheduler['occupants'].values():
+        occupants.reverse()
+
+    return scheduler
+
+
+def build_ranked_scheduler(capacity, patient_ids, keys, groups):
+    # patients in increasing key order, split by groups of (end, wards) into runs sharing a preference list. The
+    # same as admitting them one by one, which fills each ward with one rank range per group, so only the ranges
+    # are kept. keys are read when a patient is taken out of its range, they may be computed on access
+    scheduler = create_scheduler(capacity)
+    ranking = scheduler['ranked'] = create_ranking(capacity, patient_ids, keys, groups)
+    occupancy = scheduler['occupancy']
+    start = 0
+    for end, wards in zip(ranking['ends'], ranking['wards']):
+        cuts = [start]
+        for ward in wards:
+            beds = min(capacity[ward] - occupancy[ward], end - cuts[-1])
+            if beds > 0:
+                occupancy[ward] += beds
+                ranking['occupants'][ward].append([cuts[-1], cuts[-1] + beds])
+            cuts.append(cuts[-1] + max(beds, 0))
+        # the patients placed in a less preferred ward or in none wait for the ward
+        for index, ward in enumerate(wards):
+            if cuts[index + 1] < end:
+                ranking['waiting'][ward].append([cuts[index + 1], end])
+        ranking['cuts'].append(cuts)
+        start = end
+
+    return scheduler
+
+
+def iter_ranked_wards(scheduler):
+    # (ward, start, end) rank ranges of the patients still in their ranked ward
+    for ward, ranges in scheduler['ranked']['occupants'].items():
+        for start, end in ranges:
+            yield ward, start, end
+
+
+def admit(scheduler, patient_id, key, wards):
+    # wards in order of preference, an empty list needs no bed
+    if patient_id in scheduler['patients'] or patient_id in scheduler['ranked']['ranks']:
+        discharge(scheduler, patient_id)
+    patient = dict()
+    patient['key'] = key
+    patient['wards'] = [ward for ward in wards if ward in scheduler['capacity']]
+    patient['ward'] = None
+    patient['token'] = next(scheduler['tokens'])
+    scheduler['patients'][patient_id] = patient
+    place(scheduler, patient_id, 0)
+
+    return
+
+
+def discharge(scheduler, patient_id):
+    ranks = scheduler['ranked']['ranks']
+    if patient_id in ranks:
+        ward = ranked_place(scheduler, ranks.pop(patient_id))[2]
+    else:
+        ward = scheduler['patients'].pop(patient_id)['ward']
+    scheduler['moved'].discard(patient_id)
+    if ward is not None:
+        free_bed(scheduler, ward)
+
+    return
+
+
+def rescore(scheduler, patient_id, key, wards):
+    # a new acuity or a new preference list, unchanged patients keep their bed
+    patient = scheduler['patients'].get(patient_id)
+    if patient is not None and patient['key'] == key and patient['wards'] == list(wards):
+        return
+    rank = scheduler['ranked']['ranks'].get(patient_id)
+    if rank is not None and scheduler['ranked']['keys'][rank] == key \
+            and ranked_place(scheduler, rank)[0] == list(wards):
+        return
+    admit(scheduler, patient_id, key, wards)
+
+    return
+
+
+def get_ward(scheduler, patient_id):
+    patient = scheduler['patients'].get(patient_id)
+    if patient is None and patient_id in scheduler['ranked']['ranks']:
+        return ranked_place(scheduler, scheduler['ranked']['ranks'][patient_id])[2]
+
+    return patient['ward'] if patient is not None else None
+
+
+def take_moved_patients(scheduler):
+    moved = scheduler['moved']
+    scheduler['moved'] = set()
+
+    return moved
+
+
+def place(scheduler, patient_id, start):
+    # first free ward from the start-th preference on, bumping less acute occupants of full wards
+    patient = scheduler['patients'][patient_id]
+    for index in range(start, len(patient['wards'])):
+        ward = patient['wards'][index]
+        if scheduler['occupancy'][ward] < scheduler['capacity'][ward]:
+            scheduler['occupancy'][ward] += 1
+            occupy(scheduler, patient_id, index)
+            return
+        least_acute = peek_occupant(scheduler, ward)
+        if least_acute is not None and patient['key'] < least_acute[0]:
+            bumped = take_occupant(scheduler, ward, least_acute[1])
+            occupy(scheduler, patient_id, index)
+            # the bumped patient steps down its own list, it cannot get back into a more preferred ward
+            place(scheduler, least_acute[1], bumped['wards'].index(ward) + 1)
+            return
+
+    # no bed, wait for every ward of the list
+    patient['ward'] = None
+    patient['token'] = next(scheduler['tokens'])
+    scheduler['moved'].add(patient_id)
+    for ward in patient['wards']:
+        push_waiting(scheduler, ward, patient_id)
+
+    return
+
+
+def occupy(scheduler, patient_id, index):
+    # the bed is counted by the caller, the patient keeps waiting for the wards it prefers
+    patient = scheduler['patients'][patient_id]
+    ward = patient['wards'][index]
+    patient['ward'] = ward
+    patient['token'] = next(scheduler['tokens'])
+    scheduler['moved'].add(patient_id)
+    push_heap(scheduler, scheduler['occupants'][ward], LeastAcute(patient['key'], patient['token'], patient_id))
+    for preferred_ward in patient['wards'][:index]:
+        push_waiting(scheduler, preferred_ward, patient_id)
+
+    return
+
+
+def free_bed(scheduler, ward):
+    # the most acute patient waiting for the ward moves in, which frees its previous bed in turn
+    scheduler['occupancy'][ward] -= 1
+    most_acute = peek_waiting(scheduler, ward)
+    if most_acute is None:
+        return
+
+    # its waiting entry turns stale when it moves in
+    patient = take_patient(scheduler, most_acute[1])
+    previous_ward = patient['ward']
+    scheduler['occupancy'][ward] += 1
+    occupy(scheduler, most_acute[1], patient['wards'].index(ward))
+    if previous_ward is not None:
+        free_bed(scheduler, previous_ward)
+
+    return
+
+
+def peek_occupant(scheduler, ward):
+    # (key, patient id) of the least acute occupant, from the heap or the ranked ranges
+    occupants = scheduler['occupants'][ward]
+    while occupants and not is_current(scheduler, occupants[0]):
+        heapq.heappop(occupants)
+    least_acute = (occupants[0].key, occupants[0].patient_id) if occupants else None
+
+    ranking = scheduler['ranked']
+    ranges = ranking['occupants'][ward]
+    while ranges and not is_ranked(scheduler, ranges[-1][1] - 1):
+        ranges[-1][1] -= 1
+        if ranges[-1][0] == ranges[-1][1]:
+            ranges.pop()
+    if ranges:
+        rank = ranges[-1][1] - 1
+        if least_acute is None or ranking['keys'][rank] > least_acute[0]:
+            least_acute = (ranking['keys'][rank], ranking['patient ids'][rank])
+
+    return least_acute
+
+
+def peek_waiting(scheduler, ward):
+    # (key, patient id) of the most acute patient waiting for the ward, from the heap or the ranked ranges
+    waiting = scheduler['waiting'][ward]
+    while waiting and not is_current(scheduler, waiting[0]):
+        heapq.heappop(waiting)
+    most_acute = (waiting[0][0], waiting[0][2]) if waiting else None
+
+    ranking = scheduler['ranked']
+    ranges = ranking['waiting'][ward]
+    while ranges and not is_ranked(scheduler, ranges[0][0]):
+        ranges[0][0] += 1
+        if ranges[0][0] == ranges[0][1]:
+            ranges.pop(0)
+    if ranges:
+        rank = ranges[0][0]
+        if most_acute is None or ranking['keys'][rank] < most_acute[0]:
+            most_acute = (ranking['keys'][rank], ranking['patient ids'][rank])
+
+    return most_acute
+
+
+def take_occupant(scheduler, ward, patient_id):
+    # the occupant found by peek_occupant leaves the ward's heap or range
+    if patient_id in scheduler['ranked']['ranks']:
+        return take_ranked(scheduler, patient_id, occupant=False)
+    heapq.heappop(scheduler['occupants'][ward])
+
+    return scheduler['patients'][patient_id]
+
+
+def take_patient(scheduler, patient_id):
+    # the state of a scheduled patient, taken out of its rank range. Needed before its key changes when the keys
+    # are computed on access
+    if patient_id in scheduler['ranked']['ranks']:
+        return take_ranked(scheduler, patient_id)
+
+    return scheduler['patients'].get(patient_id)
+
+
+def take_ranked(scheduler, patient_id, occupant=True):
+    # the patient leaves its rank range and gets the state and heap entries admit would have given it
+    ranking = scheduler['ranked']
+    rank = ranking['ranks'].pop(patient_id)
+    wards, index, ward = ranked_place(scheduler, rank)
+    patient = dict()
+    patient['key'] = ranking['keys'][rank]
+    patient['wards'] = wards
+    patient['ward'] = ward
+    patient['token'] = next(scheduler['tokens'])
+    scheduler['patients'][patient_id] = patient
+    if ward is not None and occupant:
+        push_heap(scheduler, scheduler['occupants'][ward], LeastAcute(patient['key'], patient['token'], patient_id))
+    for preferred_ward in wards[:index]:
+        push_waiting(scheduler, preferred_ward, patient_id)
+
+    return patient
+
+
+def ranked_place(scheduler, rank):
+    # preference list, index in it and ward of a patient still in its rank range, ward None while waiting
+    ranking = scheduler['ranked']
+    group = bisect_right(ranking['ends'], rank)
+    wards = ranking['wards'][group]
+    index = bisect_right(ranking['cuts'][group], rank) - 1
+
+    return wards, index, wards[index] if index < len(wards) else None
+
+
+def is_ranked(scheduler, rank):
+    ranking = scheduler['ranked']
+
+    return ranking['ranks'].get(ranking['patient ids'][rank]) == rank
+
+
+def push_waiting(scheduler, ward, patient_id):
+    patient = scheduler['patients'][patient_id]
+    push_heap(scheduler, scheduler['waiting'][ward], (patient['key'], patient['token'], patient_id))
+
+    return
+
+
+def push_heap(scheduler, heap, item):
+    heapq.heappush(heap, item)
+    # drop the stale entries once they outnumber the patients, amortized O(1) per push
+    if len(heap) > 2 * len(scheduler['patients']) + 64:
+        heap[:] = [entry for entry in heap if is_current(scheduler, entry)]
+        heapq.heapify(heap)
+
+    return
+
+
+def is_current(scheduler, entry):
+    token, patient_id = (entry.token, entry.patient_id) if isinstance(entry, LeastAcute) else entry[1:]
+    patient = scheduler['patients'].get(patient_id)
+
+    return patient is not None and patient['token'] == token